@@ -1,21 +1,29 @@
 import asyncio
 
-import src.cache
+import src.audit
+import src.cache_backend
 import src.database
+import src.metrics
 
 loglevel = "debug"
 capture_output = True
 
 
+def on_starting(server):
+    src.metrics.clear_snapshots()
+
+
 def post_fork(server, worker):
     server.log.info(f"Executing post-fork for worker {worker.pid}")
-    src.cache.init_connection_pool()
+    src.cache_backend.init_connection_pool()
     src.database.init_thread_pool()
     src.database.init_connection_pool()
 
 
 def worker_exit(server, worker):
     server.log.info(f"Cleaning up resources on worker {worker.pid}")
-    asyncio.run(src.cache.close_connection_pool())
+    asyncio.run(src.cache_backend.close_connection_pool())
+    src.audit.flush()
     src.database.close_thread_pool()
     src.database.close_connection_pool()
+    src.metrics.close()
@@ -1,5 +1,5 @@
-import os
 import secrets
+import time
 from datetime import datetime
 
 from quart import (
@@ -10,13 +10,20 @@ from quart import (
     redirect,
     render_template,
     request,
-    send_from_directory,
+    Response,
     session,
     url_for,
 )
 
 from . import api
 from . import auth
+from . import compression
+from . import concurrency_limit
+from . import database
+from . import deadline
+from . import metrics
+from . import page_cache
+from . import static_assets
 from .config import config
 
 APP_URL = config["app"]["url"]
@@ -24,10 +31,35 @@ TEXT_MIN_CHAR = 110
 TEXT_MAX_CHAR = 512000
 
 
+def encoded_page(page, encoding):
+    return Response(
+        page,
+        content_type="text/html; charset=utf-8",
+        headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+    )
+
+
 def create_app():
-    app = Quart(__name__)
+    # Static files are served by 'static_assets', with cache headers.
+    app = Quart(__name__, static_folder=None)
     app.secret_key = secrets.token_hex()
 
+    @app.before_request
+    async def start_deadline():
+        deadline.start(request.endpoint)
+
+    @app.errorhandler(deadline.DeadlineExceeded)
+    async def deadline_exceeded(err):
+        return "The request took too long, please retry later", 504
+
+    @app.before_request
+    async def route_reads():
+        database.read_own_writes(session.get("last_write"))
+
+    @app.before_request
+    async def start_metrics():
+        metrics.start_flush_task()
+
     @app.route("/", methods=("GET", "POST"))
     async def index():
         if request.method == "GET":
@@ -71,15 +103,36 @@ def create_app():
                 == "on",
                 visibility=request_form["visibility"],
             )
+            session["last_write"] = time.time()
 
         return redirect(url_for("index", confirmation=text_id))
 
     @app.route("/text/<text_id>")
     async def get_text(text_id):
-        text_body = await api.get_text(text_id, g.user)
+        metadata = await api.get_readable_text_metadata(text_id, g.user)
+        if metadata is None:
+            abort(404)
+
+        # Pages of texts burned after reading are only rendered once.
+        encoding = None
+        if not database.is_text_burn_after_reading(metadata):
+            encoding = page_cache.accepted_encoding(
+                request.headers.get("Accept-Encoding", "")
+            )
+        if encoding is not None:
+            page = await page_cache.get(text_id, encoding)
+            if page is not None:
+                return encoded_page(page, encoding)
+
+        text_body = await api.read_text(text_id, metadata)
         if text_body is None:
             abort(404)
-        return await render_template("text.html", text_body=text_body)
+        html = await render_template(page_cache.TEMPLATE, text_body=text_body)
+        if encoding is None:
+            return html
+        page = await page_cache.compress(html, encoding)
+        await page_cache.put(text_id, encoding, page)
+        return encoded_page(page, encoding)
 
     @app.route("/delete-text", methods=("POST",))
     async def delete_text():
@@ -89,8 +142,11 @@ def create_app():
         if logged_user is None or user_id != logged_user:
             abort(403)
         await api.delete_text(
-            text_id=text_id, deletion_timestamp=datetime.now()
+            text_id=text_id,
+            deletion_timestamp=datetime.now(),
+            user_id=user_id,
         )
+        session["last_write"] = time.time()
         return "OK"
 
     @app.route("/mytexts")
@@ -100,21 +156,46 @@ def create_app():
             await flash("Please log in to see your saved texts")
             return await render_template("index.html")
 
-        texts = await api.get_texts_by_owner(user_id)
+        texts, next_page = await api.get_texts_by_owner(
+            user_id, after=request.args.get("after")
+        )
         return await render_template(
             "user_texts.html",
             mytexts=texts,
+            next_page=next_page,
             app_url=APP_URL,
         )
 
+    @app.route("/metrics")
+    async def metrics_endpoint():
+        return (
+            metrics.exposition(),
+            200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app.url_defaults(static_assets.add_version)
+
+    @app.route("/static/<path:filename>", endpoint="static")
+    async def static_file(filename):
+        return await static_assets.send_asset(
+            filename,
+            request.headers.get("Accept-Encoding", ""),
+            version=request.args.get("v"),
+        )
+
     @app.route("/favicon.ico")
     async def favicon():
-        return await send_from_directory(
-            os.path.join(app.root_path, "static"),
-            "favicon.ico",
-            mimetype="image/vnd.microsoft.icon",
+        return await static_assets.send_asset(
+            "favicon.ico", request.headers.get("Accept-Encoding", "")
         )
 
     app.register_blueprint(auth.bp)
 
+    app.asgi_app = compression.CompressionMiddleware(app.asgi_app)
+    if concurrency_limit.MAX_LIMIT > 0:
+        app.asgi_app = concurrency_limit.ConcurrencyLimitMiddleware(
+            app.asgi_app
+        )
+
     return app
@@ -1,10 +1,17 @@
+import json
 import re
 import uuid
 from datetime import datetime, timedelta
+from functools import partial
 
-from . import cache
+from . import cache_backend
 from . import database
+from . import deadline
+from . import disk_cache
+from . import ids
 from . import object_store
+from . import page_cache
+from . import text_filter
 from .config import config
 from .log import get_logger
 
@@ -15,6 +22,9 @@ SENTENCE_REGEX = re.compile(r"[\w,'&]+( [\w,'&]+)+")
 HTML_TAG_REGEX = re.compile(r"<.*?>")
 MINIMUM_TITLE_LENGTH = 40
 MAXIMUM_TITLE_LENGTH = 60
+TEXTS_PAGE_SIZE = 50
+USER_TEXTS_CACHE_EXPIRATION = 60  # seconds
+MISSING_TEXT_CACHE_EXPIRATION = 300  # seconds
 
 TTL_TO_HOURS = {
     "1h": 1,
@@ -52,6 +62,61 @@ def get_text_title(text_body):
     return "Untitled"
 
 
+def user_texts_cache_key(user_id):
+    return f"user-texts:{user_id}"
+
+
+def missing_text_cache_key(text_id):
+    return f"missing:{text_id}"
+
+
+async def invalidate_user_texts(user_id):
+    if user_id != config["app"]["default_user"]:
+        await cache_backend.delete(user_texts_cache_key(user_id))
+
+
+def encode_page_cursor(text):
+    return f"{text['creation'].isoformat()}_{text['text_id']}"
+
+
+def decode_page_cursor(cursor):
+    # ISO timestamps and UUIDs do not contain underscores.
+    try:
+        creation, text_id = cursor.split("_")
+        return datetime.fromisoformat(creation), str(uuid.UUID(text_id))
+    except (AttributeError, ValueError):
+        return
+
+
+def serialize_texts_page(texts, next_page):
+    return json.dumps(
+        {
+            "texts": [
+                {
+                    **text,
+                    "creation": text["creation"].isoformat(),
+                    "expiration": text["expiration"].isoformat(),
+                }
+                for text in texts
+            ],
+            "next_page": next_page,
+        }
+    )
+
+
+def deserialize_texts_page(value):
+    page = json.loads(value)
+    texts = [
+        {
+            **text,
+            "creation": datetime.fromisoformat(text["creation"]),
+            "expiration": datetime.fromisoformat(text["expiration"]),
+        }
+        for text in page["texts"]
+    ]
+    return texts, page["next_page"]
+
+
 async def put_text(
     text_body,
     text_title,
@@ -64,24 +129,78 @@ async def put_text(
     creation_timestamp = datetime.now()
     ttl_hours = TTL_TO_HOURS[ttl]
     expiration_timestamp = creation_timestamp + timedelta(hours=ttl_hours)
-    text_id = str(uuid.uuid4())
-    await object_store.put_text(text_id=text_id, text_body=text_body)
+    text_id = ids.new_text_id()
+    object_key, body = object_store.compress_text(text_body)
     text_title = text_title or get_text_title(text_body)
-    await database.put_text_metadata(
-        text_id=text_id,
-        text_title=text_title,
-        user_id=user_id,
-        user_ip=user_ip,
-        creation_timestamp=creation_timestamp,
-        expiration_timestamp=expiration_timestamp,
-        burn_after_reading=burn_after_reading,
-        visibility=visibility,
-    )
+    # The metadata is written once the object is stored, so texts are not
+    # readable before their body, even if another upload of it fails.
+    stored = await database.add_text_object_reference(object_key)
+    try:
+        if stored:
+            LOGGER.info(f"Text {text_id} already stored as {object_key}")
+        else:
+            await object_store.put_object(object_key, body)
+            await database.mark_text_object_stored(object_key)
+        await database.put_text_metadata(
+            text_id=text_id,
+            object_key=object_key,
+            text_title=text_title,
+            user_id=user_id,
+            user_ip=user_ip,
+            creation_timestamp=creation_timestamp,
+            expiration_timestamp=expiration_timestamp,
+            burn_after_reading=burn_after_reading,
+            visibility=visibility,
+        )
+    except Exception:
+        # Do not leave a reference to an object that may not be uploaded.
+        # The metadata write is not cancelled, so no text references it.
+        with deadline.suspended():
+            await database.release_text_object(
+                object_key, partial(object_store.delete_text, object_key)
+            )
+        raise
+    text_filter.add(text_id)
+    await invalidate_user_texts(user_id)
     return text_id
 
 
-async def get_text(text_id, user):
+async def text_may_exist(text_id):
+    """
+    Return False for text IDs that are known not to exist, without querying
+    the database.
+    """
+    parsed_text_id = ids.parse_text_id(text_id)
+    if parsed_text_id is None:
+        return False
+    known = text_filter.lookup(parsed_text_id)
+    if known is not None:
+        return known
+    # The negative cache is only checked when the filter cannot tell, to
+    # avoid a cache round trip for existing texts.
+    missing_key = missing_text_cache_key(parsed_text_id)
+    return await cache_backend.get(missing_key) is None
+
+
+async def get_readable_text_metadata(text_id, user):
+    """
+    Return the metadata of a text if it exists and the user can read it,
+    otherwise None.
+    """
+    if not await text_may_exist(text_id):
+        LOGGER.info(f"Text {text_id} does not exist, ignoring")
+        return
+
     metadata = await database.get_text_metadata(text_id)
+    if metadata is None:
+        LOGGER.info(f"Text {text_id} not found in database")
+        parsed_text_id = ids.parse_text_id(text_id)
+        await cache_backend.put(
+            missing_text_cache_key(parsed_text_id),
+            1,
+            ex=MISSING_TEXT_CACHE_EXPIRATION,
+        )
+        return
 
     if not database.text_is_visible(metadata):
         LOGGER.info(f"Text {text_id} is or will be deleted, ignoring")
@@ -94,32 +213,79 @@ async def get_text(text_id, user):
             return
         LOGGER.info(f"Text {text_id} accessed by owner")
 
-    text_body = await cache.get(text_id)
-    if text_body is not None:
-        LOGGER.info(f"Text {text_id} found in cache")
-        return text_body
-    LOGGER.info(f"Text {text_id} not found in cache")
-    text_body = await object_store.get_text(text_id)
+    return metadata
 
+
+async def read_text(text_id, metadata):
+    # Texts with the same body share their object and cache entries.
+    object_key = database.text_object_key(metadata)
     if database.is_text_burn_after_reading(metadata):
         LOGGER.info(f"Text {text_id} should be burned")
-        await database.mark_text_for_deletion(text_id)
-    else:
-        LOGGER.info(f"Text {text_id} should not be burned")
+        # Only the reader that flips 'to_be_deleted' gets the text, other
+        # concurrent readers stop here without fetching it.
+        if not await database.claim_text_for_burning(text_id):
+            LOGGER.info(f"Text {text_id} already burned by another reader")
+            return
+        await invalidate_user_texts(metadata["user_id"])
+        await page_cache.delete(text_id)
+        text_body = await cache_backend.getdel(object_key)
         if text_body is not None:
-            await cache.put(text_id, text_body)
+            LOGGER.info(f"Text {text_id} found in cache")
+            return text_body
+        return await object_store.get_text(object_key)
+
+    LOGGER.info(f"Text {text_id} should not be burned")
+    text_body = await cache_backend.get(object_key)
+    if text_body is not None:
+        LOGGER.info(f"Text {text_id} found in cache")
+        return text_body
+    LOGGER.info(f"Text {text_id} not found in cache")
+    text_body = await disk_cache.get(object_key)
+    if text_body is not None:
+        LOGGER.info(f"Text {text_id} found in disk cache")
+        return text_body
+    text_body = await object_store.get_text(object_key)
+    if text_body is not None:
+        await cache_backend.put(object_key, text_body)
+        await disk_cache.put(object_key, text_body)
 
     return text_body
 
 
-async def delete_text(text_id, deletion_timestamp):
+async def get_text(text_id, user):
+    metadata = await get_readable_text_metadata(text_id, user)
+    if metadata is None:
+        return
+    return await read_text(text_id, metadata)
+
+
+async def release_text(text_id, object_key, deletion_timestamp):
+    """
+    Mark a text as deleted, and delete its object from storage unless other
+    texts have the same body. Return True if the object was deleted, then
+    the caller should remove it from caches.
+    """
+    return await database.release_text_object(
+        object_key,
+        partial(object_store.delete_text, object_key),
+        text_id=text_id,
+        deletion_timestamp=deletion_timestamp,
+    )
+
+
+async def delete_text(text_id, deletion_timestamp, user_id=None):
     # Mark for deletion in metadata database before deleting from object
     # storage to avoid errors when text ID shows up in web app but then is not
     # found.
     await database.mark_text_for_deletion(text_id)
-    await object_store.delete_text(text_id)
-    await database.mark_text_deleted(text_id, deletion_timestamp)
-    await cache.delete(text_id)
+    metadata = await database.get_text_metadata(text_id)
+    object_key = database.text_object_key(metadata)
+    if await release_text(text_id, object_key, deletion_timestamp):
+        await cache_backend.delete(object_key)
+        await disk_cache.delete(object_key)
+    await page_cache.delete(text_id)
+    if user_id is not None:
+        await invalidate_user_texts(user_id)
 
 
 async def user_exceeded_quota(user_id, user_ip):
@@ -139,5 +305,33 @@ async def get_text_owner(text_id):
     return await database.get_text_owner(text_id)
 
 
-async def get_texts_by_owner(user_id):
-    return await database.get_texts_by_owner(user_id)
+async def get_texts_by_owner(user_id, after=None):
+    """
+    Return a page of texts owned by a user, in creation order, and a cursor
+    for the next page (``None`` if this is the last page).
+
+    The first page is what users see when they open 'My texts', it is
+    cached for a short time and invalidated when the user's texts change.
+    """
+    after = decode_page_cursor(after)
+    if after is None:
+        cached = await cache_backend.get(user_texts_cache_key(user_id))
+        if cached is not None:
+            LOGGER.info(f"Texts of user {user_id} found in cache")
+            return deserialize_texts_page(cached)
+
+    texts = await database.get_texts_by_owner(
+        user_id, after, TEXTS_PAGE_SIZE + 1
+    )
+    next_page = None
+    if len(texts) > TEXTS_PAGE_SIZE:
+        texts = texts[:TEXTS_PAGE_SIZE]
+        next_page = encode_page_cursor(texts[-1])
+
+    if after is None:
+        await cache_backend.put(
+            user_texts_cache_key(user_id),
+            serialize_texts_page(texts, next_page),
+            ex=USER_TEXTS_CACHE_EXPIRATION,
+        )
+    return texts, next_page
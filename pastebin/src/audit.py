@@ -0,0 +1,97 @@
+"""
+Write-behind audit log of login attempts.
+
+Events are buffered in a bounded queue and written to the table
+'user_connections' by a background task, with one multi-row INSERT per batch,
+so logins do not wait for the database. When the queue is full, events are
+dropped and counted rather than slowing down logins.
+"""
+import asyncio
+import contextvars
+from datetime import datetime
+
+from . import database
+from .config import config
+from .log import get_logger
+
+LOGGER = get_logger()
+QUEUE_SIZE = config["audit"]["queue_size"]
+BATCH_SIZE = config["audit"]["batch_size"]
+FLUSH_INTERVAL = config["audit"]["flush_interval"] / 1000  # seconds
+
+queue = None
+writer_task = None
+# Events taken from the queue by the writer task and not written yet.
+pending = []
+dropped_events = 0
+
+
+def record_user_connect(user_id, user_ip, success):
+    global queue, writer_task, dropped_events
+    # The queue and the writer task are created lazily because gunicorn
+    # hooks run before the worker starts its asyncio loop.
+    if queue is None:
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    if writer_task is None or writer_task.done():
+        # A new context, so the task does not inherit the request deadline.
+        writer_task = asyncio.get_running_loop().create_task(
+            write_events(), context=contextvars.Context()
+        )
+
+    try:
+        queue.put_nowait((user_id, user_ip, datetime.now(), success))
+    except asyncio.QueueFull:
+        dropped_events += 1
+        LOGGER.warning(
+            f"Audit queue is full, {dropped_events} events dropped so far"
+        )
+
+
+async def next_batch():
+    loop = asyncio.get_running_loop()
+    pending.append(await queue.get())
+    flush_time = loop.time() + FLUSH_INTERVAL
+    while len(pending) < BATCH_SIZE:
+        timeout = flush_time - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            pending.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+
+async def write_events():
+    while True:
+        await next_batch()
+        try:
+            await database.record_user_connects(list(pending))
+        except Exception as err:
+            LOGGER.error(
+                f"{err.__class__.__name__} when writing {len(pending)} audit "
+                f"events: {err}"
+            )
+        pending.clear()
+
+
+def flush():
+    """
+    Stop the writer task, then write the events it has not written and the
+    events left in the queue, synchronously. Call when the worker exits,
+    before closing the database connection pool.
+    """
+    global writer_task
+    # The loop of the task is usually closed already, which cancelled it.
+    if writer_task is not None and not writer_task.get_loop().is_closed():
+        writer_task.cancel()
+    writer_task = None
+    # A batch interrupted while being written may be written twice, rather
+    # than lost.
+    events = list(pending)
+    pending.clear()
+    if queue is not None:
+        while not queue.empty():
+            events.append(queue.get_nowait())
+    if events:
+        LOGGER.info(f"Flushing {len(events)} audit events")
+        database.record_user_connects_sync(events)
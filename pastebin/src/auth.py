@@ -1,4 +1,5 @@
 import string
+import time
 
 from quart import (
     Blueprint,
@@ -12,6 +13,8 @@ from quart import (
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from . import audit
+from . import cache_backend
 from . import database
 from . import return_codes
 from .config import config
@@ -26,6 +29,13 @@ except ImportError:
 
 MIN_PASSWORD_LEN = 10
 DEFAULT_USER = config["app"]["default_user"]
+LOGIN_LOCK_TIMEOUT = database.USER_LOCK_TIMEOUT * 60  # seconds
+MAX_LOGIN_FAIL_USER = database.MAX_CONNECT_FAIL
+MAX_LOGIN_FAIL_IP = 20
+USER_LOCKED_ERROR = "User account is locked for 15 minutes"
+IP_LOCKED_ERROR = (
+    "Too many login attempts from your address, try again in 15 minutes"
+)
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
@@ -52,6 +62,24 @@ def check_password_complexity(pw):
     return all([has_lower, has_upper, has_digit, has_punct])
 
 
+async def login_lock_error(user_id, attempts):
+    """
+    Return the error shown when logins are locked for the user or the IP
+    address, or ``None`` if the login can proceed.
+    """
+    if attempts is None:
+        # The cache is not available, fall back to the audit log.
+        if await database.user_is_locked(user_id):
+            return USER_LOCKED_ERROR
+        return
+    # Attempts include the current one.
+    user_attempts, ip_attempts = attempts
+    if user_attempts > MAX_LOGIN_FAIL_USER:
+        return USER_LOCKED_ERROR
+    if ip_attempts > MAX_LOGIN_FAIL_IP:
+        return IP_LOCKED_ERROR
+
+
 @bp.route("/register", methods=("GET", "POST"))
 async def register():
     if request.method == "POST":
@@ -88,6 +116,7 @@ async def register():
             if rcode is return_codes.USER_EXISTS:
                 error = f"User ID '{user_id}' is already taken"
             else:
+                session["last_write"] = time.time()
                 await flash(f"User '{user_id}' successfully created!")
                 return redirect(url_for("auth.login"))
 
@@ -107,35 +136,51 @@ async def login():
             return redirect(url_for("auth.login"))
 
         password = request_form["password"]
+        user_ip = request.headers.get("X-Forwarded-For", request.remote_addr)
+
+        # Lockout state is kept in the cache, so attempts on locked accounts
+        # or from abusive IP addresses do not reach the database. Attempts
+        # are counted before the password is checked, and the lockout is
+        # decided from the incremented counters, so concurrent attempts
+        # cannot all pass the check before any of them is counted.
+        attempts = await cache_backend.record_login_attempt(
+            user_id,
+            user_ip,
+            ex=LOGIN_LOCK_TIMEOUT,
+            limits=(MAX_LOGIN_FAIL_USER, MAX_LOGIN_FAIL_IP),
+        )
+        error = await login_lock_error(user_id, attempts)
+        if error is not None:
+            await flash(error)
+            return redirect(url_for("auth.login"))
 
         user_info = await database.get_user(user_id)
         if user_info is None:
             await flash("Incorrect user")
             return redirect(url_for("auth.login"))
 
-        if await database.user_is_locked(user_id):
-            await flash("User account is locked for 15 minutes")
-            return redirect(url_for("auth.login"))
-
         error = None
         success = True
         if not check_password_hash(user_info["password"], password):
             error = "Incorrect password"
             success = False
 
-        user_ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-        await database.record_user_connect(
-            user_id=user_id,
-            user_ip=user_ip,
-            success=success,
+        audit.record_user_connect(
+            user_id=user_id, user_ip=user_ip, success=success
         )
 
         if error:
             await flash(error)
             return redirect(url_for("auth.login"))
 
+        if attempts is not None:
+            await cache_backend.record_login_success(user_id, user_ip)
+
+        last_write = session.get("last_write")
         session.clear()
         session["user_id"] = user_id
+        if last_write is not None:
+            session["last_write"] = last_write
         return redirect(url_for("index"))
 
     return await render_template("auth/login.html")
@@ -0,0 +1,588 @@
+"""
+Benchmarks for the pastebin application. Run with, for example:
+
+    python -m src.benchmark text-ids --rows 10000000
+    python -m src.benchmark text-filter --texts 1000000
+    python -m src.benchmark metrics --calls 1000000
+    python -m src.benchmark hedging --requests 5000 --budget 0.05
+    MYPASTEBIN_CACHE_HOSTS=localhost:7001,localhost:7002,localhost:7003 \\
+        python -m src.benchmark cache-shards --keys 100000
+    python -m src.benchmark cache-backends --redis-hosts localhost:6379 \\
+        --memcached-hosts localhost:11211
+    python -m src.benchmark compression --text-size 512000 --bandwidth 20
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import statistics
+import string
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import mysql.connector
+
+from . import cache
+from . import compression
+from . import database
+from . import ids
+from . import memcached
+from . import metrics
+from . import object_store
+from . import text_filter
+from .config import config
+
+CREATE_BENCHMARK_TABLE = """
+CREATE TABLE {table_name} (
+  text_id {text_id_type} PRIMARY KEY,
+  text_title VARCHAR(255),
+  creation TIMESTAMP
+)
+;"""
+
+INSERT_BENCHMARK_ROW = """
+INSERT INTO {table_name} (text_id, text_title, creation) VALUES (%s, %s, %s)
+;"""
+
+TEXT_ID_SCHEMES = {
+    "uuid4": uuid.uuid4,
+    "uuid7": ids.uuid7,
+}
+
+
+def benchmark_text_id_inserts(rows, batch_size, storage, report_every):
+    """
+    Insert rows in a scratch table keyed by random (UUIDv4) or time-ordered
+    (UUIDv7) IDs, and report insert throughput as the table grows.
+    """
+    results = {}
+    with mysql.connector.connect(**database.DB_CONFIG) as con:
+        with con.cursor() as cur:
+            for scheme, make_id in TEXT_ID_SCHEMES.items():
+                table_name = f"benchmark_text_ids_{scheme}"
+                cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+                cur.execute(
+                    CREATE_BENCHMARK_TABLE.format(
+                        table_name=table_name,
+                        text_id_type=database.TEXT_ID_TYPES[storage],
+                    )
+                )
+                query = INSERT_BENCHMARK_ROW.format(table_name=table_name)
+                encode = (
+                    (lambda u: u.bytes) if storage == "binary" else str
+                )
+
+                intervals = []
+                reported = 0
+                start = interval_start = time.perf_counter()
+                for inserted in range(0, rows, batch_size):
+                    size = min(batch_size, rows - inserted)
+                    now = datetime.now()
+                    cur.executemany(
+                        query,
+                        [
+                            (encode(make_id()), "benchmark", now)
+                            for _ in range(size)
+                        ],
+                    )
+                    con.commit()
+                    done = inserted + size
+                    if done - reported >= report_every or done == rows:
+                        elapsed = time.perf_counter() - interval_start
+                        intervals.append(
+                            {
+                                "rows": done,
+                                "rows_per_sec": round(
+                                    (done - reported) / elapsed
+                                ),
+                            }
+                        )
+                        print(f"{scheme}: {intervals[-1]}")
+                        reported = done
+                        interval_start = time.perf_counter()
+                total = time.perf_counter() - start
+                results[scheme] = {
+                    "rows": rows,
+                    "seconds": round(total, 3),
+                    "rows_per_sec": round(rows / total),
+                    "intervals": intervals,
+                }
+                cur.execute(f"DROP TABLE {table_name}")
+    return results
+
+
+def benchmark_text_filter(texts, lookups, error_rate):
+    """
+    Build a Bloom filter of random text IDs, then measure how fast IDs that
+    do not exist are rejected, and how many get through (false positives).
+    """
+    start = time.perf_counter()
+    bloom_filter = text_filter.BloomFilter(texts, error_rate)
+    for _ in range(texts):
+        bloom_filter.add(str(uuid.uuid4()))
+    build_seconds = time.perf_counter() - start
+
+    false_positives = 0
+    start = time.perf_counter()
+    for _ in range(lookups):
+        text_id = ids.parse_text_id(str(uuid.uuid4()))
+        if str(text_id) in bloom_filter:
+            false_positives += 1
+    lookup_seconds = time.perf_counter() - start
+
+    return {
+        "texts": texts,
+        "filter_bytes": len(bloom_filter.bits),
+        "hash_count": bloom_filter.hash_count,
+        "build_seconds": round(build_seconds, 3),
+        "lookups": lookups,
+        "lookups_per_sec": round(lookups / lookup_seconds),
+        "false_positive_rate": false_positives / lookups,
+    }
+
+
+async def noop():
+    pass
+
+
+async def time_calls(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        await func()
+    return time.perf_counter() - start
+
+
+def benchmark_metrics_overhead(calls):
+    """
+    Compare the time per call of an async function with and without
+    'metrics.timed', to measure the cost of instrumentation.
+    """
+    timed_noop = metrics.timed(noop)
+    plain = asyncio.run(time_calls(noop, calls))
+    timed = asyncio.run(time_calls(timed_noop, calls))
+    return {
+        "calls": calls,
+        "plain_ns_per_call": round(plain / calls * 1e9),
+        "timed_ns_per_call": round(timed / calls * 1e9),
+        "overhead_ns_per_call": round((timed - plain) / calls * 1e9),
+    }
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+
+class FakeS3:
+    """
+    Stand-in for an S3 client and session: GET latency is log-normal around
+    'median' seconds, and a 'tail_share' of requests are 'tail_factor' times
+    slower.
+    """
+
+    def __init__(self, median, tail_share, tail_factor):
+        self.median = median
+        self.tail_share = tail_share
+        self.tail_factor = tail_factor
+        self.body = zlib.compress(b"benchmark text " * 100)
+        self.requests = 0
+
+    def client(self, *args, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def get_object(self, Bucket, Key):
+        self.requests += 1
+        latency = self.median * random.lognormvariate(0, 0.25)
+        if random.random() < self.tail_share:
+            latency *= self.tail_factor
+        await asyncio.sleep(latency)
+        return {"Body": FakeBody(self.body)}
+
+
+async def read_texts(requests, concurrency):
+    latencies = []
+
+    async def worker(n):
+        for _ in range(n):
+            start = time.perf_counter()
+            await object_store.get_text("benchmark")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(
+        *(worker(requests // concurrency) for _ in range(concurrency))
+    )
+    return sorted(latencies)
+
+
+def benchmark_hedging(requests, concurrency, budget, median, tail_share):
+    """
+    Read texts from an S3 stand-in with a long latency tail, without and
+    with hedged requests, and compare latency percentiles.
+    """
+    results = {}
+    for hedge_budget in (0, budget):
+        fake_s3 = FakeS3(median, tail_share, tail_factor=20)
+        object_store.SESSION = fake_s3
+        object_store.HEDGE_BUDGET = hedge_budget
+        object_store.recent_latencies.clear()
+        object_store.hedge_delay = None
+        object_store.hedge_tokens = 0.0
+        hedges_before = metrics.counters.get(
+            (object_store.HEDGED_REQUESTS, ()), 0
+        )
+        wins_before = metrics.counters.get((object_store.HEDGE_WINS, ()), 0)
+
+        latencies = asyncio.run(read_texts(requests, concurrency))
+
+        hedges = (
+            metrics.counters.get((object_store.HEDGED_REQUESTS, ()), 0)
+            - hedges_before
+        )
+        wins = (
+            metrics.counters.get((object_store.HEDGE_WINS, ()), 0)
+            - wins_before
+        )
+        results[f"budget_{hedge_budget}"] = {
+            "requests": len(latencies),
+            "s3_requests": fake_s3.requests,
+            "hedge_rate": round(hedges / len(latencies), 4),
+            "hedge_win_rate": round(wins / hedges, 4) if hedges else None,
+            **{
+                f"p{round(q * 100)}_ms": round(
+                    latencies[int(q * len(latencies))] * 1000, 2
+                )
+                for q in (0.5, 0.95, 0.99)
+            },
+        }
+    return results
+
+
+async def fill_and_read_cache(keys, reads, batch_size=100):
+    prefix = f"benchmark:{uuid.uuid4().hex}:"
+    for start in range(0, keys, batch_size):
+        await asyncio.gather(
+            *(
+                cache.put(f"{prefix}{i}", "benchmark text", ex=600)
+                for i in range(start, min(keys, start + batch_size))
+            )
+        )
+    # Half of the reads are for keys that were never written.
+    for start in range(0, reads, batch_size):
+        await asyncio.gather(
+            *(
+                cache.get(f"{prefix}{random.randrange(2 * keys)}")
+                for _ in range(min(batch_size, reads - start))
+            )
+        )
+    return prefix
+
+
+def benchmark_cache_shards(keys, reads):
+    """
+    Write keys to the Redis nodes of 'MYPASTEBIN_CACHE_HOSTS', read them
+    back along with missing keys, and report the share of keys and the hit
+    rate of each shard.
+    """
+
+    async def run():
+        cache.init_connection_pool()
+        try:
+            return await fill_and_read_cache(keys, reads)
+        finally:
+            await cache.close_connection_pool()
+
+    prefix = asyncio.run(run())
+    assigned = collections.Counter(
+        cache.ring.get_node(f"{cache.KEY_PREFIX}{prefix}{i}").name
+        for i in range(keys)
+    )
+    lookups = collections.defaultdict(collections.Counter)
+    for (name, labels), count in metrics.counters.items():
+        label_values = dict(labels)
+        if name == metrics.CACHE_LOOKUPS and "shard" in label_values:
+            lookups[label_values["shard"]][label_values["result"]] += count
+    results = {}
+    for shard in cache.shards:
+        shard_reads = lookups[shard.name].total()
+        results[shard.name] = {
+            "key_share": round(assigned[shard.name] / keys, 4),
+            "reads": shard_reads,
+            "hit_rate": (
+                round(lookups[shard.name]["hit"] / shard_reads, 4)
+                if shard_reads
+                else None
+            ),
+        }
+    return results
+
+
+async def time_cache_reads(backend, keys, batch_size, value_size):
+    value = "x" * value_size
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    for batch in batches:
+        await asyncio.gather(*(backend.put(k, value, ex=600) for k in batch))
+    start = time.perf_counter()
+    for key in keys:
+        await backend.get(key)
+    single_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for batch in batches:
+        await backend.get_many(batch)
+    batch_seconds = time.perf_counter() - start
+    for batch in batches:
+        await asyncio.gather(*(backend.delete(k) for k in batch))
+    return single_seconds, batch_seconds
+
+
+def benchmark_cache_backends(
+    redis_hosts, memcached_hosts, keys, batch_size, value_size
+):
+    """
+    Read the same keys from Redis and memcached, one at a time and in
+    batches, and compare read throughput.
+    """
+    results = {}
+    for name, backend, hosts in (
+        ("redis", cache, redis_hosts),
+        ("memcached", memcached, memcached_hosts),
+    ):
+        config["cache"]["hosts"] = hosts
+        prefix = f"benchmark:{uuid.uuid4().hex}:"
+        key_names = [f"{prefix}{i}" for i in range(keys)]
+
+        async def run():
+            backend.init_connection_pool()
+            try:
+                return await time_cache_reads(
+                    backend, key_names, batch_size, value_size
+                )
+            finally:
+                await backend.close_connection_pool()
+
+        single_seconds, batch_seconds = asyncio.run(run())
+        results[name] = {
+            "hosts": hosts,
+            "get_per_sec": round(keys / single_seconds),
+            "get_many_keys_per_sec": round(keys / batch_seconds),
+        }
+    results["parameters"] = {
+        "keys": keys,
+        "batch_size": batch_size,
+        "value_size": value_size,
+    }
+    return results
+
+
+def random_paste(size):
+    # Words of a small vocabulary, on lines of various lengths, compress
+    # about as well as prose and code.
+    vocabulary = [
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(random.choices(vocabulary, k=random.randint(1, 15)))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+async def time_response(page, encoding, chunk_size):
+    chunks = [page[i:i + chunk_size] for i in range(0, len(page), chunk_size)]
+
+    async def app(scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/html; charset=utf-8")],
+            }
+        )
+        for i, chunk in enumerate(chunks):
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": i < len(chunks) - 1,
+                }
+            )
+
+    sent = 0
+
+    async def send(message):
+        nonlocal sent
+        sent += len(message.get("body", b""))
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [(b"accept-encoding", encoding.encode())],
+    }
+    start = time.perf_counter()
+    await compression.CompressionMiddleware(app)(scope, None, send)
+    return sent, time.perf_counter() - start
+
+
+def benchmark_compression(text_size, requests, bandwidth, chunk_size):
+    """
+    Send a page with a large text through the compression middleware with
+    each encoding and level, and report the bytes sent, the compression
+    time, and the time to last byte over a link of 'bandwidth' Mbit/s.
+    """
+    page = f"<!doctype html><html><body>{random_paste(text_size)}</body>"
+    page = f"{page}</html>".encode()
+    results = {}
+    for encoding, levels, setting in (
+        ("identity", [None], None),
+        ("gzip", [1, 3, 5, 6, 9], "GZIP_LEVEL"),
+        ("br", [1, 4, 5, 6, 9, 11], "BROTLI_QUALITY"),
+    ):
+        for level in levels:
+            if setting is not None:
+                setattr(compression, setting, level)
+            timings = []
+            for _ in range(requests):
+                sent, seconds = asyncio.run(
+                    time_response(page, encoding, chunk_size)
+                )
+                timings.append(seconds)
+            seconds = statistics.median(timings)
+            transfer = sent * 8 / (bandwidth * 1e6)
+            name = encoding if level is None else f"{encoding}-{level}"
+            results[name] = {
+                "bytes_sent": sent,
+                "ratio": round(len(page) / sent, 2),
+                "compression_ms": round(seconds * 1000, 2),
+                "time_to_last_byte_ms": round((seconds + transfer) * 1000, 1),
+            }
+    results["parameters"] = {
+        "page_size": len(page),
+        "requests": requests,
+        "bandwidth_mbit": bandwidth,
+        "chunk_size": chunk_size,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    text_ids = subparsers.add_parser(
+        "text-ids", help="insert throughput of random vs time-ordered IDs"
+    )
+    text_ids.add_argument("--rows", type=int, default=10000000)
+    text_ids.add_argument("--batch-size", type=int, default=1000)
+    text_ids.add_argument(
+        "--storage", choices=database.TEXT_ID_TYPES, default="varchar"
+    )
+    text_ids.add_argument("--report-every", type=int, default=1000000)
+
+    text_filter_parser = subparsers.add_parser(
+        "text-filter", help="rejection throughput of nonexistent text IDs"
+    )
+    text_filter_parser.add_argument("--texts", type=int, default=1000000)
+    text_filter_parser.add_argument("--lookups", type=int, default=1000000)
+    text_filter_parser.add_argument(
+        "--error-rate", type=float, default=text_filter.ERROR_RATE
+    )
+
+    metrics_parser = subparsers.add_parser(
+        "metrics", help="overhead of recording latency metrics"
+    )
+    metrics_parser.add_argument("--calls", type=int, default=1000000)
+
+    hedging = subparsers.add_parser(
+        "hedging", help="S3 read latency with and without hedged requests"
+    )
+    hedging.add_argument("--requests", type=int, default=5000)
+    hedging.add_argument("--concurrency", type=int, default=50)
+    hedging.add_argument("--budget", type=float, default=0.05)
+    hedging.add_argument(
+        "--median", type=float, default=0.02, help="seconds"
+    )
+    hedging.add_argument("--tail-share", type=float, default=0.03)
+
+    cache_shards = subparsers.add_parser(
+        "cache-shards", help="key distribution and hit rate per cache shard"
+    )
+    cache_shards.add_argument("--keys", type=int, default=100000)
+    cache_shards.add_argument("--reads", type=int, default=100000)
+
+    cache_backends = subparsers.add_parser(
+        "cache-backends", help="read throughput of Redis and memcached"
+    )
+    cache_backends.add_argument("--redis-hosts", default="localhost:6379")
+    cache_backends.add_argument(
+        "--memcached-hosts", default="localhost:11211"
+    )
+    cache_backends.add_argument("--keys", type=int, default=20000)
+    cache_backends.add_argument("--batch-size", type=int, default=50)
+    cache_backends.add_argument("--value-size", type=int, default=2000)
+
+    compression_parser = subparsers.add_parser(
+        "compression",
+        help="bytes sent and time to last byte of compressed pages",
+    )
+    compression_parser.add_argument("--text-size", type=int, default=512000)
+    compression_parser.add_argument("--requests", type=int, default=20)
+    compression_parser.add_argument(
+        "--bandwidth", type=float, default=20, help="Mbit/s"
+    )
+    compression_parser.add_argument("--chunk-size", type=int, default=65536)
+
+    args = parser.parse_args()
+    if args.benchmark == "text-ids":
+        results = benchmark_text_id_inserts(
+            args.rows, args.batch_size, args.storage, args.report_every
+        )
+    elif args.benchmark == "text-filter":
+        results = benchmark_text_filter(
+            args.texts, args.lookups, args.error_rate
+        )
+    elif args.benchmark == "metrics":
+        results = benchmark_metrics_overhead(args.calls)
+    elif args.benchmark == "hedging":
+        results = benchmark_hedging(
+            args.requests,
+            args.concurrency,
+            args.budget,
+            args.median,
+            args.tail_share,
+        )
+    elif args.benchmark == "cache-shards":
+        results = benchmark_cache_shards(args.keys, args.reads)
+    elif args.benchmark == "cache-backends":
+        results = benchmark_cache_backends(
+            args.redis_hosts,
+            args.memcached_hosts,
+            args.keys,
+            args.batch_size,
+            args.value_size,
+        )
+    elif args.benchmark == "compression":
+        results = benchmark_compression(
+            args.text_size, args.requests, args.bandwidth, args.chunk_size
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
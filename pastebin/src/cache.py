@@ -1,40 +1,144 @@
+"""
+Cache of texts and counters in Redis, sharded across nodes.
+
+Keys are mapped to nodes by consistent hashing: each node owns many points
+(virtual nodes) on a hash ring, and a key belongs to the node of the first
+point after its hash. Adding a node only moves the keys of the ring ranges it
+takes over, and each node has its own circuit breaker, so a failed node only
+turns its share of keys into cache misses.
+"""
+import asyncio
 import functools
+import hashlib
+from bisect import bisect
+from operator import itemgetter
 
 import redis.asyncio as redis
 from redis.exceptions import RedisError
 
+from . import deadline
+from . import metrics
 from .circuit_breaker import AsyncCircuitBreaker
 from .config import config
 from .log import get_logger
 
 EXPIRATION_DEFAULT = 3600 * 24  # 1 day
 KEY_PREFIX = config["cache"]["key_prefix"]
+LOGIN_FAILURES_PREFIX = "login-failures:"
+VIRTUAL_NODES = 160  # points of each node on the hash ring
+BATCH_SIZE = 100  # keys per command of multi-key operations
 LOGGER = get_logger()
 
-circuit_breaker = AsyncCircuitBreaker(monitored_exceptions=(RedisError,))
 
-connection_pool = None
+def hash_key(key):
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
 
 
-def init_connection_pool():
-    global connection_pool
-    if connection_pool is None:
-        LOGGER.info("Creating cache connection pool")
-        connection_pool = redis.connection.ConnectionPool(
+class HashRing:
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        # Points are placed by node name, so all workers agree on the ring.
+        points = sorted(
+            (hash_key(f"{node.name}#{i}"), index)
+            for index, node in enumerate(nodes)
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [h for h, _ in points]
+        self.nodes = [nodes[index] for _, index in points]
+
+    def get_node(self, key):
+        index = bisect(self.hashes, hash_key(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+class Shard:
+    """
+    Connection pool to a Redis node, with its own circuit breaker.
+    """
+
+    def __init__(self, host, port):
+        self.name = f"{host}:{port}"
+        self.connection_pool = redis.connection.ConnectionPool(
             max_connections=config["cache"]["pool_size"],
-            host=config["cache"]["host"],
-            port=config["cache"]["port"],
+            host=host,
+            port=port,
             username=config["cache"]["username"],
             password=config["cache"]["password"],
             encoding=config["cache"]["encoding"],
             decode_responses=True,
         )
+        self.circuit_breaker = AsyncCircuitBreaker(
+            monitored_exceptions=(RedisError,)
+        )
+        self.guarded = {}
+
+    def client(self):
+        return redis.Redis(connection_pool=self.connection_pool)
+
+    async def call(self, func, *args, **kwargs):
+        guarded = self.guarded.get(func)
+        if guarded is None:
+            guarded = self.guarded[func] = self.circuit_breaker(func)
+        return await guarded(self, *args, **kwargs)
+
+
+shards = []
+ring = None
+
+
+def parse_cache_hosts(value):
+    cache_hosts = []
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        host, _, port = item.strip().partition(":")
+        cache_hosts.append((host, int(port or config["cache"]["port"])))
+    return cache_hosts
+
+
+def collect_gauges():
+    for shard in shards:
+        yield (
+            "pastebin_circuit_breaker_state",
+            (("breaker", "cache"), ("shard", shard.name)),
+            shard.circuit_breaker.state.value,
+        )
+
+
+metrics.register_gauges(collect_gauges)
+
+
+def init_connection_pool():
+    global ring
+    if shards == []:
+        cache_hosts = parse_cache_hosts(config["cache"]["hosts"]) or [
+            (config["cache"]["host"], int(config["cache"]["port"]))
+        ]
+        for host, port in cache_hosts:
+            LOGGER.info(f"Creating cache connection pool to {host}:{port}")
+            shards.append(Shard(host, port))
+        ring = HashRing(shards)
 
 
 async def close_connection_pool():
-    if connection_pool is not None:
-        LOGGER.info("Closing cache connection pool")
-        await connection_pool.aclose()
+    for shard in shards:
+        LOGGER.info(f"Closing cache connection pool to {shard.name}")
+        await shard.connection_pool.aclose()
+
+
+def sharded(func):
+    """
+    Route a call to the shard that owns the key, the first argument. 'func'
+    is called through the circuit breaker of the shard, with the shard and
+    the prefixed key as first arguments.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(key, *args, **kwargs):
+        key = f"{KEY_PREFIX}{key}"
+        return await ring.get_node(key).call(func, key, *args, **kwargs)
+
+    return wrapper
 
 
 def manage_errors(func):
@@ -53,22 +157,219 @@ def manage_errors(func):
     return wrapper
 
 
+def group_by_shard(ring, items, key=None):
+    # 'key' returns the key of an item, items are keys by default.
+    groups = {}
+    for item in items:
+        node = ring.get_node(item if key is None else key(item))
+        groups.setdefault(node, []).append(item)
+    return groups
+
+
+def chunks(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def call_shards(func, groups, *args):
+    """
+    Call 'func' on each shard with its keys, in parallel. A failing shard is
+    logged and its result is None, so other shards are not affected.
+    """
+    results = await asyncio.gather(
+        *(shard.call(func, keys, *args) for shard, keys in groups.items()),
+        return_exceptions=True,
+    )
+    for shard, result in zip(groups, results):
+        if isinstance(result, Exception):
+            LOGGER.error(
+                f"{result.__class__.__name__} when calling "
+                f"'{func.__module__}.{func.__name__}' on {shard.name}: "
+                f"{result}"
+            )
+    return [
+        None if isinstance(result, Exception) else result
+        for result in results
+    ]
+
+
 @manage_errors
-@circuit_breaker
-async def put(key, value, ex=EXPIRATION_DEFAULT):
-    async with redis.Redis(connection_pool=connection_pool) as client:
-        await client.set(f"{KEY_PREFIX}{key}", value, ex=ex)
+@metrics.timed
+@deadline.bounded
+@sharded
+async def put(shard, key, value, ex=EXPIRATION_DEFAULT):
+    async with shard.client() as client:
+        await client.set(key, value, ex=ex)
 
 
 @manage_errors
-@circuit_breaker
-async def get(key):
-    async with redis.Redis(connection_pool=connection_pool) as client:
-        return await client.get(f"{KEY_PREFIX}{key}")
+@metrics.timed
+@deadline.bounded
+@sharded
+async def get(shard, key):
+    async with shard.client() as client:
+        value = await client.get(key)
+    metrics.record_cache_lookup(value is not None, shard=shard.name)
+    return value
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def get_bytes(shard, key):
+    # Values that are not text, such as compressed pages, are not decoded.
+    async with shard.client() as client:
+        value = await client.execute_command("GET", key, NEVER_DECODE=True)
+    metrics.record_cache_lookup(value is not None, shard=shard.name)
+    return value
+
+
+async def mget(shard, keys):
+    # Each MGET reads at most 'BATCH_SIZE' keys, all in one round trip.
+    async with shard.client() as client:
+        async with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks(keys):
+                pipe.mget(chunk)
+            values = [v for chunk in await pipe.execute() for v in chunk]
+    for value in values:
+        metrics.record_cache_lookup(value is not None, shard=shard.name)
+    return dict(zip(keys, values))
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def get_many(keys):
+    """
+    Return the values of 'keys' in the same order, None for missing keys.
+    Keys are read with one round trip per shard, and shards are read in
+    parallel.
+    """
+    groups = group_by_shard(ring, [f"{KEY_PREFIX}{key}" for key in keys])
+    values = {}
+    for found in await call_shards(mget, groups):
+        values.update(found or {})
+    return [values.get(f"{KEY_PREFIX}{key}") for key in keys]
+
+
+async def set_items(shard, items):
+    # Values can be large, so each round trip sends at most 'BATCH_SIZE'
+    # commands.
+    async with shard.client() as client:
+        for chunk in chunks(items):
+            async with client.pipeline(transaction=False) as pipe:
+                for key, value, ex in chunk:
+                    pipe.set(key, value, ex=ex)
+                await pipe.execute()
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def put_many(items):
+    """
+    Store '(key, value, ex)' items, 'ex' being the time to live in seconds,
+    with one pipeline of at most 'BATCH_SIZE' commands per round trip.
+    """
+    items = [(f"{KEY_PREFIX}{key}", value, ex) for key, value, ex in items]
+    await call_shards(set_items, group_by_shard(ring, items, itemgetter(0)))
+
+
+async def unlink(shard, keys):
+    # UNLINK frees memory in a background thread of the Redis server.
+    async with shard.client() as client:
+        async with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks(keys):
+                pipe.unlink(*chunk)
+            return sum(await pipe.execute())
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def delete_many(keys):
+    """
+    Delete keys with one round trip per shard, and return the number of
+    deleted keys.
+    """
+    groups = group_by_shard(ring, [f"{KEY_PREFIX}{key}" for key in keys])
+    return sum(count or 0 for count in await call_shards(unlink, groups))
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def getdel(shard, key):
+    async with shard.client() as client:
+        return await client.getdel(key)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def delete(shard, key):
+    async with shard.client() as client:
+        return await client.delete(key)
+
+
+def login_failures_keys(user_id, user_ip):
+    return (
+        f"{LOGIN_FAILURES_PREFIX}user:{user_id}",
+        f"{LOGIN_FAILURES_PREFIX}ip:{user_ip}",
+    )
+
+
+@sharded
+async def increment_counter(shard, key, ex, limit):
+    async with shard.client() as client:
+        async with client.pipeline(transaction=True) as pipe:
+            # The counter is created with its expiry, so it always expires.
+            pipe.set(key, 0, ex=ex, nx=True)
+            pipe.incr(key)
+            _, count = await pipe.execute()
+        # Attempts past the limit do not extend the lockout.
+        if 1 < count <= limit:
+            await client.expire(key, ex)
+    return count
+
+
+@sharded
+async def decrement_counter(shard, key):
+    # The counter was just incremented, so it exists and keeps its expiry.
+    async with shard.client() as client:
+        await client.decr(key)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def record_login_attempt(user_id, user_ip, ex, limits):
+    """
+    Count a login attempt for the user and for the IP address, and return
+    the numbers of recent attempts including this one, or ``None`` if the
+    cache is not available. Counters expire 'ex' seconds after the last
+    attempt within 'limits', the maximum numbers of attempts for the user
+    and for the IP address, so locked accounts cannot be kept locked.
+    """
+    # The two counters may be on different shards.
+    keys = login_failures_keys(user_id, user_ip)
+    return tuple(
+        await asyncio.gather(
+            *(
+                increment_counter(key, ex, limit)
+                for key, limit in zip(keys, limits)
+            )
+        )
+    )
 
 
 @manage_errors
-@circuit_breaker
-async def delete(key):
-    async with redis.Redis(connection_pool=connection_pool) as client:
-        return await client.delete(f"{KEY_PREFIX}{key}")
+@metrics.timed
+@deadline.bounded
+async def record_login_success(user_id, user_ip):
+    # Successful attempts do not count towards the lockout.
+    user_key, ip_key = login_failures_keys(user_id, user_ip)
+    await asyncio.gather(delete(user_key), decrement_counter(ip_key))
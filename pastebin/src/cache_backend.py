@@ -0,0 +1,63 @@
+"""
+Cache used by the application, on Redis ('cache') or memcached
+('memcached'), selected with 'MYPASTEBIN_CACHE_BACKEND'. Both backends have
+the same functions, errors are logged and reported as cache misses.
+"""
+from . import cache
+from . import memcached
+from .config import config
+
+BACKENDS = {
+    "redis": cache,
+    "memcached": memcached,
+}
+
+backend = BACKENDS[config["cache"]["backend"]]
+
+
+def init_connection_pool():
+    backend.init_connection_pool()
+
+
+async def close_connection_pool():
+    await backend.close_connection_pool()
+
+
+async def put(key, value, ex=cache.EXPIRATION_DEFAULT):
+    await backend.put(key, value, ex=ex)
+
+
+async def get(key):
+    return await backend.get(key)
+
+
+async def get_bytes(key):
+    return await backend.get_bytes(key)
+
+
+async def get_many(keys):
+    return await backend.get_many(keys)
+
+
+async def put_many(items):
+    await backend.put_many(items)
+
+
+async def delete_many(keys):
+    return await backend.delete_many(keys)
+
+
+async def getdel(key):
+    return await backend.getdel(key)
+
+
+async def delete(key):
+    return await backend.delete(key)
+
+
+async def record_login_attempt(user_id, user_ip, ex, limits):
+    return await backend.record_login_attempt(user_id, user_ip, ex, limits)
+
+
+async def record_login_success(user_id, user_ip):
+    await backend.record_login_success(user_id, user_ip)
@@ -123,7 +123,7 @@ class AsyncCircuitBreaker:
                                     "half-open", "closed"
                                 )
                             )
-                            return result
+                        return result
                     except self.monitored_exceptions as err:
                         LOGGER.error(
                             f"{type(self).__name__} in half-open state caught "
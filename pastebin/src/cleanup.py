@@ -1,42 +1,57 @@
 import asyncio
 from datetime import datetime
 
-from . import cache
+from . import api
+from . import cache_backend
 from . import database
+from . import disk_cache
 from . import object_store
+from . import page_cache
 from .log import get_logger
 
 LOGGER = get_logger()
 
 
 async def cleanup():
-    rows = await database.get_texts_for_deletion()
-    LOGGER.info(f"Number of texts to cleanup: {len(rows)}")
-    for idx, row in enumerate(rows, start=1):
-        prefix = f"{idx}/{len(rows)}"
-        text_id = row["text_id"]
-        LOGGER.info(f"{prefix} Cleaning up: {text_id}")
-        LOGGER.info(f"{prefix} Deleting from object store")
-        await object_store.delete_text(text_id)
-        LOGGER.info(f"{prefix} Deleting from cache")
-        await cache.delete(text_id)
-        LOGGER.info(f"{prefix} Marking as deleted")
-        await database.mark_text_deleted(
-            text_id=text_id, deletion_timestamp=datetime.now()
-        )
-        LOGGER.info(f"{prefix} Finished cleaning up: {text_id}")
-    LOGGER.info(f"Finished cleaning up {len(rows)} texts")
+    count = 0
+    async for rows in database.iter_texts_for_deletion():
+        LOGGER.info(f"Number of texts to cleanup in batch: {len(rows)}")
+        cache_keys = []
+        for row in rows:
+            count += 1
+            prefix = f"{count}"
+            text_id = row["text_id"]
+            object_key = database.text_object_key(row)
+            LOGGER.info(f"{prefix} Cleaning up: {text_id}")
+            LOGGER.info(f"{prefix} Deleting from object store")
+            if await api.release_text(
+                text_id, object_key, deletion_timestamp=datetime.now()
+            ):
+                cache_keys.append(object_key)
+                await disk_cache.delete(object_key)
+            cache_keys.extend(page_cache.page_keys(text_id))
+            LOGGER.info(f"{prefix} Finished cleaning up: {text_id}")
+        LOGGER.info(f"Deleting {len(cache_keys)} keys from cache")
+        await cache_backend.delete_many(cache_keys)
+    LOGGER.info(f"Finished cleaning up {count} texts")
+    object_keys = await database.delete_unreferenced_text_objects(
+        object_store.delete_text
+    )
+    for object_key in object_keys:
+        await disk_cache.delete(object_key)
+    await cache_backend.delete_many(object_keys)
+    LOGGER.info(f"Deleted {len(object_keys)} unreferenced objects")
 
 
 async def main():
-    cache.init_connection_pool()
+    cache_backend.init_connection_pool()
     database.init_thread_pool()
     database.init_connection_pool()
 
     try:
         await cleanup()
     finally:
-        await cache.close_connection_pool()
+        await cache_backend.close_connection_pool()
         database.close_thread_pool()
         database.close_connection_pool()
 
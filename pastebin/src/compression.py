@@ -0,0 +1,177 @@
+"""
+Compression of responses with Brotli or gzip, as ASGI middleware.
+
+Bodies are compressed as they are sent, one chunk at a time, so large pages
+are not copied into a second buffer. Small bodies are sent as they are, and
+so are responses which are already compressed, e.g. cached pages and
+precompressed static files. Levels are lower than for pages compressed once
+and cached, because each request pays for the compression.
+"""
+import asyncio
+import zlib
+
+import brotli
+
+from .config import config
+
+MIN_SIZE = config["compression"]["min_size"]  # bytes
+GZIP_LEVEL = config["compression"]["gzip_level"]
+BROTLI_QUALITY = config["compression"]["brotli_quality"]
+# Chunks at least this large are compressed in a thread, not in the loop.
+THREAD_MIN_SIZE = 64 * 1024  # bytes
+ENCODINGS = ("br", "gzip")
+COMPRESSIBLE_TYPES = (
+    b"text/",
+    b"application/json",
+    b"application/javascript",
+    b"image/svg+xml",
+)
+
+
+def parse_quality(params):
+    for param in params.split(";"):
+        name, _, value = param.partition("=")
+        if name.strip() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def accepted_encoding(accept_encoding, encodings=ENCODINGS):
+    """
+    Return the one of 'encodings' the client prefers, given its
+    'Accept-Encoding' header, or None. Ties go to the first in 'encodings'.
+    """
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        qualities[coding.strip()] = parse_quality(params)
+    best = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # 31 window bits write a gzip header and trailer.
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def new_compressor(encoding):
+    if encoding == "br":
+        return brotli.Compressor(quality=BROTLI_QUALITY)
+    return GzipCompressor(GZIP_LEVEL)
+
+
+def get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+
+
+def compressed_headers(headers, encoding):
+    # A strong ETag identifies the uncompressed body, so it is weakened.
+    # 'Accept-Encoding' is added to an existing 'Vary' header.
+    result = []
+    vary = None
+    for key, value in headers:
+        name = key.lower()
+        if name == b"content-length":
+            continue
+        if name == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        if name == b"vary":
+            vary = value
+            if b"accept-encoding" not in value.lower() and value != b"*":
+                value += b", Accept-Encoding"
+        result.append((key, value))
+    result.append((b"content-encoding", encoding.encode()))
+    if vary is None:
+        result.append((b"vary", b"Accept-Encoding"))
+    return result
+
+
+def should_compress(status, headers):
+    if status < 200 or status in (204, 304):
+        return False
+    if get_header(headers, b"content-encoding") is not None:
+        return False
+    content_type = get_header(headers, b"content-type") or b""
+    if not content_type.lower().startswith(COMPRESSIBLE_TYPES):
+        return False
+    length = get_header(headers, b"content-length")
+    return length is None or int(length) >= MIN_SIZE
+
+
+async def compress_chunk(compressor, data):
+    if len(data) >= THREAD_MIN_SIZE:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, compressor.process, data
+        )
+    return compressor.process(data)
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+        accept_encoding = get_header(scope["headers"], b"accept-encoding")
+        encoding = accepted_encoding((accept_encoding or b"").decode())
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Headers are sent with the first chunk of the body, once
+                # the response is known to be large enough.
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = start.get("headers", [])
+                if not should_compress(start["status"], headers) or (
+                    not more_body and len(body) < MIN_SIZE
+                ):
+                    await send(start)
+                    start = None
+                    return await send(message)
+                compressor = new_compressor(encoding)
+                start["headers"] = compressed_headers(headers, encoding)
+                await send(start)
+
+            data = await compress_chunk(compressor, body)
+            if not more_body:
+                data += compressor.finish()
+            if data or not more_body:
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": data,
+                        "more_body": more_body,
+                    }
+                )
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,132 @@
+"""
+Adaptive limit of concurrent requests, per worker.
+
+The limit follows observed latency, like the gradient algorithm of Netflix's
+concurrency-limits library: while the latency of recent requests stays close
+to the long-term latency, the limit grows; when it rises, e.g. because the
+database or the object store slow down, the limit shrinks so requests do not
+pile up in queues. Requests over the limit get a 503 response right away,
+before any work is done.
+
+Low priority requests (storing texts, logging in, ...) are only admitted
+below a share of the limit, which keeps room for reading texts.
+"""
+import math
+import time
+
+from . import metrics
+from .config import config
+
+INITIAL_LIMIT = config["concurrency"]["initial_limit"]
+MIN_LIMIT = config["concurrency"]["min_limit"]
+MAX_LIMIT = config["concurrency"]["max_limit"]
+LOW_PRIORITY_SHARE = 0.8
+RETRY_AFTER = b"1"  # seconds
+UNLIMITED_PATHS = ("/metrics",)
+HIGH_PRIORITY_PREFIXES = ("/text/", "/static/", "/favicon.ico")
+
+
+class GradientLimit:
+    def __init__(
+        self,
+        initial_limit,
+        min_limit,
+        max_limit,
+        smoothing=0.2,
+        rtt_tolerance=1.5,
+        short_window=10,
+        long_window=600,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.rtt_tolerance = rtt_tolerance
+        # Exponential moving averages of latency over about 'short_window'
+        # and 'long_window' requests.
+        self.short_alpha = 2 / (short_window + 1)
+        self.long_alpha = 2 / (long_window + 1)
+        self.short_rtt = None
+        self.long_rtt = None
+        self.inflight = 0
+
+    def update(self, rtt):
+        if self.short_rtt is None:
+            self.short_rtt = self.long_rtt = rtt
+        self.short_rtt += self.short_alpha * (rtt - self.short_rtt)
+        self.long_rtt += self.long_alpha * (rtt - self.long_rtt)
+        # Let the long-term latency follow quickly when latency drops after
+        # an incident, or the limit would stay high for too long.
+        if self.long_rtt / self.short_rtt > 2:
+            self.long_rtt *= 0.95
+
+        gradient = max(
+            0.5,
+            min(1.0, self.rtt_tolerance * self.long_rtt / self.short_rtt),
+        )
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        # Do not grow the limit when it is not the bottleneck.
+        if new_limit > self.limit and self.inflight < self.limit / 2:
+            return
+        self.limit += self.smoothing * (new_limit - self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+
+def is_high_priority(scope):
+    return scope["method"] == "GET" and scope["path"].startswith(
+        HIGH_PRIORITY_PREFIXES
+    )
+
+
+async def reject(send):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"retry-after", RETRY_AFTER),
+            ],
+        }
+    )
+    await send(
+        {
+            "type": "http.response.body",
+            "body": b"Service overloaded, please retry later",
+        }
+    )
+
+
+class ConcurrencyLimitMiddleware:
+    def __init__(self, app, limit=None):
+        self.app = app
+        if limit is None:
+            limit = GradientLimit(INITIAL_LIMIT, MIN_LIMIT, MAX_LIMIT)
+        self.limit = limit
+        metrics.register_gauges(self.collect_gauges)
+
+    def collect_gauges(self):
+        yield ("pastebin_concurrency_limit", (), self.limit.limit)
+        yield ("pastebin_requests_in_flight", (), self.limit.inflight)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNLIMITED_PATHS:
+            return await self.app(scope, receive, send)
+
+        priority = "high" if is_high_priority(scope) else "low"
+        capacity = self.limit.limit
+        if priority == "low":
+            capacity *= LOW_PRIORITY_SHARE
+        if self.limit.inflight >= capacity:
+            metrics.increment(
+                "pastebin_requests_rejected_total", (("priority", priority),)
+            )
+            return await reject(send)
+
+        self.limit.inflight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limit.update(time.perf_counter() - start)
+            self.limit.inflight -= 1
@@ -1,13 +1,24 @@
 import os
 
 
+DEFAULT_CACHE_PORTS = {"redis": 6379, "memcached": 11211}
+
+
 def get_config():
     # Should be a dictionary where keys are strings and values are dictionaries
     # or scalar values (string, integer).
+    cache_backend = os.getenv("MYPASTEBIN_CACHE_BACKEND", "redis")
     return {
         "text_storage": {
             "s3_bucket": os.getenv("MYPASTEBIN_S3_BUCKET"),
+            # Set to use an S3-compatible server, e.g. MinIO for local tests.
+            "s3_endpoint_url": os.getenv("MYPASTEBIN_S3_ENDPOINT_URL", ""),
             "encoding": os.getenv("MYPASTEBIN_TEXT_ENCODING", "utf-8"),
+            # Share of GET requests that may be duplicated when slower than
+            # the recent 95th percentile latency, 0 disables hedging.
+            "hedge_budget": float(
+                os.getenv("MYPASTEBIN_S3_HEDGE_BUDGET", 0)
+            ),
         },
         "database": {
             "host": os.getenv("MYPASTEBIN_DB_HOST", "localhost"),
@@ -16,19 +27,114 @@ def get_config():
             "user": os.getenv("MYPASTEBIN_DB_USER"),
             "password": os.getenv("MYPASTEBIN_DB_PASSWORD"),
             "pool_size": os.getenv("MYPASTEBIN_DB_CON_POOL_SIZE", 32),
+            # 'varchar' stores text IDs as strings, 'binary' as 16 bytes, see
+            # 'database.migrate_text_ids_to_binary'.
+            "text_id_storage": os.getenv(
+                "MYPASTEBIN_DB_TEXT_ID_STORAGE", "varchar"
+            ),
+            # Comma-separated 'host' or 'host:port' of read replicas, reads
+            # go to the primary if empty. Users read from the primary for
+            # 'replica_lag' seconds after they write.
+            "replica_hosts": os.getenv("MYPASTEBIN_DB_REPLICA_HOSTS", ""),
+            "replica_lag": int(os.getenv("MYPASTEBIN_DB_REPLICA_LAG", 5)),
         },
         "app": {
             "url": os.getenv("MYPASTEBIN_URL", "localhost"),
             "default_user": os.getenv("MYPASTEBIN_DEFAULT_USER", "anonymous"),
-            "texts_quota_anonymous": os.getenv(
-                "MYPASTEBIN_TEXTS_QUOTA_ANONYMOUS", 10
+            "texts_quota_anonymous": int(
+                os.getenv("MYPASTEBIN_TEXTS_QUOTA_ANONYMOUS", 10)
+            ),
+            "texts_quota_user": int(
+                os.getenv("MYPASTEBIN_TEXTS_QUOTA_USER", 100)
             ),
-            "texts_quota_user": os.getenv("MYPASTEBIN_TEXTS_QUOTA_USER", 100),
             "log_level": os.getenv("MYPASTEBIN_LOG_LEVEL", "info"),
         },
+        "audit": {
+            # Login events are buffered in memory and written in batches of
+            # 'batch_size' events or every 'flush_interval' milliseconds.
+            "queue_size": int(os.getenv("MYPASTEBIN_AUDIT_QUEUE_SIZE", 10000)),
+            "batch_size": int(os.getenv("MYPASTEBIN_AUDIT_BATCH_SIZE", 500)),
+            "flush_interval": int(
+                os.getenv("MYPASTEBIN_AUDIT_FLUSH_INTERVAL", 1000)
+            ),
+        },
+        "text_filter": {
+            # Each worker keeps a Bloom filter of existing text IDs, sized
+            # for 'capacity' IDs, and rebuilds it every 'refresh_interval'
+            # seconds. A capacity of 0 disables the filter.
+            "capacity": int(
+                os.getenv("MYPASTEBIN_TEXT_FILTER_CAPACITY", 10000000)
+            ),
+            "error_rate": float(
+                os.getenv("MYPASTEBIN_TEXT_FILTER_ERROR_RATE", 0.01)
+            ),
+            "refresh_interval": int(
+                os.getenv("MYPASTEBIN_TEXT_FILTER_REFRESH_INTERVAL", 3600)
+            ),
+        },
+        "deadline": {
+            # Seconds a request may take, 0 for no limit. 'routes' overrides
+            # it per endpoint, as 'endpoint=seconds,...'.
+            "default": float(os.getenv("MYPASTEBIN_DEADLINE_DEFAULT", 10)),
+            "routes": os.getenv("MYPASTEBIN_DEADLINE_ROUTES", "get_text=5"),
+        },
+        "concurrency": {
+            # Each worker adapts its limit of concurrent requests between
+            # 'min_limit' and 'max_limit', a 'max_limit' of 0 disables it.
+            "initial_limit": int(
+                os.getenv("MYPASTEBIN_CONCURRENCY_INITIAL_LIMIT", 50)
+            ),
+            "min_limit": int(
+                os.getenv("MYPASTEBIN_CONCURRENCY_MIN_LIMIT", 5)
+            ),
+            "max_limit": int(
+                os.getenv("MYPASTEBIN_CONCURRENCY_MAX_LIMIT", 500)
+            ),
+        },
+        "metrics": {
+            # Each worker writes its metrics to this directory every
+            # 'flush_interval' seconds, for '/metrics' to add them up.
+            "dir": os.getenv(
+                "MYPASTEBIN_METRICS_DIR", "/tmp/pastebin-metrics"
+            ),
+            "flush_interval": int(
+                os.getenv("MYPASTEBIN_METRICS_FLUSH_INTERVAL", 5)
+            ),
+        },
+        "compression": {
+            # Responses smaller than 'min_size' bytes are not compressed.
+            # Levels trade response size for CPU time per request.
+            "min_size": int(
+                os.getenv("MYPASTEBIN_COMPRESSION_MIN_SIZE", 1024)
+            ),
+            "gzip_level": int(
+                os.getenv("MYPASTEBIN_COMPRESSION_GZIP_LEVEL", 5)
+            ),
+            "brotli_quality": int(
+                os.getenv("MYPASTEBIN_COMPRESSION_BROTLI_QUALITY", 4)
+            ),
+        },
+        "disk_cache": {
+            # Directory of the local disk cache of texts, shared by workers
+            # of the host, disabled if empty. 'max_size' is in megabytes.
+            "dir": os.getenv("MYPASTEBIN_DISK_CACHE_DIR", ""),
+            "max_size": int(os.getenv("MYPASTEBIN_DISK_CACHE_MAX_SIZE", 1024)),
+        },
         "cache": {
+            # 'redis' or 'memcached'.
+            "backend": cache_backend,
             "host": os.getenv("MYPASTEBIN_CACHE_HOST", "localhost"),
-            "port": os.getenv("MYPASTEBIN_CACHE_PORT", 6379),
+            # Defaults to the port of the backend, 6379 or 11211.
+            "port": int(
+                os.getenv(
+                    "MYPASTEBIN_CACHE_PORT",
+                    DEFAULT_CACHE_PORTS.get(cache_backend, 6379),
+                )
+            ),
+            # Comma-separated 'host' or 'host:port' of nodes the cache
+            # is sharded across, replaces 'host' and 'port' if set, 'port'
+            # being the default port of nodes.
+            "hosts": os.getenv("MYPASTEBIN_CACHE_HOSTS", ""),
             "username": os.getenv("MYPASTEBIN_CACHE_USER"),
             "password": os.getenv("MYPASTEBIN_CACHE_PASSWORD"),
             "encoding": os.getenv("MYPASTEBIN_CACHE_ENCODING", "utf-8"),
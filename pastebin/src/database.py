@@ -1,5 +1,9 @@
 import asyncio
+import contextvars
 import enum
+import random
+import time
+import uuid
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
@@ -7,8 +11,15 @@ from functools import partial
 
 import mysql.connector
 
+from . import deadline
+from . import metrics
 from . import return_codes
 from . import sql_queries
+from .circuit_breaker import (
+    AsyncCircuitBreaker,
+    CircuitBreakerBypass,
+    CircuitBreakerException,
+)
 from .config import config
 from .log import get_logger
 
@@ -20,8 +31,23 @@ DB_CONFIG = {
     "password": config["database"]["password"],
 }
 DEFAULT_USER = config["app"]["default_user"]
+TEXT_ID_TYPES = {"varchar": "VARCHAR(255)", "binary": "BINARY(16)"}
+TEXT_ID_BINARY = config["database"]["text_id_storage"] == "binary"
+# Lower bounds to start scanning texts in primary key order.
+MIN_TEXT_ID = b"" if TEXT_ID_BINARY else ""
+MIN_TIMESTAMP = datetime(1970, 1, 1)
+DELETION_BATCH_SIZE = 1000
+MIGRATION_BATCH_SIZE = 10000
+TEXT_IDS_BATCH_SIZE = 10000
 MAX_CONNECT_FAIL = 3
 USER_LOCK_TIMEOUT = 15  # minutes
+REPLICA_LAG = config["database"]["replica_lag"]  # seconds
+STATEMENT_TIMEOUT_ERRNO = 1969  # MariaDB 'max_statement_time' exceeded
+MIN_STATEMENT_TIME = 0.001  # seconds
+# Deletions of objects still running after this time are assumed to have
+# stopped, e.g. because the process was killed.
+OBJECT_DELETION_TIMEOUT = timedelta(minutes=10)
+OBJECT_DELETION_POLL = 0.05  # seconds
 LOGGER = get_logger()
 
 
@@ -31,7 +57,60 @@ class TextVisibility(enum.Enum):
     PRIVATE = "private"
 
 
+def encode_text_id(text_id):
+    # Raises ValueError if the text ID is not a UUID.
+    if TEXT_ID_BINARY:
+        return uuid.UUID(text_id).bytes
+    return text_id
+
+
+def decode_text_id(value):
+    if TEXT_ID_BINARY:
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+
+def decode_text_ids(rows):
+    for row in rows:
+        row["text_id"] = decode_text_id(row["text_id"])
+    return rows
+
+
+def parse_replica_hosts(value):
+    replica_hosts = []
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        host, _, port = item.strip().partition(":")
+        replica_hosts.append((host, int(port or DB_CONFIG["port"])))
+    return replica_hosts
+
+
+class Replica:
+    """
+    Connection pool to a read replica, with its own circuit breaker so a
+    failing replica is skipped until it recovers.
+    """
+
+    def __init__(self, name, host, port):
+        self.name = name
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name=name,
+            pool_size=config["database"]["pool_size"],
+            **{**DB_CONFIG, "host": host, "port": port},
+        )
+        self.circuit_breaker = AsyncCircuitBreaker(
+            monitored_exceptions=(mysql.connector.Error,)
+        )
+        self.execute = self.circuit_breaker(execute_on_pool)
+
+
 connection_pool = None
+replicas = []
+
+# Set for requests of users who wrote recently, so they read their own writes
+# even if replicas lag behind the primary.
+prefer_primary = contextvars.ContextVar("prefer_primary", default=False)
 
 
 def init_connection_pool():
@@ -43,13 +122,54 @@ def init_connection_pool():
             pool_size=config["database"]["pool_size"],
             **DB_CONFIG,
         )
+    if replicas == []:
+        replica_hosts = parse_replica_hosts(
+            config["database"]["replica_hosts"]
+        )
+        for i, (host, port) in enumerate(replica_hosts):
+            LOGGER.info(f"Creating database connection pool to {host}")
+            replicas.append(Replica(f"pastebin-replica-{i}", host, port))
 
 
 def close_connection_pool():
-    if connection_pool is not None:
-        LOGGER.info("Closing database connection pool")
-        n_closed = connection_pool._remove_connections()
-        LOGGER.info(f"Closed {n_closed} database connections")
+    for pool in [connection_pool] + [replica.pool for replica in replicas]:
+        if pool is not None:
+            LOGGER.info(f"Closing database connection pool {pool.pool_name}")
+            n_closed = pool._remove_connections()
+            LOGGER.info(f"Closed {n_closed} database connections")
+
+
+def collect_gauges():
+    if thread_pool is not None:
+        yield (
+            "pastebin_db_thread_pool_queue_depth",
+            (),
+            thread_pool._work_queue.qsize(),
+        )
+    pools = [connection_pool] + [replica.pool for replica in replicas]
+    for pool in pools:
+        if pool is not None:
+            yield (
+                "pastebin_db_pool_connections_in_use",
+                (("pool", pool.pool_name),),
+                pool.pool_size - pool._cnx_queue.qsize(),
+            )
+    for replica in replicas:
+        yield (
+            "pastebin_circuit_breaker_state",
+            (("breaker", replica.name),),
+            replica.circuit_breaker.state.value,
+        )
+
+
+metrics.register_gauges(collect_gauges)
+
+
+def read_own_writes(last_write):
+    # 'last_write' is when the user last wrote, in seconds since the epoch.
+    prefer_primary.set(
+        last_write is not None and time.time() - last_write < REPLICA_LAG
+    )
 
 
 thread_pool = None
@@ -69,8 +189,8 @@ def close_thread_pool():
 
 
 @contextmanager
-def connect(db_config=DB_CONFIG, dictionary=False):
-    con = connection_pool.get_connection()
+def connect(db_config=DB_CONFIG, dictionary=False, pool=None):
+    con = (pool or connection_pool).get_connection()
     cur = con.cursor(dictionary=dictionary)
     try:
         yield cur
@@ -86,19 +206,73 @@ def connect(db_config=DB_CONFIG, dictionary=False):
             con.close()
 
 
-async def execute_in_thread_pool(query, args=None, fetchone=False):
-    with connect(dictionary=True) as cur:
-        await asyncio.get_running_loop().run_in_executor(
+def run_query(pool, query, args, fetchone, rowcount):
+    # Runs in a thread, from getting a connection to fetching results, so a
+    # request that gives up does not release a connection still in use.
+    try:
+        with connect(dictionary=True, pool=pool) as cur:
+            cur.execute(query, args)
+            if rowcount:
+                return cur.rowcount
+            if fetchone:
+                return cur.fetchone()
+            return cur.fetchall()
+    except mysql.connector.Error as err:
+        if err.errno == STATEMENT_TIMEOUT_ERRNO:
+            raise deadline.DeadlineExceeded(str(err)) from err
+        raise
+
+
+async def execute_on_pool(pool, query, args, fetchone, rowcount):
+    # Queries still waiting for a thread are cancelled at the deadline.
+    async with deadline.limit():
+        return await asyncio.get_running_loop().run_in_executor(
             thread_pool,
-            partial(
-                cur.execute,
-                query,
-                args,
-            ),
+            partial(run_query, pool, query, args, fetchone, rowcount),
+        )
+
+
+async def execute_in_thread_pool(
+    query, args=None, fetchone=False, rowcount=False, read_only=False
+):
+    """
+    Execute a query on the primary database. Queries that do not write and
+    tolerate replication lag can set 'read_only' to run on a replica, with a
+    fallback to other replicas and then to the primary.
+
+    Read-only queries are also aborted by the database server when the
+    request deadline is reached.
+    """
+    remaining = deadline.remaining()
+    if read_only and remaining is not None:
+        # MariaDB does not limit statements with a time of 0.
+        remaining = max(remaining, MIN_STATEMENT_TIME)
+        query = (
+            f"SET STATEMENT max_statement_time={remaining:.3f} FOR {query}"
+        )
+    if read_only and not prefer_primary.get():
+        for replica in random.sample(replicas, len(replicas)):
+            try:
+                return await replica.execute(
+                    replica.pool, query, args, fetchone, rowcount
+                )
+            except (CircuitBreakerBypass, CircuitBreakerException) as err:
+                LOGGER.warning(f"Skipping replica {replica.name}: {err}")
+    return await execute_on_pool(
+        connection_pool, query, args, fetchone, rowcount
+    )
+
+
+def run_many(query, seq_args):
+    with connect() as cur:
+        cur.executemany(query, seq_args)
+
+
+async def execute_many_in_thread_pool(query, seq_args):
+    async with deadline.limit():
+        await asyncio.get_running_loop().run_in_executor(
+            thread_pool, partial(run_many, query, seq_args)
         )
-        if fetchone:
-            return cur.fetchone()
-        return cur.fetchall()
 
 
 async def setup_database_objects(root_password):
@@ -139,15 +313,57 @@ async def setup_database_objects(root_password):
                 pass
             cur.execute(sql_queries.CREATE_TABLE_USER_CONNECTIONS)
             cur.execute(sql_queries.CREATE_INDEX_USER_CONNECT_TS)
-            cur.execute(sql_queries.CREATE_TABLE_TEXTS)
-            cur.execute(sql_queries.CREATE_INDEX_TEXTS_USERID)
+            cur.execute(
+                sql_queries.CREATE_TABLE_TEXTS.format(
+                    text_id_type=TEXT_ID_TYPES[
+                        config["database"]["text_id_storage"]
+                    ],
+                )
+            )
+            cur.execute(sql_queries.CREATE_TABLE_TEXT_OBJECTS)
+            cur.execute(sql_queries.ADD_TEXT_OBJECTS_STATE)
+            cur.execute(sql_queries.CREATE_INDEX_TEXTS_USERID_CREATION)
+            cur.execute(sql_queries.DROP_INDEX_TEXTS_USERID)
             cur.execute(sql_queries.CREATE_INDEX_TEXTS_USERIP)
             cur.execute(sql_queries.CREATE_INDEX_TEXTS_CREATION)
+            cur.execute(sql_queries.CREATE_INDEX_TEXTS_PENDING_EXPIRATION)
+            cur.execute(sql_queries.CREATE_INDEX_TEXTS_PENDING_DELETION)
         con.commit()
 
 
+def migrate_text_ids_to_binary():
+    """
+    Convert the column 'texts.text_id' from strings to 16 bytes. The
+    application should be stopped during the migration, and restarted with
+    'text_id_storage' set to 'binary'.
+    """
+    with mysql.connector.connect(**DB_CONFIG) as con:
+        with con.cursor() as cur:
+            cur.execute(sql_queries.MIGRATE_TEXT_IDS_ADD_COLUMN)
+            while True:
+                cur.execute(
+                    sql_queries.MIGRATE_TEXT_IDS_FILL_COLUMN,
+                    (MIGRATION_BATCH_SIZE,),
+                )
+                converted = cur.rowcount
+                con.commit()
+                LOGGER.info(f"Converted {converted} text IDs")
+                if converted == 0:
+                    break
+            cur.execute(sql_queries.MIGRATE_TEXT_IDS_COUNT_INVALID)
+            (invalid,) = cur.fetchone()
+            if invalid > 0:
+                raise ValueError(
+                    f"{invalid} text IDs are not UUIDs and cannot be converted"
+                )
+            cur.execute(sql_queries.MIGRATE_TEXT_IDS_SWAP_COLUMNS)
+        con.commit()
+
+
+@metrics.timed
 async def put_text_metadata(
     text_id,
+    object_key,
     text_title,
     user_id,
     user_ip,
@@ -156,40 +372,244 @@ async def put_text_metadata(
     burn_after_reading,
     visibility,
 ):
-    await execute_in_thread_pool(
-        sql_queries.INSERT_TEXT,
-        (
-            text_id,
-            text_title,
-            f"{config['text_storage']['s3_bucket']}/{text_id}",
-            user_id,
-            user_ip,
-            creation_timestamp,
-            expiration_timestamp,
-            burn_after_reading,
-            visibility,
-        ),
-    )
+    # Not bounded by the deadline: the insert commits even if the request
+    # stops waiting for it, and the caller must know if the text exists.
+    with deadline.suspended():
+        await execute_in_thread_pool(
+            sql_queries.INSERT_TEXT,
+            (
+                encode_text_id(text_id),
+                text_title,
+                f"{config['text_storage']['s3_bucket']}/{object_key}",
+                user_id,
+                user_ip,
+                creation_timestamp,
+                expiration_timestamp,
+                burn_after_reading,
+                visibility,
+            ),
+        )
 
 
+@metrics.timed
 async def mark_text_for_deletion(text_id):
     await execute_in_thread_pool(
-        sql_queries.MARK_TEXT_FOR_DELETION, (text_id,)
+        sql_queries.MARK_TEXT_FOR_DELETION, (encode_text_id(text_id),)
+    )
+
+
+@metrics.timed
+async def claim_text_for_burning(text_id):
+    # Returns True for exactly one caller, even with concurrent readers.
+    return (
+        await execute_in_thread_pool(
+            sql_queries.CLAIM_TEXT_FOR_BURNING,
+            (encode_text_id(text_id),),
+            rowcount=True,
+        )
+        == 1
+    )
+
+
+def run_add_text_object_reference(object_key):
+    with connect(dictionary=True) as cur:
+        cur.execute(sql_queries.CREATE_TEXT_OBJECT, (object_key,))
+        cur.execute(sql_queries.LOCK_TEXT_OBJECT, (object_key,))
+        row = cur.fetchone()
+        if row["deletion_start"] is None:
+            cur.execute(sql_queries.ADD_TEXT_OBJECT_REFERENCE, (object_key,))
+            return bool(row["stored"])
+        if datetime.now() - row["deletion_start"] < OBJECT_DELETION_TIMEOUT:
+            # Wait for the deletion to finish, or it could delete the object
+            # after it is uploaded again.
+            return
+        cur.execute(sql_queries.RESTART_TEXT_OBJECT, (object_key,))
+        return False
+
+
+async def run_in_thread_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        thread_pool, partial(func, *args)
     )
 
 
-async def mark_text_deleted(text_id, deletion_timestamp):
+@metrics.timed
+async def add_text_object_reference(object_key):
+    """
+    Count one more text stored in the object 'object_key'. Return True if the
+    object is stored, otherwise the caller must upload it then call
+    'mark_text_object_stored'. Uploads are idempotent, so texts with the same
+    body upload it while the first upload is running, rather than depend on
+    its success.
+
+    The deadline is only checked between attempts: a transaction cancelled
+    while it runs would still commit, and leak the reference.
+    """
+    while True:
+        deadline.remaining()
+        stored = await run_in_thread_pool(
+            run_add_text_object_reference, object_key
+        )
+        if stored is not None:
+            return stored
+        await asyncio.sleep(OBJECT_DELETION_POLL)
+
+
+@metrics.timed
+async def mark_text_object_stored(object_key):
     await execute_in_thread_pool(
-        sql_queries.MARK_TEXT_DELETED, (deletion_timestamp, text_id)
+        sql_queries.MARK_TEXT_OBJECT_STORED, (object_key,)
     )
 
 
-async def get_texts_by_owner(user_id):
-    return await execute_in_thread_pool(
-        sql_queries.GET_TEXTS_BY_OWNER, (user_id,)
+def run_release_text_object(object_key, text_id, deletion_timestamp):
+    with connect(dictionary=True) as cur:
+        cur.execute(sql_queries.LOCK_TEXT_OBJECT, (object_key,))
+        row = cur.fetchone()
+        if text_id is not None:
+            cur.execute(
+                sql_queries.MARK_TEXT_DELETED,
+                (deletion_timestamp, encode_text_id(text_id)),
+            )
+            if cur.rowcount == 0:
+                # Released by a previous run.
+                return False
+        if row is not None and row["ref_count"] > 1:
+            cur.execute(
+                sql_queries.REMOVE_TEXT_OBJECT_REFERENCE, (object_key,)
+            )
+            return False
+        # Texts stored before deduplication have no row and own their object.
+        if row is not None:
+            cur.execute(
+                sql_queries.START_TEXT_OBJECT_DELETION,
+                (datetime.now(), object_key),
+            )
+        return True
+
+
+def run_release_unreferenced_text_object(object_key):
+    with connect(dictionary=True) as cur:
+        cur.execute(sql_queries.LOCK_TEXT_OBJECT, (object_key,))
+        row = cur.fetchone()
+        # Referenced again since it was listed.
+        if (
+            row is None
+            or row["ref_count"] > 0
+            or row["deletion_start"] is not None
+        ):
+            return False
+        cur.execute(
+            sql_queries.START_TEXT_OBJECT_DELETION,
+            (datetime.now(), object_key),
+        )
+        return True
+
+
+def run_cancel_text_object_deletion(object_key, text_id, release_reference):
+    with connect() as cur:
+        cur.execute(sql_queries.CANCEL_TEXT_OBJECT_DELETION, (object_key,))
+        if release_reference:
+            cur.execute(
+                sql_queries.REMOVE_TEXT_OBJECT_REFERENCE, (object_key,)
+            )
+        if text_id is not None:
+            cur.execute(
+                sql_queries.UNMARK_TEXT_DELETED, (encode_text_id(text_id),)
+            )
+
+
+async def finish_text_object_deletion(
+    object_key, delete_object, text_id, release_reference
+):
+    # Texts with the same body wait until the object row is deleted.
+    try:
+        await delete_object()
+    except BaseException:
+        await run_in_thread_pool(
+            run_cancel_text_object_deletion,
+            object_key,
+            text_id,
+            release_reference,
+        )
+        raise
+    with deadline.suspended():
+        await execute_in_thread_pool(
+            sql_queries.DELETE_TEXT_OBJECT, (object_key,)
+        )
+
+
+@metrics.timed
+async def release_text_object(
+    object_key, delete_object, text_id=None, deletion_timestamp=None
+):
+    """
+    Remove a reference to the object 'object_key', and mark the text
+    'text_id' as deleted if given. Texts already marked as deleted are
+    ignored, so cleanup can be retried. When no other text references the
+    object, 'delete_object' is awaited to delete it from object storage,
+    after the transaction, and it should ignore missing objects. Return True
+    if the object was deleted.
+
+    If the deletion fails, the text is left to the next cleanup. Without a
+    text, the reference is dropped and cleanup deletes the object with
+    'delete_unreferenced_text_objects'.
+    """
+    if not await run_in_thread_pool(
+        run_release_text_object, object_key, text_id, deletion_timestamp
+    ):
+        return False
+    await finish_text_object_deletion(
+        object_key, delete_object, text_id, release_reference=text_id is None
+    )
+    return True
+
+
+async def delete_unreferenced_text_objects(
+    delete_object, batch_size=DELETION_BATCH_SIZE
+):
+    """
+    Delete objects left without references by failed deletions, by awaiting
+    'delete_object(object_key)'. Return the keys of deleted objects.
+    """
+    rows = await execute_in_thread_pool(
+        sql_queries.GET_UNREFERENCED_TEXT_OBJECTS, (batch_size,)
+    )
+    deleted = []
+    for row in rows:
+        object_key = row["object_key"]
+        if not await run_in_thread_pool(
+            run_release_unreferenced_text_object, object_key
+        ):
+            continue
+        await finish_text_object_deletion(
+            object_key,
+            partial(delete_object, object_key),
+            text_id=None,
+            release_reference=False,
+        )
+        deleted.append(object_key)
+    return deleted
+
+
+@metrics.timed
+async def get_texts_by_owner(user_id, after, limit):
+    # 'after' is the tuple (creation, text_id) of the last text of the
+    # previous page, or None for the first page.
+    if after is None:
+        last_creation, last_text_id = MIN_TIMESTAMP, MIN_TEXT_ID
+    else:
+        last_creation, last_text_id = after[0], encode_text_id(after[1])
+    return decode_text_ids(
+        await execute_in_thread_pool(
+            sql_queries.GET_TEXTS_BY_OWNER,
+            (user_id, last_creation, last_creation, last_text_id, limit),
+            read_only=True,
+        )
     )
 
 
+@metrics.timed
 async def create_user(user_id, firstname, lastname, password):
     try:
         now = datetime.now()
@@ -202,48 +622,118 @@ async def create_user(user_id, firstname, lastname, password):
     return return_codes.OK
 
 
+@metrics.timed
 async def get_user(user_id):
     return await execute_in_thread_pool(
-        sql_queries.GET_USER, (user_id,), fetchone=True
+        sql_queries.GET_USER, (user_id,), fetchone=True, read_only=True
     )
 
 
+@metrics.timed
 async def count_recent_texts_by_anonymous_user(user_ip):
     return (
         (
             await execute_in_thread_pool(
-                sql_queries.COUNT_TEXTS_ANONYMOUS, (user_ip,), fetchone=True
+                sql_queries.COUNT_TEXTS_ANONYMOUS,
+                (user_ip,),
+                fetchone=True,
+                read_only=True,
             )
         )
     )["quota"]
 
 
+@metrics.timed
 async def count_recent_texts_by_logged_user(user_id):
     return (
         (
             await execute_in_thread_pool(
-                sql_queries.COUNT_TEXTS_USER, (user_id,), fetchone=True
+                sql_queries.COUNT_TEXTS_USER,
+                (user_id,),
+                fetchone=True,
+                read_only=True,
             )
         )
     )["quota"]
 
 
-async def get_texts_for_deletion():
-    return await execute_in_thread_pool(sql_queries.GET_TEXTS_FOR_DELETION)
+async def iter_texts_for_deletion(batch_size=DELETION_BATCH_SIZE):
+    """
+    Yield batches of texts that are expired or marked for deletion, and are
+    not deleted yet.
 
+    Each scan resumes after the last row of the previous batch, so texts
+    that fail to be cleaned up are not returned again in the same run.
+    """
+    last_expiration, last_text_id = MIN_TIMESTAMP, MIN_TEXT_ID
+    while True:
+        rows = await execute_in_thread_pool(
+            sql_queries.GET_EXPIRED_TEXTS_FOR_DELETION,
+            (last_expiration, last_expiration, last_text_id, batch_size),
+        )
+        if len(rows) == 0:
+            break
+        last_expiration, last_text_id = (
+            rows[-1]["expiration"],
+            rows[-1]["text_id"],
+        )
+        yield decode_text_ids(rows)
 
+    last_text_id = MIN_TEXT_ID
+    while True:
+        rows = await execute_in_thread_pool(
+            sql_queries.GET_MARKED_TEXTS_FOR_DELETION,
+            (last_text_id, batch_size),
+        )
+        if len(rows) == 0:
+            break
+        last_text_id = rows[-1]["text_id"]
+        yield decode_text_ids(rows)
+
+
+def iter_live_text_ids_sync(batch_size=TEXT_IDS_BATCH_SIZE):
+    """
+    Yield batches of text IDs as strings. Blocking, and it does not use the
+    connection pool, so it can run in another process. Texts are read from
+    the primary, because replicas may lag behind by more than the time the
+    caller allows for texts created while it runs.
+    """
+    con = mysql.connector.connect(**DB_CONFIG)
+    # Each batch reads the latest texts, not a snapshot kept by the scan.
+    con.autocommit = True
+    try:
+        last_text_id = MIN_TEXT_ID
+        while True:
+            cur = con.cursor()
+            cur.execute(
+                sql_queries.GET_LIVE_TEXT_IDS, (last_text_id, batch_size)
+            )
+            rows = cur.fetchall()
+            cur.close()
+            if len(rows) == 0:
+                break
+            last_text_id = rows[-1][0]
+            yield [decode_text_id(row[0]) for row in rows]
+    finally:
+        con.close()
+
+
+@metrics.timed
 async def get_text_owner(text_id):
     # No guardrail for non-existant text ID, do not use with user input.
     return (
         await execute_in_thread_pool(
-            sql_queries.GET_TEXT_OWNER, (text_id,), fetchone=True
+            sql_queries.GET_TEXT_OWNER,
+            (encode_text_id(text_id),),
+            fetchone=True,
         )
     )["user_id"]
 
 
+@metrics.timed
 async def user_is_locked(user_id):
     recent_connects = await execute_in_thread_pool(
-        sql_queries.GET_RECENT_USER_CONNECTIONS, (user_id,)
+        sql_queries.GET_RECENT_USER_CONNECTIONS, (user_id,), read_only=True
     )
 
     fails = 0
@@ -259,10 +749,17 @@ async def user_is_locked(user_id):
     return False
 
 
-async def record_user_connect(user_id, user_ip, success):
-    await execute_in_thread_pool(
-        sql_queries.RECORD_USER_CONNECT, (user_id, user_ip, success)
-    )
+@metrics.timed
+async def record_user_connects(events):
+    # Events are tuples (user_id, user_ip, timestamp, success), they are
+    # written with a single multi-row INSERT.
+    await execute_many_in_thread_pool(sql_queries.RECORD_USER_CONNECT, events)
+
+
+def record_user_connects_sync(events):
+    # For use outside the asyncio loop, e.g. when a worker exits.
+    with connect() as cur:
+        cur.executemany(sql_queries.RECORD_USER_CONNECT, events)
 
 
 def text_is_visible(metadata):
@@ -273,10 +770,31 @@ def is_text_burn_after_reading(metadata):
     return metadata["burn_after_reading"]
 
 
+@metrics.timed
 async def get_text_metadata(text_id):
-    return await execute_in_thread_pool(
-        sql_queries.GET_TEXT_METADATA, (text_id,), fetchone=True
+    try:
+        encoded_text_id = encode_text_id(text_id)
+    except ValueError:
+        return
+    metadata = await execute_in_thread_pool(
+        sql_queries.GET_TEXT_METADATA,
+        (encoded_text_id,),
+        fetchone=True,
+        read_only=True,
     )
+    if metadata is None and replicas != []:
+        # The text may be too recent to be on the replica yet.
+        metadata = await execute_in_thread_pool(
+            sql_queries.GET_TEXT_METADATA, (encoded_text_id,), fetchone=True
+        )
+    if metadata is not None:
+        metadata["text_id"] = decode_text_id(metadata["text_id"])
+    return metadata
+
+
+def text_object_key(text_metadata):
+    # Texts stored before deduplication use their text ID as object key.
+    return text_metadata["text_path"].partition("/")[2]
 
 
 def text_is_private(text_metadata):
@@ -0,0 +1,97 @@
+"""
+Per-request deadlines.
+
+A deadline is set when a request starts, from the timeout of its route, and
+kept in a context variable. Calls to the database, the cache and the object
+store only get the time left before the deadline, so once the client has
+given up, work stops and connections and threads are freed for requests that
+can still succeed.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+
+from .config import config
+
+DEFAULT_TIMEOUT = config["deadline"]["default"]  # seconds
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_route_timeouts(value):
+    # 'endpoint=seconds,...', e.g. 'get_text=5,auth.login=10'.
+    timeouts = {}
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        endpoint, _, timeout = item.partition("=")
+        timeouts[endpoint.strip()] = float(timeout)
+    return timeouts
+
+
+ROUTE_TIMEOUTS = parse_route_timeouts(config["deadline"]["routes"])
+
+# Deadline of the current request in event loop time, None if unbounded.
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def start(endpoint):
+    timeout = ROUTE_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    if timeout > 0:
+        deadline.set(asyncio.get_running_loop().time() + timeout)
+    else:
+        deadline.set(None)
+
+
+def remaining():
+    """
+    Return the seconds left before the deadline, or None if there is no
+    deadline. Raise DeadlineExceeded if it has passed.
+    """
+    when = deadline.get()
+    if when is None:
+        return
+    left = when - asyncio.get_running_loop().time()
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left
+
+
+@contextlib.asynccontextmanager
+async def limit():
+    when = deadline.get()
+    remaining()
+    timeout = asyncio.timeout_at(when)
+    try:
+        async with timeout:
+            yield
+    except TimeoutError as err:
+        if timeout.expired():
+            raise DeadlineExceeded("Request deadline exceeded") from err
+        raise
+
+
+@contextlib.contextmanager
+def suspended():
+    """
+    Run without a deadline, for work that must finish once started, e.g.
+    undoing a partial write after the deadline is reached.
+    """
+    token = deadline.set(None)
+    try:
+        yield
+    finally:
+        deadline.reset(token)
+
+
+def bounded(func):
+    # Stop an async function when the request deadline is reached.
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with limit():
+            return await func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,150 @@
+"""
+Optional cache of texts on local disk, between the cache and the object store.
+
+Texts are stored compressed, one file per text in a directory named after the
+hash of the key, and read through 'mmap' so the compressed data is
+decompressed without being copied into a Python buffer first. The directory
+is shared by all workers of the host: files are written to a temporary file
+then renamed, and one worker at a time evicts the least recently read files
+when the cache exceeds its size, which is coordinated with a file lock.
+"""
+import asyncio
+import fcntl
+import hashlib
+import mmap
+import os
+import tempfile
+import zlib
+
+from . import metrics
+from .cache import manage_errors
+from .config import config
+from .log import get_logger
+
+LOGGER = get_logger()
+CACHE_DIR = config["disk_cache"]["dir"]
+MAX_SIZE = config["disk_cache"]["max_size"] * 1024 * 1024  # bytes
+EVICTION_TARGET = 0.9  # share of 'MAX_SIZE' left after eviction
+EVICTION_CHECK_WRITES = 100
+TEXT_ENCODING = config["text_storage"]["encoding"]
+LOCK_FILE = ".lock"
+TEMP_PREFIX = ".tmp-"
+
+writes_since_eviction = 0
+
+
+def key_path(key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, digest[:2], digest)
+
+
+def read_file(path):
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = zlib.decompress(mm)
+    except FileNotFoundError:
+        return
+    # The modification time records the last read, for eviction.
+    os.utime(path)
+    return data.decode(TEXT_ENCODING)
+
+
+def write_file(path, value):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(value.encode(TEXT_ENCODING)))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def delete_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict():
+    """
+    Delete the least recently read files until the cache is below
+    'EVICTION_TARGET' of its size. Return the number of deleted files.
+    """
+    with open(os.path.join(CACHE_DIR, LOCK_FILE), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is evicting.
+            return 0
+        entries = []
+        total_size = 0
+        for directory in os.scandir(CACHE_DIR):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.startswith(TEMP_PREFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        if total_size <= MAX_SIZE:
+            return 0
+
+        entries.sort()
+        deleted = 0
+        for _, size, path in entries:
+            if total_size <= MAX_SIZE * EVICTION_TARGET:
+                break
+            delete_file(path)
+            total_size -= size
+            deleted += 1
+        LOGGER.info(f"Evicted {deleted} texts from the disk cache")
+        return deleted
+
+
+def is_enabled():
+    return CACHE_DIR != ""
+
+
+async def run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+@manage_errors
+@metrics.timed
+async def get(key):
+    if not is_enabled():
+        return
+    value = await run_in_thread(read_file, key_path(key))
+    metrics.record_cache_lookup(value is not None, tier="disk")
+    return value
+
+
+@manage_errors
+@metrics.timed
+async def put(key, value):
+    global writes_since_eviction
+    if not is_enabled():
+        return
+    await run_in_thread(write_file, key_path(key), value)
+    writes_since_eviction += 1
+    if writes_since_eviction >= EVICTION_CHECK_WRITES:
+        writes_since_eviction = 0
+        await run_in_thread(evict)
+
+
+@manage_errors
+@metrics.timed
+async def delete(key):
+    if is_enabled():
+        await run_in_thread(delete_file, key_path(key))
@@ -0,0 +1,303 @@
+"""
+Load test of the pastebin application. Requests are sent to the ASGI
+application in-process, which uses the database, cache and object store
+configured in the environment ('run_benchmark' starts local stand-ins in
+docker). Results are printed as JSON, for example:
+
+    python -m src.loadtest --requests 10000 --concurrency 64 \\
+        --mix create=10,read_hot=60,read_cold=20,delete=5,login=5
+
+Operations:
+* create: store a text as an anonymous user
+* read_hot: read one of a few texts, which are in the cache
+* read_cold: read a text for the first time, so it is not in the cache
+* delete: delete a text as its owner
+* login: log in with a correct password
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from urllib.parse import parse_qs, urlparse
+
+from werkzeug.security import generate_password_hash
+
+from . import auth
+from . import cache_backend
+from . import create_app
+from . import database
+from . import metrics
+
+DEFAULT_MIX = "create=10,read_hot=60,read_cold=20,delete=5,login=5"
+OPERATIONS = ("create", "read_hot", "read_cold", "delete", "login")
+USER_ID = "loadtest"
+PASSWORD = "Load-test-pw1"
+HOT_TEXTS = 20
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+class Overloaded(Exception):
+    pass
+
+
+async def send(client, method, path, **kwargs):
+    # Requests shed by the concurrency limit are reported apart from errors.
+    response = await getattr(client, method)(path, **kwargs)
+    if response.status_code == 503:
+        raise Overloaded
+    return response
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"Unknown operation '{operation}', choose from {OPERATIONS}"
+            )
+        mix[operation] = float(weight)
+    return mix
+
+
+def percentile(sorted_values, q):
+    if sorted_values == []:
+        return
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def random_ip():
+    # Spread anonymous texts and logins over many addresses, so quotas and
+    # login lockouts do not kick in.
+    return ".".join(str(random.randint(1, 254)) for _ in range(4))
+
+
+def dependency_calls():
+    return {
+        f"{dict(labels)['component']}.{dict(labels)['operation']}": sum(
+            histogram[:-1]
+        )
+        for (name, labels), histogram in metrics.histograms.items()
+        if name == metrics.DEPENDENCY_LATENCY
+    }
+
+
+class LoadTest:
+    def __init__(self, app, mix, requests, text_size):
+        self.app = app
+        self.mix = mix
+        self.requests = requests
+        self.text_size = text_size
+        self.anonymous = app.test_client()
+        self.user = app.test_client()
+        self.hot_texts = []
+        self.cold_texts = []
+        self.user_texts = []
+        self.latencies = {operation: [] for operation in mix}
+        self.errors = {operation: 0 for operation in mix}
+        self.shed = {operation: 0 for operation in mix}
+
+    def text_body(self):
+        n_words = self.text_size // 6
+        return " ".join(random.choices(WORDS, k=n_words))
+
+    def expected_count(self, operation):
+        total = sum(self.mix.values())
+        return math.ceil(self.requests * self.mix.get(operation, 0) / total)
+
+    async def store_text(self, client):
+        response = await send(
+            client,
+            "post",
+            "/",
+            form={
+                "text-body": self.text_body(),
+                "ttl": "1d",
+                "visibility": "public",
+            },
+            headers={"X-Forwarded-For": random_ip()},
+        )
+        location = urlparse(response.headers.get("Location", ""))
+        return parse_qs(location.query).get("confirmation", [None])[0]
+
+    async def log_in(self, client):
+        response = await send(
+            client,
+            "post",
+            "/auth/login",
+            form={"user_id": USER_ID, "password": PASSWORD},
+            headers={"X-Forwarded-For": random_ip()},
+        )
+        return urlparse(response.headers.get("Location", "")).path == "/"
+
+    async def prepare(self):
+        await database.create_user(
+            USER_ID,
+            "Load",
+            "Test",
+            generate_password_hash(PASSWORD, method=auth.HASH_METHOD),
+        )
+        if not await self.log_in(self.user):
+            raise RuntimeError(f"Could not log in as '{USER_ID}'")
+        for _ in range(HOT_TEXTS):
+            text_id = await self.store_text(self.anonymous)
+            await self.anonymous.get(f"/text/{text_id}")
+            self.hot_texts.append(text_id)
+        for _ in range(self.expected_count("read_cold")):
+            self.cold_texts.append(await self.store_text(self.anonymous))
+        for _ in range(self.expected_count("delete")):
+            self.user_texts.append(await self.store_text(self.user))
+
+    async def create(self):
+        return await self.store_text(self.anonymous) is not None
+
+    async def read_hot(self):
+        text_id = random.choice(self.hot_texts)
+        response = await send(self.anonymous, "get", f"/text/{text_id}")
+        return response.status_code == 200
+
+    async def read_cold(self):
+        if self.cold_texts == []:
+            return await self.read_hot()
+        text_id = self.cold_texts.pop()
+        response = await send(self.anonymous, "get", f"/text/{text_id}")
+        return response.status_code == 200
+
+    async def delete(self):
+        if self.user_texts == []:
+            return False
+        response = await send(
+            self.user,
+            "post",
+            "/delete-text",
+            form={"text-id": self.user_texts.pop()},
+        )
+        return response.status_code == 200
+
+    async def login(self):
+        return await self.log_in(self.app.test_client())
+
+    async def worker(self, operations):
+        while operations != []:
+            operation = operations.pop()
+            start = time.perf_counter()
+            try:
+                ok = await getattr(self, operation)()
+            except Overloaded:
+                self.shed[operation] += 1
+                continue
+            except Exception:
+                ok = False
+            self.latencies[operation].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[operation] += 1
+
+    async def run(self, concurrency):
+        operations = random.choices(
+            list(self.mix), weights=list(self.mix.values()), k=self.requests
+        )
+        calls_before = dependency_calls()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(self.worker(operations) for _ in range(concurrency))
+        )
+        elapsed = time.perf_counter() - start
+        calls_after = dependency_calls()
+        return self.report(elapsed, calls_before, calls_after)
+
+    def report(self, elapsed, calls_before, calls_after):
+        def summary(latencies, errors, shed):
+            latencies = sorted(latencies)
+            return {
+                "requests": len(latencies),
+                "errors": errors,
+                "shed": shed,
+                "throughput": round(len(latencies) / elapsed, 1),
+                **{
+                    f"p{round(q * 100)}_ms": round(
+                        percentile(latencies, q) * 1000, 2
+                    )
+                    for q in (0.5, 0.95, 0.99)
+                    if latencies != []
+                },
+            }
+
+        all_latencies = [
+            latency
+            for latencies in self.latencies.values()
+            for latency in latencies
+        ]
+        return {
+            "seconds": round(elapsed, 3),
+            "total": summary(
+                all_latencies,
+                sum(self.errors.values()),
+                sum(self.shed.values()),
+            ),
+            "operations": {
+                operation: summary(
+                    latencies, self.errors[operation], self.shed[operation]
+                )
+                for operation, latencies in self.latencies.items()
+            },
+            "dependency_calls": {
+                key: count - calls_before.get(key, 0)
+                for key, count in sorted(calls_after.items())
+                if count > calls_before.get(key, 0)
+            },
+        }
+
+
+async def run_load_test(mix, requests, concurrency, text_size):
+    app = create_app()
+    cache_backend.init_connection_pool()
+    database.init_thread_pool()
+    database.init_connection_pool()
+    try:
+        load_test = LoadTest(app, mix, requests, text_size)
+        await load_test.prepare()
+        return await load_test.run(concurrency)
+    finally:
+        await cache_backend.close_connection_pool()
+        database.close_thread_pool()
+        database.close_connection_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--text-size", type=int, default=2000)
+    parser.add_argument("--output", help="write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_load_test(
+            args.mix, args.requests, args.concurrency, args.text_size
+        )
+    )
+    results["parameters"] = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "mix": args.mix,
+        "text_size": args.text_size,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
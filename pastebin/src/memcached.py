@@ -1,41 +1,303 @@
+"""
+Cache backend on memcached, with the same functions as the Redis backend in
+'cache'. Keys are sharded across nodes on the same hash ring, and each node
+has its own connection pool and circuit breaker.
+"""
+import asyncio
 import functools
+import hashlib
+import re
+from operator import itemgetter
 
-from pymemcache.client.base import Client
+import aiomcache
 
+from . import deadline
+from . import metrics
+from .cache import (
+    EXPIRATION_DEFAULT,
+    KEY_PREFIX,
+    HashRing,
+    call_shards,
+    group_by_shard,
+    login_failures_keys,
+    manage_errors,
+    parse_cache_hosts,
+)
+from .circuit_breaker import AsyncCircuitBreaker
 from .config import config
 from .log import get_logger
 
-CACHE_CLIENT = Client(
-    config["cache"]["host"],
-    encoding=config["cache"]["encoding"],
-)
-
 LOGGER = get_logger()
+ENCODING = config["cache"]["encoding"]
+MAX_KEY_LENGTH = 250
+VALID_KEY_REGEX = re.compile(r"[!-~]+")  # printable ASCII, no spaces
+
+
+class Shard:
+    """
+    Connection pool to a memcached node, with its own circuit breaker.
+    """
+
+    def __init__(self, host, port):
+        self.name = f"{host}:{port}"
+        # Connections are opened when needed, not all when the pool starts.
+        self.client = aiomcache.Client(
+            host,
+            port,
+            pool_size=int(config["cache"]["pool_size"]),
+            pool_minsize=1,
+        )
+        self.circuit_breaker = AsyncCircuitBreaker(
+            monitored_exceptions=(OSError, EOFError, aiomcache.ClientException)
+        )
+        self.guarded = {}
+
+    async def call(self, func, *args, **kwargs):
+        guarded = self.guarded.get(func)
+        if guarded is None:
+            guarded = self.guarded[func] = self.circuit_breaker(func)
+        return await guarded(self, *args, **kwargs)
+
+
+shards = []
+ring = None
+
+
+def collect_gauges():
+    for shard in shards:
+        yield (
+            "pastebin_circuit_breaker_state",
+            (("breaker", "memcached"), ("shard", shard.name)),
+            shard.circuit_breaker.state.value,
+        )
+
+
+metrics.register_gauges(collect_gauges)
 
 
-def manage_exceptions(func):
+def init_connection_pool():
+    global ring
+    if shards == []:
+        cache_hosts = parse_cache_hosts(config["cache"]["hosts"]) or [
+            (config["cache"]["host"], int(config["cache"]["port"]))
+        ]
+        for host, port in cache_hosts:
+            LOGGER.info(f"Creating memcached connection pool to {host}:{port}")
+            shards.append(Shard(host, port))
+        ring = HashRing(shards)
+
+
+async def close_connection_pool():
+    for shard in shards:
+        LOGGER.info(f"Closing memcached connection pool to {shard.name}")
+        await shard.client.close()
+
+
+def memcached_key(key):
+    # Memcached keys are at most 250 bytes without spaces or control
+    # characters, other keys are replaced by their hash.
+    key = f"{KEY_PREFIX}{key}"
+    if len(key) <= MAX_KEY_LENGTH and VALID_KEY_REGEX.fullmatch(key):
+        return key
+    return f"{KEY_PREFIX}{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def sharded(func):
+    """
+    Route a call to the shard that owns the key, the first argument. 'func'
+    is called through the circuit breaker of the shard, with the shard and
+    the memcached key, as bytes, as first arguments.
+    """
+
     @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            LOGGER.error(f"{e.__class__.__name__} when calling '{func}': {e}")
+    async def wrapper(key, *args, **kwargs):
+        key = memcached_key(key)
+        return await ring.get_node(key).call(
+            func, key.encode(), *args, **kwargs
+        )
 
     return wrapper
 
 
-@manage_exceptions
-def put(key, value):
-    CACHE_CLIENT.set(key, value)
+def encode(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode(ENCODING)
 
 
-@manage_exceptions
-def get(key):
-    value = CACHE_CLIENT.get(key)
+def decode(value):
     if value is not None:
-        return value.decode(config["cache"]["encoding"])
+        return value.decode(ENCODING)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def put(shard, key, value, ex=EXPIRATION_DEFAULT):
+    await shard.client.set(key, encode(value), exptime=ex)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def get(shard, key):
+    value = await shard.client.get(key)
+    metrics.record_cache_lookup(
+        value is not None, tier="memcached", shard=shard.name
+    )
+    return decode(value)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def get_bytes(shard, key):
+    value = await shard.client.get(key)
+    metrics.record_cache_lookup(
+        value is not None, tier="memcached", shard=shard.name
+    )
+    return value
+
+
+async def multi_get(shard, keys):
+    # Memcached rejects duplicate keys in a multi-get.
+    keys = list(dict.fromkeys(keys))
+    values = await shard.client.multi_get(*(key.encode() for key in keys))
+    for value in values:
+        metrics.record_cache_lookup(
+            value is not None, tier="memcached", shard=shard.name
+        )
+    return dict(zip(keys, map(decode, values)))
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def get_many(keys):
+    """
+    Return the values of 'keys' in the same order, None for missing keys.
+    Keys are read with one multi-get per shard, and shards are read in
+    parallel.
+    """
+    memcached_keys = [memcached_key(key) for key in keys]
+    values = {}
+    for found in await call_shards(
+        multi_get, group_by_shard(ring, memcached_keys)
+    ):
+        values.update(found or {})
+    return [values.get(key) for key in memcached_keys]
+
+
+async def set_items(shard, items):
+    # The text protocol has no multi-key set or delete: commands are sent one
+    # at a time on each shard, and shards are written in parallel.
+    for key, value, ex in items:
+        await shard.client.set(key.encode(), encode(value), exptime=ex)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def put_many(items):
+    """
+    Store '(key, value, ex)' items, 'ex' being the time to live in seconds.
+    """
+    items = [(memcached_key(key), value, ex) for key, value, ex in items]
+    await call_shards(set_items, group_by_shard(ring, items, itemgetter(0)))
+
+
+async def delete_keys(shard, keys):
+    deleted = 0
+    for key in keys:
+        deleted += await shard.client.delete(key.encode())
+    return deleted
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def delete_many(keys):
+    """
+    Delete keys and return the number of deleted keys.
+    """
+    groups = group_by_shard(ring, [memcached_key(key) for key in keys])
+    return sum(count or 0 for count in await call_shards(delete_keys, groups))
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def getdel(shard, key):
+    # Memcached has no atomic get and delete. Burned texts are claimed in the
+    # database, so concurrent readers do not get here.
+    value = await shard.client.get(key)
+    if value is not None:
+        await shard.client.delete(key)
+    return decode(value)
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+@sharded
+async def delete(shard, key):
+    return await shard.client.delete(key)
+
+
+@sharded
+async def increment_counter(shard, key, ex, limit):
+    # 'add' only creates missing counters, 'incr' fails on missing keys.
+    while not await shard.client.add(key, b"1", exptime=ex):
+        try:
+            count = await shard.client.incr(key)
+        except aiomcache.ClientException:
+            # Expired between 'add' and 'incr'.
+            continue
+        # Attempts past the limit do not extend the lockout.
+        if count <= limit:
+            await shard.client.touch(key, ex)
+        return count
+    return 1
+
+
+@sharded
+async def decrement_counter(shard, key):
+    try:
+        await shard.client.decr(key)
+    except aiomcache.ClientException:
+        pass
+
+
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def record_login_attempt(user_id, user_ip, ex, limits):
+    """
+    Count a login attempt for the user and for the IP address, and return
+    the numbers of recent attempts including this one, or ``None`` if the
+    cache is not available. Counters expire 'ex' seconds after the last
+    attempt within 'limits', the maximum numbers of attempts for the user
+    and for the IP address, so locked accounts cannot be kept locked.
+    """
+    keys = login_failures_keys(user_id, user_ip)
+    return tuple(
+        await asyncio.gather(
+            *(
+                increment_counter(key, ex, limit)
+                for key, limit in zip(keys, limits)
+            )
+        )
+    )
 
 
-@manage_exceptions
-def delete(key):
-    return CACHE_CLIENT.delete(key)
+@manage_errors
+@metrics.timed
+@deadline.bounded
+async def record_login_success(user_id, user_ip):
+    # Successful attempts do not count towards the lockout.
+    user_key, ip_key = login_failures_keys(user_id, user_ip)
+    await asyncio.gather(delete(user_key), decrement_counter(ip_key))
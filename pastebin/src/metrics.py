@@ -0,0 +1,336 @@
+"""
+Lightweight metrics, exposed in the Prometheus text format.
+
+Each worker updates plain dictionaries in memory, which costs well under a
+microsecond per call, and periodically writes them to a JSON file named after
+its process ID in the metrics directory. The '/metrics' endpoint adds up the
+files of all workers: histograms and counters are summed, gauges are reported
+per worker with a 'pid' label.
+
+Histograms and counters of workers that exit are added to an archive file,
+so totals never go down, and gauges of workers that are no longer running
+are not reported.
+"""
+import asyncio
+import contextlib
+import contextvars
+import fcntl
+import functools
+import json
+import os
+import time
+from bisect import bisect_left
+
+from .config import config
+from .log import get_logger
+
+LOGGER = get_logger()
+METRICS_DIR = config["metrics"]["dir"]
+ARCHIVE_FILE = "archive.json"
+LOCK_FILE = ".lock"
+FLUSH_INTERVAL = config["metrics"]["flush_interval"]  # seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+DEPENDENCY_LATENCY = "pastebin_dependency_latency_seconds"
+DEPENDENCY_ERRORS = "pastebin_dependency_errors_total"
+CACHE_LOOKUPS = "pastebin_cache_lookups_total"
+HELP = {
+    DEPENDENCY_LATENCY: "Latency of database, cache and object store calls",
+    DEPENDENCY_ERRORS: "Exceptions raised by database, cache and object "
+    "store calls",
+    CACHE_LOOKUPS: "Cache lookups by tier, shard and result, hit or miss",
+    "pastebin_db_thread_pool_queue_depth": "Database queries waiting for a "
+    "thread",
+    "pastebin_db_pool_connections_in_use": "Connections checked out of "
+    "database connection pools",
+    "pastebin_circuit_breaker_state": "Circuit breaker state: 1 closed, "
+    "2 open, 3 half-open",
+    "pastebin_concurrency_limit": "Adaptive limit of concurrent requests",
+    "pastebin_s3_hedged_requests_total": "S3 GET requests sent again because "
+    "the first one was slow",
+    "pastebin_s3_hedge_wins_total": "Hedged S3 GET requests that answered "
+    "first",
+    "pastebin_requests_in_flight": "Requests being processed",
+    "pastebin_requests_rejected_total": "Requests rejected because the "
+    "concurrency limit was reached",
+}
+
+# Keys are (metric name, labels), where labels is a tuple of (name, value).
+# Histogram values are counts per bucket, the last bucket being +Inf,
+# followed by the sum of observed values.
+histograms = {}
+counters = {}
+gauge_collectors = []
+flush_task = None
+snapshot_written = False
+
+
+def new_histogram(name, labels):
+    return histograms.setdefault(
+        (name, labels), [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+    )
+
+
+def increment(name, labels, amount=1):
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def register_gauges(collector):
+    """
+    Register a function returning (name, labels, value) tuples, which is
+    called when the worker writes its metrics.
+    """
+    gauge_collectors.append(collector)
+
+
+def timed(func):
+    """
+    Record the latency and exceptions of an async function, labelled by
+    module and function name.
+    """
+    labels = (
+        ("component", func.__module__.rpartition(".")[2]),
+        ("operation", func.__name__),
+    )
+    histogram = new_histogram(DEPENDENCY_LATENCY, labels)
+    errors_key = (DEPENDENCY_ERRORS, labels)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            counters[errors_key] = counters.get(errors_key, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            histogram[-1] += elapsed
+
+    return wrapper
+
+
+def record_cache_lookup(hit, tier="redis", shard=None):
+    labels = (("result", "hit" if hit else "miss"), ("tier", tier))
+    if shard is not None:
+        labels += (("shard", shard),)
+    increment(CACHE_LOOKUPS, labels)
+
+
+def snapshot(include_gauges=True):
+    gauges = []
+    if include_gauges:
+        for collector in gauge_collectors:
+            try:
+                gauges.extend(collector())
+            except Exception as err:
+                LOGGER.error(
+                    f"{err.__class__.__name__} when collecting gauges: {err}"
+                )
+    return {
+        "histograms": [[n, lb, v] for (n, lb), v in histograms.items()],
+        "counters": [[n, lb, v] for (n, lb), v in counters.items()],
+        "gauges": [[n, lb, v] for n, lb, v in gauges],
+    }
+
+
+def worker_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+@contextlib.contextmanager
+def locked(operation):
+    # Archiving a file must not be seen half done by '/metrics'.
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def write_file(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def archive(path):
+    """
+    Add the histograms and counters of the worker file 'path' to the archive,
+    and remove the file.
+    """
+    with locked(fcntl.LOCK_EX):
+        try:
+            worker = read_file(path)
+        except FileNotFoundError:
+            return
+        totals = new_totals()
+        archive_path = os.path.join(METRICS_DIR, ARCHIVE_FILE)
+        if os.path.exists(archive_path):
+            add_worker(totals, read_file(archive_path))
+        add_worker(totals, {**worker, "gauges": []})
+        write_file(
+            archive_path,
+            {
+                "histograms": [
+                    [n, lb, v] for (n, lb), v in totals["histograms"].items()
+                ],
+                "counters": [
+                    [n, lb, v] for (n, lb), v in totals["counters"].items()
+                ],
+                "gauges": [],
+            },
+        )
+        os.remove(path)
+
+
+def write_snapshot(include_gauges=True):
+    global snapshot_written
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = worker_path(os.getpid())
+    if not snapshot_written:
+        # Left by a killed worker with the same process ID.
+        archive(path)
+        snapshot_written = True
+    write_file(path, snapshot(include_gauges))
+
+
+def close():
+    # Keep the histograms and counters of exiting workers, but not gauges.
+    write_snapshot(include_gauges=False)
+    archive(worker_path(os.getpid()))
+
+
+def clear_snapshots():
+    # Call when the server starts, before workers are created.
+    if os.path.isdir(METRICS_DIR):
+        for file_name in os.listdir(METRICS_DIR):
+            if file_name.endswith(".json"):
+                os.remove(os.path.join(METRICS_DIR, file_name))
+
+
+async def flush_periodically():
+    while True:
+        try:
+            write_snapshot()
+        except Exception as err:
+            LOGGER.error(
+                f"{err.__class__.__name__} when writing metrics: {err}"
+            )
+        await asyncio.sleep(FLUSH_INTERVAL)
+
+
+def start_flush_task():
+    global flush_task
+    # Started lazily because gunicorn hooks run before the worker starts its
+    # asyncio loop.
+    if flush_task is None or flush_task.done():
+        flush_task = asyncio.get_running_loop().create_task(
+            flush_periodically(), context=contextvars.Context()
+        )
+
+
+def pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def new_totals():
+    return {"histograms": {}, "counters": {}, "gauges": {}}
+
+
+def add_worker(totals, worker, pid=None):
+    for name, labels, value in worker["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        total = totals["histograms"].setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            total[i] += v
+    for name, labels, value in worker["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        totals["counters"][key] = totals["counters"].get(key, 0) + value
+    for name, labels, value in worker["gauges"]:
+        key = (name, tuple(map(tuple, labels)) + (("pid", pid),))
+        totals["gauges"][key] = value
+
+
+def aggregate():
+    totals = new_totals()
+    with locked(fcntl.LOCK_SH):
+        for file_name in os.listdir(METRICS_DIR):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                worker = read_file(os.path.join(METRICS_DIR, file_name))
+            except (OSError, ValueError):
+                continue
+            pid = file_name.removesuffix(".json")
+            if not pid.isdigit() or not pid_is_running(int(pid)):
+                worker["gauges"] = []
+            add_worker(totals, worker, pid)
+    return totals
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render(totals):
+    lines = []
+    typed = set()
+
+    def header(name, metric_type):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in sorted(totals["histograms"].items()):
+        header(name, "histogram")
+        cumulative = 0
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+        for bound, count in zip(bounds, value):
+            cumulative += count
+            bucket_labels = format_labels(labels + (("le", bound),))
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    for (name, labels), value in sorted(totals["counters"].items()):
+        header(name, "counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), value in sorted(totals["gauges"].items()):
+        header(name, "gauge")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def exposition():
+    # Refresh this worker's file so the response includes its latest values.
+    write_snapshot()
+    return render(aggregate())
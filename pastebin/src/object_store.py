@@ -1,8 +1,14 @@
+import asyncio
+import collections
+import hashlib
+import time
 import zlib
 
 import aioboto3
 import botocore
 
+from . import deadline
+from . import metrics
 from .config import config
 from .log import get_logger
 
@@ -10,30 +16,126 @@ LOGGER = get_logger()
 SESSION = aioboto3.Session()
 S3_BUCKET = config["text_storage"]["s3_bucket"]
 TEXT_ENCODING = config["text_storage"]["encoding"]
+S3_ENDPOINT_URL = config["text_storage"]["s3_endpoint_url"] or None
+HEDGE_BUDGET = config["text_storage"]["hedge_budget"]
+MAX_HEDGE_TOKENS = 10
+LATENCY_WINDOW = 1000  # GET requests
+LATENCY_REFRESH = 100  # GET requests between updates of the hedge delay
+HEDGED_REQUESTS = "pastebin_s3_hedged_requests_total"
+HEDGE_WINS = "pastebin_s3_hedge_wins_total"
 
+recent_latencies = collections.deque(maxlen=LATENCY_WINDOW)
+hedge_delay = None
+hedge_tokens = 0.0
 
-async def put_text(text_id, text_body):
-    async with SESSION.client("s3") as s3:
-        await s3.put_object(
-            Body=zlib.compress(text_body.encode(TEXT_ENCODING)),
-            Bucket=S3_BUCKET,
-            Key=text_id,
-        )
 
+def record_latency(latency):
+    global hedge_delay
+    recent_latencies.append(latency)
+    if len(recent_latencies) % LATENCY_REFRESH == 0:
+        ordered = sorted(recent_latencies)
+        hedge_delay = ordered[int(len(ordered) * 0.95)]
 
-async def get_text(text_id):
+
+def take_hedge_token():
+    # Each GET earns 'HEDGE_BUDGET' tokens and each hedge costs one, so at
+    # most this share of GET requests are hedged.
+    global hedge_tokens
+    if hedge_tokens >= 1:
+        hedge_tokens -= 1
+        return True
+    return False
+
+
+def compress_text(text_body):
+    """
+    Return the object key and the compressed body of a text. The key is the
+    hash of the compressed body, so texts with the same body share an object.
+    """
+    body = zlib.compress(text_body.encode(TEXT_ENCODING))
+    return hashlib.sha256(body).hexdigest(), body
+
+
+@metrics.timed
+@deadline.bounded
+async def put_object(object_key, body):
+    async with SESSION.client("s3", endpoint_url=S3_ENDPOINT_URL) as s3:
+        await s3.put_object(Body=body, Bucket=S3_BUCKET, Key=object_key)
+
+
+async def get_object(object_key):
+    start = time.perf_counter()
     try:
-        async with SESSION.client("s3") as s3:
-            response = await s3.get_object(Bucket=S3_BUCKET, Key=text_id)
+        async with SESSION.client("s3", endpoint_url=S3_ENDPOINT_URL) as s3:
+            response = await s3.get_object(Bucket=S3_BUCKET, Key=object_key)
             body = await response["Body"].read()
-            return zlib.decompress(body).decode(TEXT_ENCODING)
+    except asyncio.CancelledError:
+        # Requests which lose the race are the slow ones, leaving them out
+        # would lower the hedge delay. Their latency is at least this long.
+        record_latency(time.perf_counter() - start)
+        raise
+    record_latency(time.perf_counter() - start)
+    return body
+
+
+async def get_object_hedged(object_key):
+    """
+    Send a second GET request if the first one is slower than the recent
+    95th percentile latency, and return the first response.
+    """
+    global hedge_tokens
+    hedge_tokens = min(MAX_HEDGE_TOKENS, hedge_tokens + HEDGE_BUDGET)
+    first = asyncio.ensure_future(get_object(object_key))
+    if hedge_delay is None:
+        return await first
+
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        if done or not take_hedge_token():
+            return await first
+        metrics.increment(HEDGED_REQUESTS, ())
+        second = asyncio.ensure_future(get_object(object_key))
+        tasks.add(second)
+        while True:
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                tasks.discard(task)
+                # Fall back to the other request if one fails.
+                if task.exception() is None or tasks == set():
+                    if task is second:
+                        metrics.increment(HEDGE_WINS, ())
+                    return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@metrics.timed
+@deadline.bounded
+async def get_text(object_key):
+    try:
+        if HEDGE_BUDGET > 0:
+            body = await get_object_hedged(object_key)
+        else:
+            body = await get_object(object_key)
+        return zlib.decompress(body).decode(TEXT_ENCODING)
     except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "NoSuchKey":
-            LOGGER.error(f"Key '{text_id}' not found")
+            LOGGER.error(f"Key '{object_key}' not found")
             return
         raise
 
 
-async def delete_text(text_id):
-    async with SESSION.client("s3") as s3:
-        await s3.delete_object(Bucket=S3_BUCKET, Key=text_id)
+@metrics.timed
+@deadline.bounded
+async def delete_text(object_key):
+    # S3 does not fail on missing keys, but S3-compatible servers may.
+    try:
+        async with SESSION.client("s3", endpoint_url=S3_ENDPOINT_URL) as s3:
+            await s3.delete_object(Bucket=S3_BUCKET, Key=object_key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
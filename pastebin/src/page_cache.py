@@ -0,0 +1,73 @@
+"""
+Cache of rendered and compressed text pages, so pages of popular texts are
+sent as they are stored, without rendering the template or compressing the
+page for each request.
+
+Pages are keyed by text ID, template version and content encoding. Text IDs
+are keyed in their canonical form, so a page requested with an upper case ID
+is deleted with the text. The template version is a hash of the template, so
+pages rendered with a previous template are not used after a deployment.
+"""
+import asyncio
+import gzip
+import hashlib
+import os
+from functools import partial
+
+import brotli
+
+from . import cache_backend
+from . import compression
+from . import ids
+
+TEMPLATE = "text.html"
+PAGE_CACHE_EXPIRATION = 3600  # seconds
+# Pages are compressed once and sent many times, but compression still adds
+# to the latency of the request that renders the page.
+ENCODINGS = {
+    "br": partial(brotli.compress, quality=9),
+    "gzip": partial(gzip.compress, compresslevel=6, mtime=0),
+}
+
+
+def template_version():
+    path = os.path.join(os.path.dirname(__file__), "templates", TEMPLATE)
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+TEMPLATE_VERSION = template_version()
+
+
+def page_key(text_id, encoding):
+    text_id = ids.parse_text_id(str(text_id)) or text_id
+    return f"page:{text_id}:{TEMPLATE_VERSION}:{encoding}"
+
+
+def page_keys(text_id):
+    return [page_key(text_id, encoding) for encoding in ENCODINGS]
+
+
+def accepted_encoding(accept_encoding):
+    return compression.accepted_encoding(accept_encoding, tuple(ENCODINGS))
+
+
+async def compress(html, encoding):
+    # Compressing large pages takes milliseconds, do not block the loop.
+    return await asyncio.get_running_loop().run_in_executor(
+        None, ENCODINGS[encoding], html.encode()
+    )
+
+
+async def get(text_id, encoding):
+    return await cache_backend.get_bytes(page_key(text_id, encoding))
+
+
+async def put(text_id, encoding, page):
+    await cache_backend.put(
+        page_key(text_id, encoding), page, ex=PAGE_CACHE_EXPIRATION
+    )
+
+
+async def delete(text_id):
+    await cache_backend.delete_many(page_keys(text_id))
@@ -35,7 +35,7 @@ CREATE INDEX IF NOT EXISTS user_connect_ts_idx ON user_connections (ts)
 
 CREATE_TABLE_TEXTS = """
 CREATE TABLE IF NOT EXISTS texts (
-  text_id VARCHAR(255) PRIMARY KEY,
+  text_id {text_id_type} PRIMARY KEY,
   text_title VARCHAR(255),
   text_path VARCHAR(255),
   user_id VARCHAR(40) REFERENCES users(user_id),
@@ -49,8 +49,31 @@ CREATE TABLE IF NOT EXISTS texts (
 )
 ;"""
 
-CREATE_INDEX_TEXTS_USERID = """
-CREATE INDEX IF NOT EXISTS texts_userid_idx ON texts (user_id)
+CREATE_TABLE_TEXT_OBJECTS = """
+CREATE TABLE IF NOT EXISTS text_objects (
+  object_key VARCHAR(64) PRIMARY KEY,
+  ref_count INT UNSIGNED NOT NULL
+)
+;"""
+
+# 'stored' is false until the object is uploaded, rows created before the
+# column existed are for stored objects. 'deletion_start' is set while the
+# object is deleted from storage.
+ADD_TEXT_OBJECTS_STATE = """
+ALTER TABLE text_objects
+ADD COLUMN IF NOT EXISTS stored BOOLEAN NOT NULL DEFAULT TRUE,
+ADD COLUMN IF NOT EXISTS deletion_start DATETIME
+;"""
+
+# Serves listings of a user's texts in creation order, and quota counts.
+CREATE_INDEX_TEXTS_USERID_CREATION = """
+CREATE INDEX IF NOT EXISTS texts_userid_creation_idx
+ON texts (user_id, creation)
+;"""
+
+# Superseded by texts_userid_creation_idx.
+DROP_INDEX_TEXTS_USERID = """
+DROP INDEX IF EXISTS texts_userid_idx ON texts
 ;"""
 
 CREATE_INDEX_TEXTS_USERIP = """
@@ -61,6 +84,18 @@ CREATE_INDEX_TEXTS_CREATION = """
 CREATE INDEX IF NOT EXISTS texts_creation_idx ON texts (creation)
 ;"""
 
+# Deletable texts are a small fraction of the table, these indexes let the
+# cleanup process find them without scanning live texts.
+CREATE_INDEX_TEXTS_PENDING_EXPIRATION = """
+CREATE INDEX IF NOT EXISTS texts_pending_expiration_idx
+ON texts (deletion, expiration)
+;"""
+
+CREATE_INDEX_TEXTS_PENDING_DELETION = """
+CREATE INDEX IF NOT EXISTS texts_pending_deletion_idx
+ON texts (deletion, to_be_deleted)
+;"""
+
 CREATE_USER = """
 INSERT INTO users (user_id, first_name, last_name, joined, password)
 VALUES (%s, %s, %s, %s, %s)
@@ -87,19 +122,93 @@ MARK_TEXT_FOR_DELETION = """
 UPDATE texts SET to_be_deleted = TRUE WHERE text_id = %s
 ;"""
 
-MARK_TEXT_DELETED = "UPDATE texts SET deletion = %s WHERE text_id = %s;"
+CLAIM_TEXT_FOR_BURNING = """
+UPDATE texts SET to_be_deleted = TRUE
+WHERE text_id = %s AND to_be_deleted = FALSE
+;"""
+
+MARK_TEXT_DELETED = """
+UPDATE texts SET deletion = %s WHERE text_id = %s AND deletion IS NULL
+;"""
+
+UNMARK_TEXT_DELETED = "UPDATE texts SET deletion = NULL WHERE text_id = %s;"
+
+# Creates the row with no reference if missing, and locks it.
+CREATE_TEXT_OBJECT = """
+INSERT INTO text_objects (object_key, ref_count, stored) VALUES (%s, 0, FALSE)
+ON DUPLICATE KEY UPDATE ref_count = ref_count
+;"""
+
+LOCK_TEXT_OBJECT = """
+SELECT ref_count, stored, deletion_start FROM text_objects
+WHERE object_key = %s FOR UPDATE
+;"""
+
+ADD_TEXT_OBJECT_REFERENCE = """
+UPDATE text_objects SET ref_count = ref_count + 1 WHERE object_key = %s
+;"""
+
+# The reference of the text being deleted is dropped.
+RESTART_TEXT_OBJECT = """
+UPDATE text_objects SET ref_count = 1, stored = FALSE, deletion_start = NULL
+WHERE object_key = %s
+;"""
+
+MARK_TEXT_OBJECT_STORED = """
+UPDATE text_objects SET stored = TRUE WHERE object_key = %s
+;"""
+
+START_TEXT_OBJECT_DELETION = """
+UPDATE text_objects SET deletion_start = %s WHERE object_key = %s
+;"""
+
+# The object may have been deleted before the error, so it is uploaded again
+# by the next text that references it.
+CANCEL_TEXT_OBJECT_DELETION = """
+UPDATE text_objects SET stored = FALSE, deletion_start = NULL
+WHERE object_key = %s
+;"""
+
+# Objects left without references by a failed deletion, deleted by cleanup.
+GET_UNREFERENCED_TEXT_OBJECTS = """
+SELECT object_key FROM text_objects
+WHERE ref_count = 0 AND deletion_start IS NULL
+LIMIT %s
+;"""
+
+REMOVE_TEXT_OBJECT_REFERENCE = """
+UPDATE text_objects SET ref_count = ref_count - 1 WHERE object_key = %s
+;"""
+
+DELETE_TEXT_OBJECT = """
+DELETE FROM text_objects WHERE object_key = %s AND deletion_start IS NOT NULL
+;"""
 
 GET_TEXTS_BY_OWNER = """
 SELECT text_id, text_title, creation, expiration FROM texts
-WHERE user_id = %s AND (deletion IS NULL AND to_be_deleted IS NOT TRUE)
-ORDER BY creation
+WHERE user_id = %s
+  AND (deletion IS NULL AND to_be_deleted IS NOT TRUE)
+  AND (creation > %s OR (creation = %s AND text_id > %s))
+ORDER BY creation, text_id
+LIMIT %s
 ;"""
 
 GET_TEXT_OWNER = "SELECT user_id FROM texts WHERE text_id = %s;"
 
-GET_TEXTS_FOR_DELETION = """
-SELECT text_id FROM texts
-WHERE (expiration < NOW() OR to_be_deleted) AND deletion IS NULL
+GET_EXPIRED_TEXTS_FOR_DELETION = """
+SELECT text_id, text_path, expiration FROM texts
+WHERE deletion IS NULL
+  AND expiration < NOW()
+  AND (expiration > %s OR (expiration = %s AND text_id > %s))
+ORDER BY expiration, text_id
+LIMIT %s
+;"""
+
+GET_MARKED_TEXTS_FOR_DELETION = """
+SELECT text_id, text_path FROM texts
+WHERE deletion IS NULL AND to_be_deleted = TRUE AND text_id > %s
+ORDER BY text_id
+LIMIT %s
 ;"""
 
 GET_USER = "SELECT * FROM users WHERE user_id = %s;"
@@ -120,7 +229,7 @@ WHERE user_id = %s AND creation > NOW() - INTERVAL 1 DAY
 
 RECORD_USER_CONNECT = """
 INSERT INTO user_connections (user_id, user_ip, ts, success)
-VALUES (%s, %s, NOW(), %s)
+VALUES (%s, %s, %s, %s)
 ;"""
 
 GET_RECENT_USER_CONNECTIONS = """
@@ -132,3 +241,37 @@ ORDER BY ts DESC
 GET_TEXT_METADATA = """
 SELECT * FROM texts WHERE text_id = %s
 ;"""
+
+GET_LIVE_TEXT_IDS = """
+SELECT text_id FROM texts
+WHERE text_id > %s AND to_be_deleted = FALSE AND deletion IS NULL
+ORDER BY text_id
+LIMIT %s
+;"""
+
+MIGRATE_TEXT_IDS_ADD_COLUMN = """
+ALTER TABLE texts ADD COLUMN IF NOT EXISTS text_id_bin BINARY(16)
+;"""
+
+# UNHEX silently pads hex strings that are too short for BINARY(16). Text IDs
+# which are not 32 hex digits are left NULL and counted as invalid, and are
+# skipped so later batches do not select them again.
+MIGRATE_TEXT_IDS_FILL_COLUMN = """
+UPDATE texts SET text_id_bin = UNHEX(REPLACE(text_id, '-', ''))
+WHERE text_id_bin IS NULL
+  AND LENGTH(REPLACE(text_id, '-', '')) = 32
+  AND UNHEX(REPLACE(text_id, '-', '')) IS NOT NULL
+LIMIT %s
+;"""
+
+MIGRATE_TEXT_IDS_COUNT_INVALID = """
+SELECT COUNT(*) FROM texts WHERE text_id_bin IS NULL
+;"""
+
+MIGRATE_TEXT_IDS_SWAP_COLUMNS = """
+ALTER TABLE texts
+  DROP PRIMARY KEY,
+  DROP COLUMN text_id,
+  CHANGE COLUMN text_id_bin text_id BINARY(16) NOT NULL FIRST,
+  ADD PRIMARY KEY (text_id)
+;"""
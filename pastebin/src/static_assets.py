@@ -0,0 +1,81 @@
+"""
+Static files, served with their Brotli or gzip variants when the client
+accepts them. Variants are written next to the files when the image is built,
+by 'precompress_static'.
+
+URLs of static files include a hash of their content, so they can be cached
+by browsers for a year: a new version of a file has a new URL.
+"""
+import hashlib
+import mimetypes
+import os
+
+from quart import send_from_directory
+
+from . import compression
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+MAX_AGE = 365 * 24 * 3600  # seconds
+# Browsers request '/favicon.ico' and outdated versions without the current
+# hash, which are cached for a short time only.
+UNVERSIONED_MAX_AGE = 3600  # seconds
+
+
+def file_version(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def list_files(directory=STATIC_DIR):
+    """
+    Return the versions of static files, and their precompressed variants,
+    by path relative to 'directory'.
+    """
+    versions = {}
+    variants = set()
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, directory)
+            if name.endswith(tuple(PRECOMPRESSED.values())):
+                variants.add(name)
+            else:
+                versions[name] = file_version(path)
+    return versions, variants
+
+
+VERSIONS, VARIANTS = list_files()
+
+
+def add_version(endpoint, values):
+    # Called by 'url_for', adds the version to URLs of static files.
+    if endpoint == "static" and values.get("filename") in VERSIONS:
+        values.setdefault("v", VERSIONS[values["filename"]])
+
+
+async def send_asset(file_name, accept_encoding, version=None):
+    encodings = tuple(
+        encoding
+        for encoding, suffix in PRECOMPRESSED.items()
+        if f"{file_name}{suffix}" in VARIANTS
+    )
+    encoding = compression.accepted_encoding(accept_encoding, encodings)
+    immutable = version is not None and version == VERSIONS.get(file_name)
+    max_age = MAX_AGE if immutable else UNVERSIONED_MAX_AGE
+    if encoding is None:
+        response = await send_from_directory(
+            STATIC_DIR, file_name, cache_timeout=max_age
+        )
+    else:
+        response = await send_from_directory(
+            STATIC_DIR,
+            f"{file_name}{PRECOMPRESSED[encoding]}",
+            mimetype=mimetypes.guess_type(file_name)[0],
+            cache_timeout=max_age,
+        )
+        response.headers["Content-Encoding"] = encoding
+    if encodings:
+        response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = immutable
+    return response
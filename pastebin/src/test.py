@@ -1,80 +1,1122 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import gzip
+import os
+import tempfile
+import time
 import unittest
-from datetime import datetime, timedelta
+import unittest.mock
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
+import quart
+import redis
+
+from . import api
+from . import audit
 from . import auth
+from . import cache
+from . import compression
+from . import concurrency_limit
 from . import database
+from . import deadline
+from . import disk_cache
+from . import ids
+from . import memcached
+from . import metrics
 from . import object_store
+from . import page_cache
+from . import sql_queries
+from . import static_assets
+from . import text_filter
+from .circuit_breaker import CircuitBreakerBypass, CircuitBreakerState
 
 
-def test_put_text():
-    with open("config.py") as f:
-        text_body = f.read()
-    now = datetime.now()
-    exp = now + timedelta(days=30)
+class TestPasswordComplexity(unittest.TestCase):
+    def test_password_too_short(self):
+        self.assertFalse(auth.check_password_complexity("aXcZe164?"))
 
-    database.put_text(
-        "DySG",
-        text_body,
-        "anonymous",
-        now,
-        exp,
-    )
+    def test_password_no_lowercase(self):
+        self.assertFalse(auth.check_password_complexity("ANEIDPZ73$"))
 
+    def test_password_no_uppercase(self):
+        self.assertFalse(auth.check_password_complexity("aneidpz73$"))
 
-def test_put_text_object():
-    object_store.put_text("this-is-the-key", "this-is-the-text-body")
+    def test_password_no_digit(self):
+        self.assertFalse(auth.check_password_complexity("aneIdpzup$"))
 
+    def test_password_no_punctuation(self):
+        self.assertFalse(auth.check_password_complexity("aneiDpzup1"))
+
+    def test_password_ok(self):
+        self.assertTrue(auth.check_password_complexity("o1sDhfi8&U"))
 
-def test_delete_object():
-    object_store.delete_text("sodfoinsodinsd")
 
+class TestUuid7(unittest.TestCase):
+    def test_version_and_variant(self):
+        text_id = ids.uuid7()
+        self.assertEqual(text_id.version, 7)
+        self.assertEqual(text_id.variant, uuid.RFC_4122)
 
-def test_get_text():
-    print(object_store.get_text("249Y"))
+    def test_time_ordered(self):
+        first = ids.new_text_id()
+        time.sleep(0.002)
+        second = ids.new_text_id()
+        self.assertLess(first, second)
 
+    def test_timestamp(self):
+        before = time.time_ns() // 1000000
+        text_id = ids.uuid7()
+        self.assertGreaterEqual(text_id.int >> 80, before)
 
-def test_get_text_no_such_key():
-    print("object not found:", object_store.get_text("osidmoismdf") is None)
 
+class TestTextsPage(unittest.TestCase):
+    text = {
+        "text_id": "0192f1a2-7b3c-7d4e-8f5a-6b7c8d9e0f1a",
+        "text_title": "Title",
+        "creation": datetime(2024, 10, 1, 12, 30, 15),
+        "expiration": datetime(2024, 10, 8, 12, 30, 15),
+    }
 
-def test_get_texts_by_user():
-    data = database.get_texts_by_user("anonymous")
-    print(data)
-    print(data[0]["text_id"])
-    print(data[1]["expiration"])
+    def test_page_cursor(self):
+        cursor = api.encode_page_cursor(self.text)
+        self.assertEqual(
+            api.decode_page_cursor(cursor),
+            (self.text["creation"], self.text["text_id"]),
+        )
 
+    def test_invalid_page_cursor(self):
+        self.assertIsNone(api.decode_page_cursor(None))
+        self.assertIsNone(api.decode_page_cursor("2024-10-01T12:30:15_abc"))
 
-def test_insert_user_exists():
-    print(
-        database.create_user(
-            "anonymous", "john", "doe", datetime.now(), "blah"
+    def test_serialize_page(self):
+        value = api.serialize_texts_page([self.text], "cursor")
+        self.assertEqual(
+            api.deserialize_texts_page(value), ([self.text], "cursor")
         )
-    )
 
 
-class TestPasswordComplexity(unittest.TestCase):
-    def test_password_too_short(self):
-        self.assertFalse(auth.check_password_complexity("aXcZe164?"))
+class TestTextFilter(unittest.TestCase):
+    def setUp(self):
+        self.text_ids = [str(uuid.uuid4()) for _ in range(1000)]
+        bloom_filter = text_filter.BloomFilter(1000, 0.01)
+        for text_id in self.text_ids:
+            bloom_filter.add(text_id)
+        text_filter.current = bloom_filter
+        text_filter.snapshot_time = time.time()
+        text_filter.refresh_task = unittest.mock.Mock(done=lambda: False)
 
-    def test_password_no_lowercase(self):
-        self.assertFalse(auth.check_password_complexity("ANEIDPZ73$"))
+    def tearDown(self):
+        text_filter.current = None
+        text_filter.snapshot_time = None
+        text_filter.refresh_task = None
 
-    def test_password_no_uppercase(self):
-        self.assertFalse(auth.check_password_complexity("aneidpz73$"))
+    def test_no_false_negatives(self):
+        for text_id in self.text_ids:
+            self.assertTrue(text_filter.lookup(uuid.UUID(text_id)))
 
-    def test_password_no_digit(self):
-        self.assertFalse(auth.check_password_complexity("aneIdpzup$"))
+    def test_false_positive_rate(self):
+        false_positives = sum(
+            text_filter.lookup(uuid.uuid4()) for _ in range(10000)
+        )
+        self.assertLess(false_positives, 300)
 
-    def test_password_no_punctuation(self):
-        self.assertFalse(auth.check_password_complexity("aneiDpzup1"))
+    def test_recent_text_ids_skip_filter(self):
+        self.assertIsNone(text_filter.lookup(ids.uuid7()))
+
+    def test_filter_not_built(self):
+        text_filter.current = None
+        self.assertIsNone(text_filter.lookup(uuid.uuid4()))
+
+    def test_build(self):
+        batches = [self.text_ids[:500], self.text_ids[500:]]
+        with unittest.mock.patch.object(
+            database, "iter_live_text_ids_sync", lambda: iter(batches)
+        ):
+            bloom_filter, _, count = text_filter.build()
+        self.assertEqual(count, len(self.text_ids))
+        for text_id in self.text_ids:
+            self.assertIn(text_id, bloom_filter)
+
+
+class TestReplicaRouting(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.replica = unittest.mock.Mock(
+            pool="replica", execute=unittest.mock.AsyncMock()
+        )
+        database.replicas.append(self.replica)
+        patcher = unittest.mock.patch.object(
+            database, "execute_on_pool", unittest.mock.AsyncMock()
+        )
+        self.execute_on_primary = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(database.replicas.clear)
+
+    def test_parse_replica_hosts(self):
+        self.assertEqual(
+            database.parse_replica_hosts("db-1:3307, db-2,"),
+            [("db-1", 3307), ("db-2", database.DB_CONFIG["port"])],
+        )
+
+    async def test_read_from_replica(self):
+        await database.execute_in_thread_pool("SELECT 1", read_only=True)
+        self.replica.execute.assert_awaited_once()
+        self.execute_on_primary.assert_not_awaited()
+
+    async def test_read_own_writes(self):
+        database.read_own_writes(time.time())
+        await database.execute_in_thread_pool("SELECT 1", read_only=True)
+        self.replica.execute.assert_not_awaited()
+        self.execute_on_primary.assert_awaited_once()
+
+    async def test_failover_to_primary(self):
+        self.replica.execute.side_effect = CircuitBreakerBypass("open")
+        await database.execute_in_thread_pool("SELECT 1", read_only=True)
+        self.execute_on_primary.assert_awaited_once()
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        patcher = unittest.mock.patch.object(
+            metrics, "METRICS_DIR", metrics_dir.name
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_timed(self):
+        async def get_thing(fail):
+            if fail:
+                raise ValueError
+
+        timed = metrics.timed(get_thing)
+        await timed(False)
+        with self.assertRaises(ValueError):
+            await timed(True)
+        labels = (
+            ("component", __name__.rpartition(".")[2]),
+            ("operation", "get_thing"),
+        )
+        histogram = metrics.histograms[(metrics.DEPENDENCY_LATENCY, labels)]
+        self.assertEqual(sum(histogram[:-1]), 2)
+        self.assertEqual(
+            metrics.counters[(metrics.DEPENDENCY_ERRORS, labels)], 1
+        )
+
+    def test_aggregate_workers(self):
+        metrics.record_cache_lookup(True)
+        metrics.write_snapshot()
+        with open(f"{metrics.METRICS_DIR}/1.json", "w") as f:
+            f.write(
+                '{"histograms": [], "gauges": [], "counters": '
+                '[["pastebin_cache_lookups_total", '
+                '[["result", "hit"], ["tier", "redis"]], 2]]}'
+            )
+        expected = metrics.counters[
+            (metrics.CACHE_LOOKUPS, (("result", "hit"), ("tier", "redis")))
+        ]
+        text = metrics.render(metrics.aggregate())
+        self.assertIn("# TYPE pastebin_cache_lookups_total counter", text)
+        self.assertIn(
+            'pastebin_cache_lookups_total{result="hit",tier="redis"} '
+            f"{expected + 2}",
+            text,
+        )
+
+    def test_exited_workers(self):
+        worker = {
+            "histograms": [],
+            "counters": [[metrics.CACHE_LOOKUPS, [["result", "hit"]], 2]],
+            "gauges": [["pastebin_requests_in_flight", [], 3]],
+        }
+        # No process has this ID, e.g. a killed worker.
+        dead_pid = 2**22 + 1
+        metrics.write_file(metrics.worker_path(dead_pid), worker)
+        totals = metrics.aggregate()
+        self.assertEqual(totals["gauges"], {})
+        counter_key = (metrics.CACHE_LOOKUPS, (("result", "hit"),))
+        self.assertEqual(totals["counters"][counter_key], 2)
+
+        # Counters are kept when the file is archived, e.g. when a new
+        # worker gets the same process ID.
+        metrics.archive(metrics.worker_path(dead_pid))
+        metrics.archive(metrics.worker_path(dead_pid))
+        metrics.write_file(metrics.worker_path(dead_pid), worker)
+        metrics.archive(metrics.worker_path(dead_pid))
+        self.assertFalse(os.path.exists(metrics.worker_path(dead_pid)))
+        totals = metrics.aggregate()
+        self.assertEqual(totals["counters"][counter_key], 4)
+
+
+class TestAudit(unittest.IsolatedAsyncioTestCase):
+    async def test_flush_pending_batch(self):
+        write_started = asyncio.Event()
+
+        async def record_user_connects(events):
+            write_started.set()
+            await asyncio.Event().wait()
+
+        record_sync = unittest.mock.Mock()
+        with unittest.mock.patch.multiple(
+            audit,
+            queue=None,
+            writer_task=None,
+            pending=[],
+            FLUSH_INTERVAL=0.01,
+        ), unittest.mock.patch.multiple(
+            database,
+            record_user_connects=record_user_connects,
+            record_user_connects_sync=record_sync,
+        ):
+            for i in range(3):
+                audit.record_user_connect(f"user-{i}", "127.0.0.1", True)
+            await write_started.wait()
+            self.assertEqual(len(audit.pending), 3)
+            audit.record_user_connect("user-3", "127.0.0.1", False)
+            audit.flush()
+        events = record_sync.call_args.args[0]
+        self.assertEqual(
+            [event[0] for event in events],
+            ["user-0", "user-1", "user-2", "user-3"],
+        )
+
+
+class TestConcurrencyLimit(unittest.IsolatedAsyncioTestCase):
+    def test_limit_shrinks_when_latency_rises(self):
+        limit = concurrency_limit.GradientLimit(100, 5, 500)
+        limit.inflight = 100
+        for _ in range(100):
+            limit.update(0.01)
+        steady = limit.limit
+        for _ in range(20):
+            limit.update(0.1)
+        self.assertLess(limit.limit, steady / 2)
+
+    async def request(self, middleware, method, path):
+        statuses = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message["status"])
+
+        scope = {"type": "http", "method": method, "path": path}
+        await middleware(scope, None, send)
+        return statuses[0]
+
+    async def test_overload(self):
+        release = asyncio.Event()
+
+        async def slow_app(scope, receive, send):
+            await release.wait()
+            await send({"type": "http.response.start", "status": 200})
+
+        middleware = concurrency_limit.ConcurrencyLimitMiddleware(
+            slow_app, concurrency_limit.GradientLimit(10, 10, 10)
+        )
+        pending = [
+            asyncio.create_task(self.request(middleware, "POST", "/"))
+            for _ in range(8)
+        ]
+        await asyncio.sleep(0)
+        # Low priority requests are admitted up to 80% of the limit.
+        self.assertEqual(await self.request(middleware, "POST", "/"), 503)
+        reads = [
+            asyncio.create_task(self.request(middleware, "GET", "/text/a"))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(
+            await self.request(middleware, "GET", "/text/a"), 503
+        )
+        release.set()
+        self.assertEqual(await asyncio.gather(*pending, *reads), [200] * 10)
+
+
+class TestDeadline(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.dict(
+            deadline.ROUTE_TIMEOUTS, {"slow": 0.05}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_bounded_call(self):
+        deadline.start("slow")
+        with self.assertRaises(deadline.DeadlineExceeded):
+            await deadline.bounded(asyncio.sleep)(1)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            deadline.remaining()
+
+    async def test_statement_timeout(self):
+        deadline.start("slow")
+        with unittest.mock.patch.object(
+            database, "execute_on_pool", unittest.mock.AsyncMock()
+        ) as execute_on_pool:
+            await database.execute_in_thread_pool("SELECT 1", read_only=True)
+            await database.execute_in_thread_pool("UPDATE t SET c = 1")
+        read_query = execute_on_pool.await_args_list[0].args[1]
+        write_query = execute_on_pool.await_args_list[1].args[1]
+        self.assertRegex(
+            read_query, r"^SET STATEMENT max_statement_time=0\.0\d+ FOR "
+        )
+        self.assertEqual(write_query, "UPDATE t SET c = 1")
+
+    async def test_statement_timeout_near_deadline(self):
+        deadline.start("slow")
+        with unittest.mock.patch.object(
+            database, "execute_on_pool", unittest.mock.AsyncMock()
+        ) as execute_on_pool, unittest.mock.patch.object(
+            deadline, "remaining", return_value=0.0001
+        ):
+            await database.execute_in_thread_pool("SELECT 1", read_only=True)
+        self.assertIn(
+            "max_statement_time=0.001 ", execute_on_pool.await_args.args[1]
+        )
+
+
+class TestHedgedReads(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = 0
+
+        async def get_object(text_id):
+            self.calls += 1
+            if self.calls == 1:
+                await asyncio.sleep(1)
+                return b"slow"
+            return b"fast"
+
+        for name, value in [
+            ("get_object", get_object),
+            ("hedge_delay", 0.01),
+            ("hedge_tokens", 0.0),
+            ("HEDGE_BUDGET", 1.0),
+        ]:
+            patcher = unittest.mock.patch.object(object_store, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_hedge_wins(self):
+        body = await object_store.get_object_hedged("text")
+        self.assertEqual(body, b"fast")
+        self.assertEqual(self.calls, 2)
+
+    async def test_budget_exhausted(self):
+        object_store.HEDGE_BUDGET = 0.5
+        body = await object_store.get_object_hedged("text")
+        self.assertEqual(body, b"slow")
+        self.assertEqual(self.calls, 1)
+
+
+class TestHedgedLatency(unittest.IsolatedAsyncioTestCase):
+    async def test_cancelled_request_latency(self):
+        delays = [1, 0.05]
+
+        class Body:
+            async def read(self):
+                await asyncio.sleep(delays.pop(0))
+                return b"body"
+
+        s3 = unittest.mock.AsyncMock()
+        s3.get_object.return_value = {"Body": Body()}
+        session = unittest.mock.MagicMock()
+        session.client.return_value.__aenter__.return_value = s3
+        latencies = collections.deque()
+        with unittest.mock.patch.multiple(
+            object_store,
+            SESSION=session,
+            recent_latencies=latencies,
+            hedge_delay=0.01,
+            hedge_tokens=1.0,
+        ):
+            body = await object_store.get_object_hedged("text")
+            await asyncio.sleep(0)
+        self.assertEqual(body, b"body")
+        # The first request was cancelled, its latency is still recorded.
+        self.assertEqual(len(latencies), 2)
+        self.assertGreaterEqual(max(latencies), 0.05)
+
+
+class TestDiskCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = unittest.mock.patch.object(
+            disk_cache, "CACHE_DIR", cache_dir.name
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_put_get_delete(self):
+        await disk_cache.put("text-id", "text body")
+        self.assertEqual(await disk_cache.get("text-id"), "text body")
+        await disk_cache.delete("text-id")
+        self.assertIsNone(await disk_cache.get("text-id"))
+
+    def test_evict_least_recently_read(self):
+        for i in range(10):
+            path = disk_cache.key_path(f"text-{i}")
+            disk_cache.write_file(path, uuid.uuid4().hex * 100)
+            os.utime(path, (i, i))
+        size = os.path.getsize(disk_cache.key_path("text-0"))
+        with unittest.mock.patch.object(disk_cache, "MAX_SIZE", size * 5):
+            self.assertEqual(disk_cache.evict(), 6)
+        self.assertIsNone(disk_cache.read_file(disk_cache.key_path("text-5")))
+        self.assertIsNotNone(
+            disk_cache.read_file(disk_cache.key_path("text-6"))
+        )
+
+
+class TestTextDeduplication(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cursor = unittest.mock.Mock(rowcount=1)
+        self.delete_object = unittest.mock.AsyncMock()
+        thread_pool = ThreadPoolExecutor(1)
+        self.addCleanup(thread_pool.shutdown)
+        for name, value in [
+            ("thread_pool", thread_pool),
+            ("connect", lambda **kwargs: contextlib.nullcontext(self.cursor)),
+        ]:
+            patcher = unittest.mock.patch.object(database, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_same_body_same_key(self):
+        key, body = object_store.compress_text("text body")
+        self.assertEqual(object_store.compress_text("text body")[0], key)
+        self.assertNotEqual(object_store.compress_text("other body")[0], key)
+
+    async def test_upload_skipped_for_existing_object(self):
+        mocks = {
+            "add_text_object_reference": unittest.mock.AsyncMock(
+                return_value=True
+            ),
+            "put_text_metadata": unittest.mock.AsyncMock(),
+        }
+        with unittest.mock.patch.multiple(
+            database, **mocks
+        ), unittest.mock.patch.object(
+            object_store, "put_object", unittest.mock.AsyncMock()
+        ) as put_object:
+            await api.put_text(
+                "text body",
+                "",
+                database.DEFAULT_USER,
+                "127.0.0.1",
+                "1d",
+                False,
+                "public",
+            )
+        put_object.assert_not_awaited()
+        key, _ = object_store.compress_text("text body")
+        self.assertEqual(
+            mocks["put_text_metadata"].await_args.kwargs["object_key"], key
+        )
+
+    async def release(self, ref_count):
+        self.cursor.fetchone.return_value = (
+            None
+            if ref_count is None
+            else {
+                "ref_count": ref_count,
+                "stored": True,
+                "deletion_start": None,
+            }
+        )
+        return await database.release_text_object(
+            "key", self.delete_object, "text-id", datetime.now()
+        )
+
+    async def test_object_shared(self):
+        self.assertFalse(await self.release(2))
+        self.delete_object.assert_not_awaited()
+
+    async def test_last_reference(self):
+        self.assertTrue(await self.release(1))
+        self.delete_object.assert_awaited_once()
+
+    async def test_object_stored_before_deduplication(self):
+        self.assertTrue(await self.release(None))
+        self.delete_object.assert_awaited_once()
+
+    async def test_text_already_released(self):
+        self.cursor.rowcount = 0
+        self.assertFalse(await self.release(1))
+        self.delete_object.assert_not_awaited()
+
+    async def test_failed_deletion_is_retried(self):
+        self.delete_object.side_effect = OSError
+        with self.assertRaises(OSError):
+            await self.release(1)
+        queries = [c.args[0] for c in self.cursor.execute.call_args_list]
+        self.assertIn(sql_queries.UNMARK_TEXT_DELETED, queries)
+        self.assertNotIn(sql_queries.DELETE_TEXT_OBJECT, queries)
+
+
+class FakeTextObjectsCursor:
+    """
+    Cursor running the queries on 'text_objects' against a dictionary.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.texts = {}
+        self.row = None
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, query, args):
+        key = args[-1]
+        row = self.objects.get(key)
+        if query == sql_queries.CREATE_TEXT_OBJECT:
+            self.objects.setdefault(
+                key, {"ref_count": 0, "stored": False, "deletion_start": None}
+            )
+        elif query == sql_queries.LOCK_TEXT_OBJECT:
+            self.row = None if row is None else dict(row)
+        elif query == sql_queries.ADD_TEXT_OBJECT_REFERENCE:
+            row["ref_count"] += 1
+        elif query == sql_queries.REMOVE_TEXT_OBJECT_REFERENCE:
+            row["ref_count"] -= 1
+        elif query == sql_queries.MARK_TEXT_OBJECT_STORED:
+            row["stored"] = True
+        elif query == sql_queries.START_TEXT_OBJECT_DELETION:
+            row["deletion_start"] = args[0]
+        elif query == sql_queries.CANCEL_TEXT_OBJECT_DELETION:
+            row.update(stored=False, deletion_start=None)
+        elif query == sql_queries.GET_UNREFERENCED_TEXT_OBJECTS:
+            self.rows = [
+                {"object_key": object_key}
+                for object_key, row in self.objects.items()
+                if row["ref_count"] == 0 and row["deletion_start"] is None
+            ]
+        elif query == sql_queries.DELETE_TEXT_OBJECT:
+            del self.objects[key]
+        elif query == sql_queries.INSERT_TEXT:
+            self.texts[args[0]] = args[2].partition("/")[2]
+        else:
+            raise NotImplementedError(query)
+
+    def fetchone(self):
+        return self.row
+
+    def fetchall(self):
+        return self.rows
+
+
+class TestConcurrentUploads(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cursor = FakeTextObjectsCursor()
+        thread_pool = ThreadPoolExecutor(1)
+        self.addCleanup(thread_pool.shutdown)
+        for target, name, value in [
+            (database, "thread_pool", thread_pool),
+            (
+                database,
+                "connect",
+                lambda **kwargs: contextlib.nullcontext(self.cursor),
+            ),
+            (object_store, "put_object", self.put_object),
+            (object_store, "delete_text", self.delete_text),
+            (api, "invalidate_user_texts", unittest.mock.AsyncMock()),
+        ]:
+            patcher = unittest.mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.bucket = set()
+        self.first_upload = asyncio.Event()
+        self.fail_first_upload = asyncio.Event()
+        self.uploads = 0
+
+    async def put_object(self, object_key, body):
+        self.uploads += 1
+        if self.uploads == 1:
+            self.first_upload.set()
+            await self.fail_first_upload.wait()
+            raise OSError("upload failed")
+        self.bucket.add(object_key)
+
+    async def delete_text(self, object_key):
+        await asyncio.sleep(0.1)
+        self.bucket.discard(object_key)
+
+    def put_text(self):
+        return api.put_text(
+            "text body",
+            "",
+            database.DEFAULT_USER,
+            "127.0.0.1",
+            "1d",
+            False,
+            "public",
+        )
+
+    async def test_first_upload_fails_while_duplicate_in_flight(self):
+        first = asyncio.create_task(self.put_text())
+        await self.first_upload.wait()
+        text_id = await self.put_text()
+        self.fail_first_upload.set()
+        with self.assertRaises(OSError):
+            await first
+
+        object_key = self.cursor.texts[database.encode_text_id(text_id)]
+        self.assertIn(object_key, self.bucket)
+        self.assertEqual(
+            self.cursor.objects[object_key],
+            {"ref_count": 1, "stored": True, "deletion_start": None},
+        )
+
+    async def test_upload_waits_for_deletion(self):
+        self.uploads = 1
+        text_id = await self.put_text()
+        object_key = self.cursor.texts[database.encode_text_id(text_id)]
+        release = asyncio.create_task(
+            database.release_text_object(
+                object_key,
+                functools.partial(object_store.delete_text, object_key),
+            )
+        )
+        await asyncio.sleep(0.05)
+        # Uploaded again after the deletion, not before.
+        await self.put_text()
+        self.assertTrue(await release)
+        self.assertIn(object_key, self.bucket)
+        self.assertEqual(self.cursor.objects[object_key]["ref_count"], 1)
+
+    async def test_release_after_deadline(self):
+        self.uploads = 1
+        self.fail_first_upload.set()
+        put_object = object_store.put_object
+
+        async def slow_put_object(object_key, body):
+            await asyncio.sleep(0.1)
+            await put_object(object_key, body)
+
+        with unittest.mock.patch.object(
+            deadline, "ROUTE_TIMEOUTS", {"slow": 0.05}
+        ), unittest.mock.patch.object(
+            object_store, "put_object", deadline.bounded(slow_put_object)
+        ):
+            deadline.start("slow")
+            with self.assertRaises(deadline.DeadlineExceeded):
+                await self.put_text()
+        # Released even though the deadline has passed.
+        self.assertEqual(self.cursor.objects, {})
+
+    async def test_failed_deletion_releases_reference(self):
+        self.uploads = 1
+        with unittest.mock.patch.object(
+            database,
+            "put_text_metadata",
+            unittest.mock.AsyncMock(side_effect=OSError),
+        ), unittest.mock.patch.object(
+            object_store,
+            "delete_text",
+            unittest.mock.AsyncMock(side_effect=OSError),
+        ):
+            with self.assertRaises(OSError):
+                await self.put_text()
+        object_key, _ = object_store.compress_text("text body")
+        self.assertEqual(self.cursor.objects[object_key]["ref_count"], 0)
+
+        deleted = await database.delete_unreferenced_text_objects(
+            object_store.delete_text
+        )
+        self.assertEqual(deleted, [object_key])
+        self.assertEqual(self.cursor.objects, {})
+        self.assertNotIn(object_key, self.bucket)
+
+
+class FakeRedis:
+    round_trips = 0
+    expired_keys = []
+
+    def __init__(self, data, fail):
+        self.data = data
+        self.fail = fail
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def check(self):
+        if self.fail:
+            raise redis.exceptions.ConnectionError("Connection refused")
+
+    async def get(self, key):
+        self.check()
+        return self.data.get(key)
+
+    async def decr(self, key):
+        self.check()
+        self.data[key] = self.data.get(key, 0) - 1
+
+    async def delete(self, key):
+        self.check()
+        return int(self.data.pop(key, None) is not None)
+
+    async def expire(self, key, ex):
+        self.check()
+        FakeRedis.expired_keys.append(key)
+        return key in self.data
+
+    def pipeline(self, transaction):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def mget(self, keys):
+        data = self.redis_client.data
+        self.commands.append(lambda: [data.get(key) for key in keys])
+
+    def set(self, key, value, ex, nx=False):
+        data = self.redis_client.data
+        self.commands.append(
+            lambda: None if nx and key in data else data.update({key: value})
+        )
+
+    def incr(self, key):
+        data = self.redis_client.data
+        self.commands.append(
+            lambda: data.update({key: data.get(key, 0) + 1}) or data[key]
+        )
+
+    def expire(self, key, ex):
+        self.commands.append(lambda: True)
+
+    def unlink(self, *keys):
+        data = self.redis_client.data
+        self.commands.append(
+            lambda: sum(data.pop(key, None) is not None for key in keys)
+        )
+
+    async def execute(self):
+        self.redis_client.check()
+        FakeRedis.round_trips += 1
+        results = [command() for command in self.commands]
+        self.commands = []
+        return results
+
+
+class TestCacheSharding(unittest.TestCase):
+    def setUp(self):
+        self.shards = [cache.Shard(f"redis-{i}", 6379) for i in range(4)]
+        self.keys = [f"text:{uuid.uuid4()}" for _ in range(10000)]
+
+    def test_distribution(self):
+        ring = cache.HashRing(self.shards)
+        counts = collections.Counter(
+            ring.get_node(key).name for key in self.keys
+        )
+        for shard in self.shards:
+            share = counts[shard.name] / len(self.keys)
+            self.assertAlmostEqual(share, 0.25, delta=0.05)
+
+    def test_minimal_rebalancing(self):
+        before = cache.HashRing(self.shards)
+        new_shard = cache.Shard("redis-4", 6379)
+        after = cache.HashRing(self.shards + [new_shard])
+        moved = [
+            key
+            for key in self.keys
+            if before.get_node(key) is not after.get_node(key)
+        ]
+        # Only keys taken over by the new node move.
+        self.assertTrue(all(after.get_node(k) is new_shard for k in moved))
+        self.assertAlmostEqual(len(moved) / len(self.keys), 0.2, delta=0.05)
+
+    def use_fake_shards(self, failed=None):
+        data = {f"{cache.KEY_PREFIX}{key}": "body" for key in self.keys[:100]}
+        FakeRedis.round_trips = 0
+        FakeRedis.expired_keys = []
+        for shard in self.shards:
+            shard.client = functools.partial(
+                FakeRedis, data, fail=shard is failed
+            )
+        patcher = unittest.mock.patch.object(
+            cache, "ring", cache.HashRing(self.shards)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_shard_only_affects_its_keys(self):
+        failed = self.shards[0]
+        self.use_fake_shards(failed)
+
+        async def read_all():
+            return [await cache.get(key) for key in self.keys[:100]]
+
+        for _ in range(failed.circuit_breaker.min_calls_trigger):
+            values = asyncio.run(read_all())
+        self.assertEqual(
+            failed.circuit_breaker.state, CircuitBreakerState.OPEN
+        )
+        for key, value in zip(self.keys, values):
+            if cache.ring.get_node(f"{cache.KEY_PREFIX}{key}") is failed:
+                self.assertIsNone(value)
+            else:
+                self.assertEqual(value, "body")
+        for shard in self.shards[1:]:
+            self.assertEqual(
+                shard.circuit_breaker.state, CircuitBreakerState.CLOSED
+            )
+
+    def test_get_many(self):
+        failed = self.shards[0]
+        self.use_fake_shards(failed)
+        keys = self.keys[:100] + ["missing"]
+        values = asyncio.run(cache.get_many(keys))
+        for key, value in zip(keys, values):
+            if key == "missing" or (
+                cache.ring.get_node(f"{cache.KEY_PREFIX}{key}") is failed
+            ):
+                self.assertIsNone(value)
+            else:
+                self.assertEqual(value, "body")
+
+    def test_batches(self):
+        self.use_fake_shards()
+        keys = self.keys[:1000]
+        asyncio.run(cache.put_many((key, "body", 60) for key in keys))
+        # Writes are sent in chunks of 'BATCH_SIZE' commands per shard.
+        self.assertLessEqual(
+            FakeRedis.round_trips, len(keys) // cache.BATCH_SIZE + 4
+        )
+        self.assertEqual(asyncio.run(cache.get_many(keys)), ["body"] * 1000)
+        FakeRedis.round_trips = 0
+        self.assertEqual(asyncio.run(cache.delete_many(keys)), 1000)
+        self.assertEqual(FakeRedis.round_trips, len(self.shards))
+        self.assertEqual(asyncio.run(cache.get_many(keys)), [None] * 1000)
+
+    def test_concurrent_login_attempts(self):
+        self.use_fake_shards()
+        limits = (auth.MAX_LOGIN_FAIL_USER, auth.MAX_LOGIN_FAIL_IP)
+
+        def attempt():
+            return cache.record_login_attempt("user", "127.0.0.1", 900, limits)
+
+        async def attempts():
+            return await asyncio.gather(*(attempt() for _ in range(10)))
+
+        # Each attempt gets its own count, so only the first attempts up to
+        # the limit are let through.
+        counts = asyncio.run(attempts())
+        self.assertEqual(
+            sorted(user for user, _ in counts), list(range(1, 11))
+        )
+        allowed = [
+            count
+            for count in counts
+            if asyncio.run(auth.login_lock_error("user", count)) is None
+        ]
+        self.assertEqual(len(allowed), auth.MAX_LOGIN_FAIL_USER)
+        # Attempts on a locked account do not extend the lockout.
+        user_key, ip_key = (
+            f"{cache.KEY_PREFIX}{key}"
+            for key in cache.login_failures_keys("user", "127.0.0.1")
+        )
+        FakeRedis.expired_keys = []
+        asyncio.run(attempt())
+        self.assertEqual(FakeRedis.expired_keys, [ip_key])
+        asyncio.run(cache.record_login_success("user", "127.0.0.1"))
+        self.assertEqual(asyncio.run(attempt()), (1, 11))
+
+    def test_login_lock_errors(self):
+        for attempts, error in (
+            ((1, 1), None),
+            ((auth.MAX_LOGIN_FAIL_USER + 1, 1), auth.USER_LOCKED_ERROR),
+            ((1, auth.MAX_LOGIN_FAIL_IP + 1), auth.IP_LOCKED_ERROR),
+        ):
+            self.assertEqual(
+                asyncio.run(auth.login_lock_error("user", attempts)), error
+            )
+
+
+class TestMemcached(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(
+            memcached.memcached_key("text:abc"), f"{cache.KEY_PREFIX}text:abc"
+        )
+        for key in ("user texts", "x" * 300, "caf\u00e9"):
+            hashed = memcached.memcached_key(key)
+            self.assertLessEqual(len(hashed), memcached.MAX_KEY_LENGTH)
+            self.assertRegex(hashed, r"^[!-~]+$")
+
+
+class TestPageCache(unittest.TestCase):
+    def test_accepted_encoding(self):
+        for header, encoding in (
+            ("gzip, deflate, br", "br"),
+            ("gzip;q=0.8, br;q=0", "gzip"),
+            ("br;q=0.5, gzip", "gzip"),
+            ("gzip; q=0.5, br; q=0.6", "br"),
+            ("*;q=0.5, gzip;q=0.8", "gzip"),
+            ("deflate", None),
+            ("", None),
+            ("*", "br"),
+        ):
+            self.assertEqual(page_cache.accepted_encoding(header), encoding)
+
+    def test_page_key(self):
+        self.assertIn(
+            page_cache.TEMPLATE_VERSION, page_cache.page_key("abc", "br")
+        )
+        self.assertEqual(
+            len(set(page_cache.page_keys("abc"))), len(page_cache.ENCODINGS)
+        )
+
+    def test_page_key_canonical_text_id(self):
+        text_id = "0190a1b2-c3d4-7e5f-8a9b-0c1d2e3f4a5b"
+        self.assertEqual(
+            page_cache.page_key(text_id.upper(), "br"),
+            page_cache.page_key(text_id, "br"),
+        )
+        self.assertEqual(
+            page_cache.page_key(text_id.replace("-", ""), "gzip"),
+            page_cache.page_key(text_id, "gzip"),
+        )
+
+    def test_compress(self):
+        html = "<p>text body</p>" * 100
+        gzipped = asyncio.run(page_cache.compress(html, "gzip"))
+        self.assertEqual(gzip.decompress(gzipped).decode(), html)
+        # Pages compress the same every time, gzip headers have no date.
+        self.assertEqual(
+            gzipped, asyncio.run(page_cache.compress(html, "gzip"))
+        )
+
+
+class TestCompression(unittest.IsolatedAsyncioTestCase):
+    async def request(self, chunks, headers, accept_encoding="gzip"):
+        messages = []
+
+        async def app(scope, receive, send):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": headers,
+                }
+            )
+            for i, chunk in enumerate(chunks):
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": i < len(chunks) - 1,
+                    }
+                )
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "headers": [(b"accept-encoding", accept_encoding.encode())],
+        }
+        await compression.CompressionMiddleware(app)(scope, None, send)
+        response_headers = dict(messages[0]["headers"])
+        body = b"".join(m["body"] for m in messages[1:])
+        return response_headers, body
+
+    async def test_streaming(self):
+        chunks = [uuid.uuid4().hex.encode() * 1000 for _ in range(5)]
+        headers, body = await self.request(
+            chunks, [(b"content-type", b"text/html; charset=utf-8")]
+        )
+        self.assertEqual(headers[b"content-encoding"], b"gzip")
+        self.assertEqual(gzip.decompress(body), b"".join(chunks))
+        self.assertLess(len(body), len(b"".join(chunks)))
+
+    async def test_not_compressed(self):
+        large = b"x" * compression.MIN_SIZE
+        for chunks, headers, accept_encoding in (
+            ([b"small"], [(b"content-type", b"text/html")], "gzip"),
+            ([large], [(b"content-type", b"image/png")], "gzip"),
+            ([large], [(b"content-type", b"text/html")], "identity"),
+            (
+                [large],
+                [
+                    (b"content-type", b"text/html"),
+                    (b"content-encoding", b"br"),
+                ],
+                "br",
+            ),
+        ):
+            response_headers, body = await self.request(
+                chunks, headers, accept_encoding
+            )
+            self.assertEqual(response_headers, dict(headers))
+            self.assertEqual(body, b"".join(chunks))
+
+    async def test_headers_of_compressed_body(self):
+        headers, _ = await self.request(
+            [b"x" * compression.MIN_SIZE],
+            [
+                (b"content-type", b"text/html"),
+                (b"etag", b'"abc"'),
+                (b"vary", b"Cookie"),
+            ],
+        )
+        self.assertEqual(headers[b"etag"], b'W/"abc"')
+        self.assertEqual(headers[b"vary"], b"Cookie, Accept-Encoding")
 
-    def test_password_ok(self):
-        self.assertTrue(auth.check_password_complexity("o1sDhfi8&U"))
 
+class TestStaticAssets(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        static_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(static_dir.cleanup)
+        with open(os.path.join(static_dir.name, "style.css"), "w") as f:
+            f.write("body { color: black; }" * 100)
+        with open(os.path.join(static_dir.name, "style.css.gz"), "wb") as f:
+            f.write(gzip.compress(b"body { color: black; }" * 100))
+        versions, variants = static_assets.list_files(static_dir.name)
+        for name, value in (
+            ("STATIC_DIR", static_dir.name),
+            ("VERSIONS", versions),
+            ("VARIANTS", variants),
+        ):
+            patcher = unittest.mock.patch.object(static_assets, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = quart.Quart(__name__)
 
-def main():
-    print(test_get_text())
+    async def test_send_asset(self):
+        version = static_assets.VERSIONS["style.css"]
+        async with self.app.test_request_context("/"):
+            response = await static_assets.send_asset(
+                "style.css", "gzip, br", version
+            )
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(
+                gzip.decompress(await response.get_data()),
+                b"body { color: black; }" * 100,
+            )
+            response = await static_assets.send_asset("style.css", "br")
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertFalse(response.cache_control.immutable)
+            self.assertEqual(
+                response.cache_control.max_age,
+                static_assets.UNVERSIONED_MAX_AGE,
+            )
 
 
 if __name__ == "__main__":
-    main()
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Per-worker Bloom filter of existing text IDs, used to answer requests for
+nonexistent texts (crawlers, scanners) without querying the database.
+
+The filter is built from the table 'texts' by a background task, and rebuilt
+every 'refresh_interval' seconds. Texts created after a rebuild started are
+missing from the filter of other workers, so text IDs generated after the
+snapshot (UUIDv7 embed their creation time) are not looked up in the filter.
+
+Hashing millions of IDs holds the GIL for seconds, so the filter is built in
+a separate process, read from the primary database.
+"""
+import asyncio
+import contextvars
+import hashlib
+import math
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import database
+from . import ids
+from .config import config
+from .log import get_logger
+
+LOGGER = get_logger()
+CAPACITY = config["text_filter"]["capacity"]
+ERROR_RATE = config["text_filter"]["error_rate"]
+REFRESH_INTERVAL = config["text_filter"]["refresh_interval"]
+# Between hosts generating text IDs, and between the generation of an ID and
+# the insertion of its text, which is bounded by the request deadline.
+CLOCK_SKEW = 60  # seconds
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def positions(self, key):
+        # Double hashing: k positions from two 64-bit hashes.
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self.positions(key)
+        )
+
+
+current = None
+snapshot_time = None
+refresh_task = None
+
+
+def build():
+    # Blocking, run it in a separate process.
+    started = time.time()
+    new_filter = BloomFilter(CAPACITY, ERROR_RATE)
+    count = 0
+    for text_ids in database.iter_live_text_ids_sync():
+        for text_id in text_ids:
+            new_filter.add(text_id)
+        count += len(text_ids)
+    if count > CAPACITY:
+        LOGGER.warning(
+            f"Text filter holds {count} IDs but is sized for {CAPACITY}, "
+            "increase its capacity to keep false positives low"
+        )
+    return new_filter, started, count
+
+
+async def refresh_periodically():
+    global current, snapshot_time
+    loop = asyncio.get_running_loop()
+    while True:
+        # Spawned rather than forked, as the worker runs threads.
+        executor = ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        )
+        try:
+            new_filter, started, count = await loop.run_in_executor(
+                executor, build
+            )
+            current, snapshot_time = new_filter, started
+            LOGGER.info(f"Text filter rebuilt with {count} text IDs")
+        except Exception as err:
+            LOGGER.error(
+                f"{err.__class__.__name__} when rebuilding text filter: {err}"
+            )
+        finally:
+            executor.shutdown(wait=False)
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+
+def start_refresh_task():
+    global refresh_task
+    # Started lazily because gunicorn hooks run before the worker starts its
+    # asyncio loop.
+    if CAPACITY > 0 and (refresh_task is None or refresh_task.done()):
+        refresh_task = asyncio.get_running_loop().create_task(
+            refresh_periodically(), context=contextvars.Context()
+        )
+
+
+def add(text_id):
+    if current is not None:
+        current.add(text_id)
+
+
+def lookup(text_id):
+    """
+    Check a text ID parsed with 'ids.parse_text_id'. Return False if the text
+    does not exist, True if it may exist, and None if the filter cannot tell
+    because it is not built yet or the ID is more recent than the filter.
+    """
+    start_refresh_task()
+    if current is None:
+        return
+    created = ids.uuid7_timestamp(text_id)
+    if created is not None and created >= snapshot_time - CLOCK_SKEW:
+        return
+    return str(text_id) in current
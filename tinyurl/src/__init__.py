@@ -16,6 +16,8 @@ from flask import (
 from . import mongo
 
 APP_URL = "127.0.0.1:5000"
+BULK_MAX_URLS = 1000
+DATE_FORMAT = "%m/%d/%Y %H:%M:%S UTC"
 DEFAULT_USER = "anonymous"
 TTL_TO_HOURS = {
     "1h": 1,
@@ -28,6 +30,22 @@ TTL_TO_HOURS = {
 mongo_client = mongo.Client()
 
 
+def alias_service_url(path):
+    alias_host = os.getenv("ALIAS_SERVICE_HOST")
+    alias_port = os.getenv("ALIAS_SERVICE_PORT")
+    return f"http://{alias_host}:{alias_port}/{path}"
+
+
+def get_aliases(count):
+    if count == 0:
+        return []
+    response = requests.get(
+        alias_service_url("get-aliases"), params={"count": count}
+    )
+    response.raise_for_status()
+    return response.json()["aliases"]
+
+
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.secret_key = secrets.token_hex()
@@ -41,6 +59,7 @@ def create_app(test_config=None):
     def index():
         msg = None
         user_urls = []
+        next_page = None
 
         if request.method == "POST":
             username = session.get("username", DEFAULT_USER)
@@ -53,10 +72,8 @@ def create_app(test_config=None):
                 if mongo_client.get_url(alias) is not None:
                     msg = f"Error: alias '{alias}' already exists"
             else:
-                alias_host = os.getenv("ALIAS_SERVICE_HOST")
-                alias_port = os.getenv("ALIAS_SERVICE_PORT")
                 alias = requests.get(
-                    f"http://{alias_host}:{alias_port}/get-alias"
+                    alias_service_url("get-alias")
                 ).json()["alias"]
 
             if msg is None:
@@ -64,13 +81,101 @@ def create_app(test_config=None):
                 msg = f"Created short URL: {APP_URL}/{alias}"
 
         if g.user:
-            user_urls = mongo_client.get_urls_by_user(g.user["_id"])
+            user_urls, next_page = mongo_client.get_urls_by_user(
+                g.user["_id"],
+                before=mongo.decode_page_cursor(request.args.get("before")),
+            )
+            if next_page is not None:
+                next_page = mongo.encode_page_cursor(next_page)
             for u in user_urls:
                 u["alias"] = f"{APP_URL}/{u['_id']}"
-                u["created_on"] = u["created_on"].strftime("%m/%d/%Y %H:%M:%S")
-                u["ttl"] = u["ttl"].strftime("%m/%d/%Y %H:%M:%S")
+                u["created_on"] = u["created_on"].strftime(DATE_FORMAT)
+                u["ttl"] = u["ttl"].strftime(DATE_FORMAT)
+
+        return render_template(
+            "index.html",
+            message=msg,
+            myurls=user_urls,
+            next_page=next_page,
+        )
+
+    @app.route("/api/urls", methods=("POST",))
+    def bulk_create_urls():
+        """
+        Shortens several URLs at once. Expects a JSON body such as
+        {"urls": [{"url": "https://...", "alias": "optional", "ttl": "1w"}]}
+        and returns one result per URL, in the same order.
+        """
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or not isinstance(
+            payload.get("urls"), list
+        ):
+            return {"error": "expected a JSON object with a list 'urls'"}, 400
+        items = payload["urls"]
+        if len(items) > BULK_MAX_URLS:
+            return {"error": f"at most {BULK_MAX_URLS} URLs per request"}, 413
+
+        username = session.get("username", DEFAULT_USER)
+        results = [None] * len(items)
+        urls = []
+        positions = []
+        custom_aliases = set()
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get("url"):
+                results[i] = {"error": "missing 'url'"}
+                continue
+            if not isinstance(item["url"], str):
+                results[i] = {"error": "invalid 'url'"}
+                continue
+            ttl = item.get("ttl", "1w")
+            if not isinstance(ttl, str) or ttl not in TTL_TO_HOURS:
+                results[i] = {"url": item["url"], "error": "invalid 'ttl'"}
+                continue
+            alias = item.get("alias")
+            if alias is not None and not isinstance(alias, str):
+                results[i] = {"url": item["url"], "error": "invalid 'alias'"}
+                continue
+            if alias:
+                alias = quote_plus(alias)
+                if alias in custom_aliases:
+                    results[i] = {
+                        "url": item["url"],
+                        "error": "alias already exists",
+                    }
+                    continue
+                custom_aliases.add(alias)
+            urls.append([alias or None, item["url"], TTL_TO_HOURS[ttl]])
+            positions.append(i)
+
+        missing = [n for n, u in enumerate(urls) if u[0] is None]
+        try:
+            for n, alias in zip(missing, get_aliases(len(missing))):
+                urls[n][0] = alias
+        except (requests.RequestException, KeyError, ValueError):
+            # URLs with a custom alias can still be stored.
+            for n in missing:
+                results[positions[n]] = {
+                    "url": urls[n][1],
+                    "error": "alias service unavailable",
+                }
+            kept = [n for n, u in enumerate(urls) if u[0] is not None]
+            urls = [urls[n] for n in kept]
+            positions = [positions[n] for n in kept]
+
+        errors = mongo_client.create_urls(urls, username)
+        for n, (position, (alias, original, _)) in enumerate(
+            zip(positions, urls)
+        ):
+            if n in errors:
+                results[position] = {"url": original, "error": errors[n]}
+            else:
+                results[position] = {
+                    "url": original,
+                    "alias": alias,
+                    "short_url": f"{APP_URL}/{alias}",
+                }
 
-        return render_template("index.html", message=msg, myurls=user_urls)
+        return {"results": results}
 
     @app.route("/<alias>")
     def alias(alias):
@@ -1,7 +1,16 @@
-from fastapi import FastAPI
+import fcntl
+import os
+import threading
+
+import psycopg2.errors
+from fastapi import FastAPI, Query
 
 import postgres
 
+# Number of aliases reserved at once by counter-based allocators.
+RANGE_SIZE = 1000000
+MAX_ALIASES_PER_REQUEST = 10000
+
 
 class Batch:
     def __init__(self, size=1000):
@@ -9,27 +18,152 @@ class Batch:
         self.db = postgres.DB()
         self.size = size
         self.items = []
+        self.lock = threading.Lock()
         self.load_batch()
 
-    def load_batch(self):
-        if len(self.items) > 0:
+    def load_batch(self, size=None):
+        if len(self.items) > 0 and size is None:
             return
         if self.db.con.closed:
             print("connecting to database")
             self.db.connect()
         print("getting new batch of aliases")
-        self.items = postgres.get_aliases_batch(self.db.con, self.size)
+        self.items.extend(
+            postgres.get_aliases_batch(self.db.con, size or self.size)
+        )
+
+    def get_alias(self):
+        # FastAPI runs synchronous endpoints in a thread pool.
+        with self.lock:
+            if len(self.items) == 0:
+                self.load_batch()
+            return self.items.pop()
+
+    def get_aliases(self, count):
+        with self.lock:
+            if count > len(self.items):
+                self.load_batch(max(count - len(self.items), self.size))
+            if count > len(self.items):
+                raise RuntimeError("alias pool is exhausted")
+            aliases = self.items[-count:]
+            del self.items[-count:]
+        return aliases
+
+
+class SequenceCounter:
+    def __init__(self, max_range):
+        print("connecting to database")
+        self.db = postgres.DB()
+        postgres.create_aliases_sequence(self.db.con, max_range)
+
+    def next_range(self):
+        if self.db.con.closed:
+            print("connecting to database")
+            self.db.connect()
+        try:
+            return postgres.reserve_aliases_range(self.db.con)
+        except psycopg2.errors.SequenceGeneratorLimitExceeded:
+            # The sequence stops at the last range of the alias space.
+            self.db.con.rollback()
+            raise RuntimeError("alias space is exhausted")
+
+
+class FileCounter:
+    def __init__(self, path):
+        self.path = path
+
+    def next_range(self):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            value = int(f.read().strip() or 0)
+            f.seek(0)
+            f.truncate()
+            f.write(str(value + 1))
+            f.flush()
+            os.fsync(f.fileno())
+        return value
+
+
+class CounterBatch:
+    """
+    Hands out aliases from integer ranges reserved with a counter, mapped to
+    aliases with a keyed permutation so they are not served in a predictable
+    order. Aliases are computed on demand, a range only costs two integers.
+    """
+
+    def __init__(self, counter, key, length=6, range_size=RANGE_SIZE):
+        self.counter = counter
+        self.length = length
+        self.range_size = range_size
+        self.permutation = postgres.AliasPermutation(length, key)
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+
+    def load_range(self):
+        print("reserving new range of aliases")
+        start = self.counter.next_range() * self.range_size
+        if start >= self.permutation.size:
+            raise RuntimeError("alias space is exhausted")
+        self.next = start
+        self.end = min(start + self.range_size, self.permutation.size)
 
     def get_alias(self):
-        if len(self.items) == 0:
-            self.load_batch()
-        return self.items.pop()
+        # FastAPI runs synchronous endpoints in a thread pool.
+        with self.lock:
+            if self.next == self.end:
+                self.load_range()
+            index = self.next
+            self.next += 1
+        return postgres.index_to_alias(
+            self.permutation.permute(index), self.length
+        )
+
+    def get_aliases(self, count):
+        indices = []
+        with self.lock:
+            while len(indices) < count:
+                if self.next == self.end:
+                    self.load_range()
+                stop = min(self.end, self.next + count - len(indices))
+                indices.extend(range(self.next, stop))
+                self.next = stop
+        return [
+            postgres.index_to_alias(self.permutation.permute(i), self.length)
+            for i in indices
+        ]
+
+
+def make_batch():
+    allocator = os.getenv("ALIAS_ALLOCATOR", "table")
+    if allocator == "table":
+        return Batch(1000)
+
+    key = os.getenv("ALIAS_PERMUTATION_KEY")
+    if key is None:
+        raise ValueError(
+            "ALIAS_PERMUTATION_KEY must be set to use a counter allocator"
+        )
+    length = int(os.getenv("ALIAS_LENGTH", 6))
+    max_range = (len(postgres.ALPHABET) ** length - 1) // RANGE_SIZE
+    if allocator == "sequence":
+        counter = SequenceCounter(max_range)
+    elif allocator == "file":
+        counter = FileCounter(os.getenv("ALIAS_COUNTER_FILE", "alias_counter"))
+    else:
+        raise ValueError(f"Unknown alias allocator '{allocator}'")
+    return CounterBatch(counter, key, length)
 
 
 app = FastAPI()
-batch = Batch(1000)
+batch = make_batch()
 
 
 @app.get("/get-alias")
 def get_alias():
     return {"alias": batch.get_alias()}
+
+
+@app.get("/get-aliases")
+def get_aliases(count: int = Query(..., ge=1, le=MAX_ALIASES_PER_REQUEST)):
+    return {"aliases": batch.get_aliases(count)}
@@ -0,0 +1,77 @@
+"""
+Measures how many URLs per second a running application shortens, with the
+bulk API and with the HTML form.
+
+Example: python benchmark.py --app-url http://127.0.0.1:5000 --count 10000
+"""
+import argparse
+import secrets
+import time
+
+import requests
+
+
+def make_urls(count):
+    return [
+        f"https://example.com/{i}/{secrets.token_urlsafe(16)}"
+        for i in range(count)
+    ]
+
+
+def benchmark_bulk(app_url, urls, batch_size):
+    errors = 0
+    with requests.Session() as session:
+        start = time.perf_counter()
+        for i in range(0, len(urls), batch_size):
+            response = session.post(
+                f"{app_url}/api/urls",
+                json={"urls": [{"url": u} for u in urls[i:i + batch_size]]},
+            )
+            response.raise_for_status()
+            errors += sum(
+                1 for r in response.json()["results"] if "error" in r
+            )
+        elapsed = time.perf_counter() - start
+    return len(urls) / elapsed, errors
+
+
+def benchmark_form(app_url, urls):
+    with requests.Session() as session:
+        start = time.perf_counter()
+        for url in urls:
+            response = session.post(
+                app_url,
+                data={"longurl": url, "custom-alias": "", "ttl": "1w"},
+            )
+            response.raise_for_status()
+        elapsed = time.perf_counter() - start
+    return len(urls) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--app-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--form-count",
+        type=int,
+        default=1000,
+        help="URLs shortened one by one with the form, for comparison",
+    )
+    args = parser.parse_args()
+
+    throughput, errors = benchmark_bulk(
+        args.app_url, make_urls(args.count), args.batch_size
+    )
+    print(
+        f"bulk API: {throughput:.0f} URLs/sec "
+        f"({args.count} URLs, batches of {args.batch_size}, {errors} errors)"
+    )
+    if args.form_count > 0:
+        throughput = benchmark_form(args.app_url, make_urls(args.form_count))
+        print(f"form: {throughput:.0f} URLs/sec ({args.form_count} URLs)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Converts the creation and expiration dates of URLs stored in the local time
+of the application servers to UTC, which the TTL index and reads expect, then
+creates the TTL index. Run once, before or right after deploying the version
+that stores UTC dates.
+
+Example: python migrate_dates.py Europe/Paris --ttl-grace-period 86400
+"""
+import argparse
+
+import mongo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "timezone", help="timezone of the application servers, e.g. UTC"
+    )
+    parser.add_argument(
+        "--ttl-grace-period",
+        type=int,
+        default=0,
+        help="seconds MongoDB keeps expired URLs, for the sweeper",
+    )
+    args = parser.parse_args()
+
+    print("connecting to database")
+    mongo_client = mongo.Client()
+    migrated = mongo_client.migrate_dates_to_utc(args.timezone)
+    print(f"migrated {migrated} URLs")
+    # Created after the migration, so URLs are not removed hours early.
+    print("create TTL index if not exists")
+    mongo_client.create_urls_ttl_index(args.ttl_grace_period)
+    print("success")
+
+
+if __name__ == "__main__":
+    main()
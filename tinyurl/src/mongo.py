@@ -2,6 +2,40 @@ import datetime
 import os
 
 import pymongo
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+URLS_PAGE_SIZE = 50
+URL_SUMMARY_PROJECTION = {"original": 1, "created_on": 1, "ttl": 1}
+URLS_BY_USER_SORT = [
+    ("created_on", pymongo.DESCENDING),
+    ("_id", pymongo.DESCENDING),
+]
+DATE_PARTS = (
+    "year",
+    "month",
+    "day",
+    "hour",
+    "minute",
+    "second",
+    "millisecond",
+)
+
+
+def utc_now():
+    # TTL indexes compare dates in UTC.
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def local_to_utc(field, timezone):
+    # Dates are stored as UTC, so the parts of a local time stored as is are
+    # the parts of that local time.
+    return {
+        "$dateFromParts": {
+            **{part: {f"${part}": f"${field}"} for part in DATE_PARTS},
+            "timezone": timezone,
+        }
+    }
 
 
 class Client:
@@ -17,24 +51,143 @@ class Client:
         self.urls = self.db[self.coll_urls]
 
     def create_urls_users_index(self):
-        self.urls.create_index(("created_by", pymongo.HASHED))
+        # Compound index so a user's URLs can be read page by page in
+        # creation order, a hashed index cannot serve sorted range scans.
+        self.urls.create_index(
+            [("created_by", pymongo.ASCENDING)] + URLS_BY_USER_SORT
+        )
+
+    def create_urls_ttl_index(self, expire_after=0):
+        # MongoDB removes documents 'expire_after' seconds past their 'ttl'.
+        # A grace period leaves time for the sweeper to recycle aliases.
+        self.urls.create_index("ttl", expireAfterSeconds=expire_after)
+
+    def migrate_dates_to_utc(self, timezone):
+        """
+        Converts 'created_on' and 'ttl' of URLs, and 'joined_on' and
+        'last_login' of users, stored in the local time of 'timezone', e.g.
+        'Europe/Paris', to UTC. Documents stored in UTC have the field 'utc',
+        so the migration can run more than once.
+
+        :returns (int): Number of migrated URLs.
+        """
+        self.users.update_many(
+            {"utc": {"$exists": False}},
+            [
+                {
+                    "$set": {
+                        "joined_on": local_to_utc("joined_on", timezone),
+                        # Users who never logged in have no last login.
+                        "last_login": {
+                            "$cond": [
+                                {"$eq": [{"$type": "$last_login"}, "date"]},
+                                local_to_utc("last_login", timezone),
+                                "$$REMOVE",
+                            ]
+                        },
+                        "utc": True,
+                    }
+                }
+            ],
+        )
+        result = self.urls.update_many(
+            {"utc": {"$exists": False}},
+            [
+                {
+                    "$set": {
+                        "created_on": local_to_utc("created_on", timezone),
+                        "ttl": local_to_utc("ttl", timezone),
+                        "utc": True,
+                    }
+                }
+            ],
+        )
+        return result.modified_count
 
     def create_url(self, alias, original, user_name, ttl):
-        now = datetime.datetime.now()
+        now = utc_now()
         doc = {
             "_id": alias,
             "original": original,
             "created_by": user_name,
             "created_on": now,
             "ttl": now + datetime.timedelta(hours=ttl),
+            "utc": True,
         }
-        self.urls.insert_one(doc)
+        # Expired URLs may not have been removed yet, their alias can be
+        # reused. Raises DuplicateKeyError if the alias is still in use.
+        self.urls.replace_one(
+            {"_id": alias, "ttl": {"$lte": now}}, doc, upsert=True
+        )
+
+    def create_urls(self, urls, user_name):
+        """
+        Stores URLs with a single unordered bulk write. Aliases are written
+        like in 'create_url', so expired URLs may be replaced.
+
+        :param list(list) urls: Lists [alias, original, ttl] where ttl is in
+            hours.
+        :param str user_name: Username of the creator.
+        :returns (dict): Error messages indexed by position in 'urls'.
+        """
+        if len(urls) == 0:
+            return {}
+        now = utc_now()
+        operations = []
+        for alias, original, ttl in urls:
+            doc = {
+                "_id": alias,
+                "original": original,
+                "created_by": user_name,
+                "created_on": now,
+                "ttl": now + datetime.timedelta(hours=ttl),
+                "utc": True,
+            }
+            operations.append(
+                pymongo.ReplaceOne(
+                    {"_id": alias, "ttl": {"$lte": now}}, doc, upsert=True
+                )
+            )
+
+        try:
+            self.urls.bulk_write(operations, ordered=False)
+        except BulkWriteError as err:
+            return {
+                e["index"]: (
+                    "alias already exists"
+                    if e["code"] == DUPLICATE_KEY_ERROR
+                    else e["errmsg"]
+                )
+                for e in err.details["writeErrors"]
+            }
+        return {}
 
     def get_url(self, alias):
-        result = self.urls.find_one({"_id": alias}, {"_id": 0, "original": 1})
+        result = self.urls.find_one(
+            {"_id": alias, "ttl": {"$gt": utc_now()}},
+            {"_id": 0, "original": 1},
+        )
         if result is not None:
             return result["original"]
 
+    def get_expired_aliases(self, now, limit):
+        return [
+            doc["_id"]
+            for doc in self.urls.find({"ttl": {"$lte": now}}, {"_id": 1})
+            .limit(limit)
+        ]
+
+    def delete_expired_urls(self, aliases, now):
+        self.urls.delete_many({"_id": {"$in": aliases}, "ttl": {"$lte": now}})
+
+    def filter_expired_aliases(self, aliases, now):
+        return [
+            doc["_id"]
+            for doc in self.urls.find(
+                {"_id": {"$in": aliases}, "ttl": {"$lte": now}}, {"_id": 1}
+            )
+        ]
+
     def register_user(self, user_name, first_name, last_name, password):
         self.users.insert_one(
             {
@@ -42,18 +195,52 @@ class Client:
                 "first_name": first_name,
                 "last_name": last_name,
                 "password": password,
-                "joined_on": datetime.datetime.now(),
+                "joined_on": utc_now(),
+                "utc": True,
             }
         )
 
     def get_user(self, user_name):
         return self.users.find_one({"_id": user_name})
 
-    def get_urls_by_user(self, user_name):
-        return list(self.urls.find({"created_by": user_name}))
+    def get_urls_by_user(self, user_name, before=None, limit=URLS_PAGE_SIZE):
+        query = {"created_by": user_name}
+        if before is not None:
+            created_on, alias = before
+            query["$or"] = [
+                {"created_on": {"$lt": created_on}},
+                {"created_on": created_on, "_id": {"$lt": alias}},
+            ]
+        # Fetch one extra document to know if there is a next page.
+        urls = list(
+            self.urls.find(query, URL_SUMMARY_PROJECTION)
+            .sort(URLS_BY_USER_SORT)
+            .limit(limit + 1)
+        )
+        next_page = None
+        if len(urls) > limit:
+            urls = urls[:limit]
+            next_page = (urls[-1]["created_on"], urls[-1]["_id"])
+        return urls, next_page
 
     def update_user_last_login(self, user_name):
-        now = datetime.datetime.now()
+        # Users whose dates are still in local time are updated once they
+        # are migrated, 'migrate_dates_to_utc' would convert it again.
         self.users.update_one(
-            {"_id": user_name}, {"$set": {"last_login": now}}
+            {"_id": user_name, "utc": True},
+            {"$set": {"last_login": utc_now()}},
         )
+
+
+def encode_page_cursor(page):
+    created_on, alias = page
+    return f"{created_on.isoformat()}_{alias}"
+
+
+def decode_page_cursor(cursor):
+    # ISO timestamps do not contain underscores, aliases may.
+    try:
+        created_on, alias = cursor.split("_", 1)
+        return datetime.datetime.fromisoformat(created_on), alias
+    except (AttributeError, ValueError):
+        return None
@@ -8,10 +8,15 @@ Functions in this module assume that:
     * ALIAS_DB_PASSWORD
     * ALIAS_DB_HOST
     * ALIAS_DB_PORT
+* the environment variable ALIAS_PERMUTATION_KEY may be defined to keep the
+  order of generated aliases stable across incremental generation runs, it
+  must be defined to resume a run
 """
+import hashlib
+import io
 import itertools
 import os
-import random
+import secrets
 import string
 import time
 
@@ -21,9 +26,17 @@ import psycopg2.extensions
 import psycopg2.extras
 
 CREATE_ALIASES_TABLE_SQL = """
-CREATE TABLE aliases (id VARCHAR(6));
+CREATE TABLE IF NOT EXISTS aliases (id VARCHAR(6));
 """
 
+CREATE_ALIASES_SEQUENCE_SQL = """
+CREATE SEQUENCE IF NOT EXISTS alias_ranges MINVALUE 0 MAXVALUE %s START 0;
+"""
+
+ALPHABET = string.ascii_letters + string.digits + "-_."
+FEISTEL_ROUNDS = 4
+MASK_64 = (1 << 64) - 1
+
 # parameters for connection retries
 MAX_RETRIES = 9
 BACKOFF_FACTOR = 0.3
@@ -59,28 +72,133 @@ class DB:
         self.con = con
 
 
-def generate_aliases(length=6):
-    alphabet = string.ascii_letters + string.digits + "-_."
+class AliasPermutation:
+    """
+    Keyed bijection over the integer index space of aliases of a given
+    length, built from a balanced Feistel network and cycle walking.
+
+    It lets us visit the whole alias space in a pseudo-random order without
+    materializing it, and ``invert`` recovers the index of an alias.
+    """
+
+    def __init__(self, length, key, rounds=FEISTEL_ROUNDS):
+        self.length = length
+        self.size = len(ALPHABET) ** length
+        self.half_bits = (max(2, (self.size - 1).bit_length()) + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.round_keys = [
+            int.from_bytes(
+                hashlib.blake2b(
+                    f"{key}:{i}".encode(), digest_size=8
+                ).digest(),
+                "big",
+            )
+            for i in range(rounds)
+        ]
+
+    def _round(self, value, round_key):
+        h = ((value ^ round_key) * 0x9E3779B97F4A7C15) & MASK_64
+        h ^= h >> 32
+        return ((h * 0xBF58476D1CE4E5B9) & MASK_64) >> (64 - self.half_bits)
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ self._round(right, round_key)
+        return (left << self.half_bits) | right
+
+    def _decrypt(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_key in reversed(self.round_keys):
+            left, right = right ^ self._round(left, round_key), left
+        return (left << self.half_bits) | right
+
+    def permute(self, index):
+        # The Feistel network permutes a power-of-two domain larger than the
+        # alias space, re-encrypt until we land back inside it.
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def invert(self, value):
+        index = self._decrypt(value)
+        while index >= self.size:
+            index = self._decrypt(index)
+        return index
+
+
+def is_valid_alias(alias, max_length=6):
+    return 0 < len(alias) <= max_length and all(c in ALPHABET for c in alias)
+
+
+def index_to_alias(index, length):
+    chars = []
+    for _ in range(length):
+        index, digit = divmod(index, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+def alias_to_index(alias):
+    index = 0
+    for char in alias:
+        index = index * len(ALPHABET) + ALPHABET.index(char)
+    return index
 
-    # Make tuples of single element to insert easily into database.
-    aliases = [
-        ("".join(i),) for i in itertools.product(alphabet, repeat=length)
-    ]
 
-    random.shuffle(aliases)
-    return aliases
+def generate_aliases(length=6, key="", start=0, stop=None):
+    """
+    Yields aliases of the desired length in a pseudo-random order determined
+    by ``key``, without holding the alias space in memory.
 
+    :param int length: Desired alias length.
+    :param str key: Permutation key, use the same key to resume a run.
+    :param int start: Position in the permuted sequence to start from.
+    :param int stop: Position in the permuted sequence to stop at (excluded),
+        defaults to the size of the alias space.
+    :returns (generator(str)): Aliases.
+    """
+    permutation = AliasPermutation(length, key)
+    stop = permutation.size if stop is None else min(stop, permutation.size)
+    for index in range(start, stop):
+        yield index_to_alias(permutation.permute(index), length)
 
-def store_aliases(aliases, con, page_size=10000):
+
+def store_aliases(aliases, con, chunk_size=1000000, truncate=True, total=None):
+    """
+    Loads aliases in the database with COPY, one chunk per transaction, so
+    memory usage is bounded by the chunk size.
+
+    :param iterable(str) aliases: Aliases to store.
+    :param psycopg2.connection con: Psycopg2 connection object.
+    :param int chunk_size: Number of aliases loaded per COPY statement.
+    :param bool truncate: Whether to empty the aliases table first.
+    :param int total: Expected number of aliases, for progress reporting.
+    :returns (int): Number of aliases stored.
+    """
+    stored = 0
+    start_time = time.monotonic()
+    aliases = iter(aliases)
     with con.cursor() as cur:
-        cur.execute("TRUNCATE TABLE aliases;")
-        psycopg2.extras.execute_batch(
-            cur,
-            "INSERT INTO aliases VALUES (%s);",
-            aliases,
-            page_size=page_size,
-        )
-        con.commit()
+        if truncate:
+            cur.execute("TRUNCATE TABLE aliases;")
+        while chunk := list(itertools.islice(aliases, chunk_size)):
+            # Aliases only contain characters from ALPHABET, so they do not
+            # need escaping in COPY text format.
+            cur.copy_expert(
+                "COPY aliases (id) FROM STDIN;",
+                io.StringIO("\n".join(chunk) + "\n"),
+            )
+            con.commit()
+            stored += len(chunk)
+            elapsed = time.monotonic() - start_time
+            progress = f"{stored}" if total is None else f"{stored}/{total}"
+            print(
+                f"stored {progress} aliases "
+                f"({stored / max(elapsed, 1e-9):.0f} aliases/s)"
+            )
+    return stored
 
 
 def get_aliases_batch(con, size=1000):
@@ -105,9 +223,43 @@ def get_aliases_batch(con, size=1000):
     return result
 
 
-def generate_aliases_run():
-    print("generating aliases")
-    aliases = generate_aliases(4)
+def create_aliases_sequence(con, max_range):
+    with con.cursor() as cur:
+        cur.execute(CREATE_ALIASES_SEQUENCE_SQL, (max_range,))
+        con.commit()
+
+
+def reserve_aliases_range(con):
+    """
+    Reserves the next range of alias indices. Sequences are not
+    transactional, so concurrent callers never get the same range.
+
+    :param psycopg2.connection con: Psycopg2 connection object.
+    :returns (int): Range number.
+    """
+    with con.cursor() as cur:
+        cur.execute("SELECT nextval('alias_ranges');")
+        result = cur.fetchone()[0]
+        con.commit()
+    return result
+
+
+def generate_aliases_run(length=4, start=0, stop=None):
+    key = os.getenv("ALIAS_PERMUTATION_KEY")
+    if key is None:
+        if start > 0:
+            raise ValueError(
+                "ALIAS_PERMUTATION_KEY must be set to resume generation"
+            )
+        key = secrets.token_hex(16)
+        print(
+            f"using permutation key {key}, set ALIAS_PERMUTATION_KEY to this "
+            "value to resume generation"
+        )
+    size = len(ALPHABET) ** length
+    stop = size if stop is None else min(stop, size)
+    total = max(stop - start, 0)
+    aliases = generate_aliases(length, key, start, stop)
     print("connecting to database")
     db = DB(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT)
     try:
@@ -116,7 +268,7 @@ def generate_aliases_run():
             cur.execute(CREATE_ALIASES_TABLE_SQL)
             db.con.commit()
         print("storing aliases to database")
-        store_aliases(aliases, db.con)
+        store_aliases(aliases, db.con, truncate=start == 0, total=total)
         print("success")
     except Exception as e:
         print(e)
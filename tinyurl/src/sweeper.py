@@ -0,0 +1,60 @@
+"""
+Removes expired URLs in batches and gives their aliases back to the alias
+pool, so they can be handed out again by the alias service.
+
+The URLs collection should have a TTL index with a grace period (see
+'mongo.Client.create_urls_ttl_index'), MongoDB then only removes expired URLs
+that the sweeper did not process in time.
+"""
+import os
+
+import psycopg2.extensions
+
+import mongo
+import postgres
+
+BATCH_SIZE = int(os.getenv("SWEEPER_BATCH_SIZE", 10000))
+
+
+def sweep(mongo_client, con, batch_size=BATCH_SIZE, recycle=True):
+    swept = recycled = 0
+    while True:
+        now = mongo.utc_now()
+        aliases = mongo_client.get_expired_aliases(now, batch_size)
+        if len(aliases) == 0:
+            break
+        if recycle:
+            # Aliases are recycled before their URLs are deleted, so they are
+            # not lost if the sweeper stops in between, the next run recycles
+            # them again. Aliases of URLs re-created since the query are in
+            # use again. Custom aliases may not fit in the alias pool.
+            recyclable = [
+                a for a in mongo_client.filter_expired_aliases(aliases, now)
+                if postgres.is_valid_alias(a)
+            ]
+            recycled += postgres.store_aliases(
+                recyclable, con, truncate=False
+            )
+        mongo_client.delete_expired_urls(aliases, now)
+        swept += len(aliases)
+        print(f"swept {swept} expired URLs, recycled {recycled} aliases")
+    return swept, recycled
+
+
+def main():
+    print("connecting to databases")
+    mongo_client = mongo.Client()
+    db = postgres.DB(
+        isolation_level=psycopg2.extensions.ISOLATION_LEVEL_DEFAULT
+    )
+    # Counter-based allocators never read the aliases table.
+    recycle = os.getenv("ALIAS_ALLOCATOR", "table") == "table"
+    try:
+        swept, recycled = sweep(mongo_client, db.con, recycle=recycle)
+        print(f"success: swept {swept} URLs, recycled {recycled} aliases")
+    finally:
+        db.con.close()
+
+
+if __name__ == "__main__":
+    main()